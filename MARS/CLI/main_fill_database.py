@@ -1,65 +1,238 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import time
 import traceback
 from CGRtools.files.RDFrw import RDFread, RDFwrite
-from itertools import count
-import itertools
-from MARS.models import Molecules
-from pony.orm import db_session
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO
+import json
+from MARS.models import db, Molecules, MoleculeRecord, ReactionRecord, fear, cgr_core, bump_generation, get_generation, \
+    MAX_PARAMS, fragmentor_mol, fragmentor_rct
+from networkx.readwrite.json_graph import node_link_data
+from pony.orm import db_session, commit
 from MARS.models import Reactions
 from MARS.models import ReactionsMolecules
+from MARS.files.TreeIndex import TreeIndex
+from MARS.files.LSHIndex import LSHIndex
+from MARS.files.Stream import rdf_chunks, load_checkpoint, save_checkpoint
+from MARS.files.Profile import profiler, profiled_call, timed
 
+QUEUE_SIZE = 2
 
-def fill_database_core(**kwargs):
-    it = iter(RDFread(kwargs['input']))
-    chunksize = kwargs['chunksize']
-
-    for x in itertools.zip_longest(*[it]*chunksize):
-        if None in x:
-            y = []
-            for i in x:
-                if i is None:
-                    break
-                y.append(i)
-            x = y
-
-        print(x)
-
-        substrats_list = []
-        products_list = []
 
+def fill_database_core(**kwargs):
+    inputdata = kwargs['input']
+    source = inputdata.name
+    checkpoint = kwargs['checkpoint'] or '%s.checkpoint' % source
+    resumable = inputdata.seekable()
+    if kwargs['resume']:
+        if not resumable:
+            raise ValueError('only regular files can be resumed')
+        offset, loaded = load_checkpoint(checkpoint, source)
+        print('Resuming from record %d' % loaded)
+    else:
+        offset, loaded = 0, 0
+
+    start = time.perf_counter()
+    processed = 0
+    size = 0
+    for x, position, records in prepared_chunks(rdf_chunks(inputdata.buffer, kwargs['chunksize'], offset,
+                                                           inputdata.encoding), kwargs['workers']):
+        write_chunk(*x, treepath=kwargs['treepath'])
+        loaded += records
+        processed += records
+        size += position - offset
+        offset = position
+        if resumable:
+            save_checkpoint(checkpoint, source, offset, loaded)
+
+        elapsed = time.perf_counter() - start
+        print('%d records loaded: %.1f records/s, %.2f MB/s' % (loaded, processed / elapsed, size / elapsed / 2 ** 20))
+
+    if kwargs['compact']:
+        for entity in (Molecules, Reactions):
+            TreeIndex.compact(entity, kwargs['treepath'])
+            LSHIndex.compact(entity, kwargs['treepath'])
+
+
+def prepared_chunks(texts, workers=1):
+    """
+    parse RDF text chunks, compute their FEAR strings, CGRs and fingerprints in pool of worker processes.
+    results are returned in input order, so DB content doesn't depend on number of workers.
+    number of chunks in flight is bounded, so file reading waits for slow workers.
+    workers fragment structures in place, so Fragmentor processes aren't started by each of them.
+
+    :param texts: iterable of (RDF text, position, number of records) triples
+    :return: generator of (prepared chunk, position, number of records) triples
+    """
+    if workers <= 1:
+        for text, position, records in texts:
+            yield prepare_text(text), position, records
+        return
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker) as pool:
+        queue = deque()
+        for text, position, records in texts:
+            if profiler.enabled:
+                # stages of workers are sent back with results
+                queue.append((pool.submit(profiled_call, prepare_text, text), position, records))
+            else:
+                queue.append((pool.submit(prepare_text, text), position, records))
+            if len(queue) >= QUEUE_SIZE * workers:
+                x, position, records = queue.popleft()
+                yield _result(x), position, records
+        while queue:
+            x, position, records = queue.popleft()
+            yield _result(x), position, records
+
+
+def _init_worker():
+    fragmentor_mol.workers = fragmentor_rct.workers = 1
+
+
+def _result(future):
+    if profiler.enabled:
+        x, stages = future.result()
+        profiler.merge(stages)
+        return x
+    return future.result()
+
+
+def prepare_text(text):
+    return prepare_chunk(list(RDFread(StringIO(text))))
+
+
+@timed('prepare')
+def prepare_chunk(x):
+    """
+    canonicalize and fingerprint chunk of reactions. molecules repeated in chunk are
+    fingerprinted once.
+
+    :return: list of ReactionRecord and list of unique MoleculeRecord of chunk
+    """
+    memo = {}
+    molecules = []
+    participants = []
+    for role in ('substrats', 'products'):
+        fears = []
         for i in x:
-            for j in i['substrats']:
-                substrats_list.append(j)
-            for u in i['products']:
-                products_list.append(u)
-
-        print(substrats_list)
-        print(products_list)
-
-        substrats_fp = Molecules.get_fingerprints(substrats_list)
-        products_fp = Molecules.get_fingerprints(products_list)
-        reactions_fps = Reactions.get_fingerprints(x)
-
-        with db_session():
-            for i in range(0, len(substrats_list)):
-                substrat_fear = Molecules.get_fear(substrats_list[i])
-                if not Molecules.exists(fear=substrat_fear):
-                    Molecules(substrats_list[i],substrats_fp[i])
-
-            for i in range(0, len(products_list)):
-                product_fear = Molecules.get_fear(products_list[i])
-                if not Molecules.exists(fear=product_fear ):
-                    Molecules(products_list[i], products_fp[i])
-
-            for i in range(0, len(x)):
-                react_fear = Reactions.get_fear(x[i])
-                if not Reactions.exists(fear=react_fear):
-                    Reactions(reaction=x[i],fingerprint=reactions_fps[i])
-
-
-
-
-
-
+            fears.append([])
+            for j in i[role]:
+                molecule_fear = Molecules.get_fear(j)
+                if molecule_fear not in memo:
+                    memo[molecule_fear] = len(molecules)
+                    molecules.append(j)
+                fears[-1].append(molecule_fear)
+        participants.append(fears)
+
+    molecules_fp = Molecules.get_fingerprints(molecules, list(memo)) if molecules else []
+    molecule_records = []
+    for f, m, fp in zip(memo, molecules, molecules_fp):
+        data = node_link_data(m)
+        molecule_records.append(MoleculeRecord(f, data, Molecules.get_packed(data), fp))
+    cgrs = [cgr_core.getCGR(r) for r in x]
+    reaction_fears = [fear.get_cgr_string(cgr) for cgr in cgrs]
+    reactions_fps = Reactions.get_cgr_fingerprints(cgrs, reaction_fears)
+
+    reaction_records = []
+    for reaction_fear, cgr, fp, substrats, products in zip(reaction_fears, cgrs, reactions_fps, *participants):
+        reaction_records.append(ReactionRecord(reaction_fear, node_link_data(cgr), fp,
+                                               [molecule_records[memo[f]] for f in substrats],
+                                               [molecule_records[memo[f]] for f in products]))
+    return reaction_records, molecule_records
+
+
+def write_chunk(reaction_records, molecule_records, treepath='.', bulk=True):
+    """
+    insert chunk into DB and its new entities into similarity indexes. new generation of DB is started
+    with the same transaction, if there are new entities, so cached search results become stale.
+    indexes of both entities are advanced to the new generation.
+    """
+    with db_session(), profiler.stage('sql_insert', len(reaction_records)):
+        if bulk:
+            new_molecules, new_reactions = bulk_insert(reaction_records, molecule_records)
+        else:
+            new_molecules, new_reactions = orm_insert(reaction_records, molecule_records)
+        if not new_molecules[0] and not new_reactions[0]:
+            return
+        bump_generation()
+        generation = get_generation()
+
+    for entity, new in ((Molecules, new_molecules), (Reactions, new_reactions)):
+        TreeIndex.update(entity, *new, generation, dump_path=treepath)
+        LSHIndex.update(entity, *new, dump_path=treepath)
+
+
+def orm_insert(reaction_records, molecule_records):
+    new_molecules = []
+    new_reactions = []
+    for m in molecule_records:
+        if not Molecules.exists(fear=m.fear):
+            new_molecules.append(Molecules(fingerprint=m.fingerprint, fear_string=m.fear, data=m.data,
+                                           packed=m.packed))
+
+    for r in reaction_records:
+        if not Reactions.exists(fear=r.fear):
+            new_reactions.append(Reactions(fingerprint=r.fingerprint, fear_string=r.fear, cgr=r.cgr,
+                                           substrats=r.substrats, products=r.products))
+
+    commit()
+    return ([m.id for m in new_molecules], [m.fingerprint for m in new_molecules]), \
+           ([r.id for r in new_reactions], [r.fingerprint for r in new_reactions])
+
+
+def get_ids(entity, fears):
+    """
+    map FEAR strings to ids of existing entities. raw SQL is used: pony returns cached results of
+    repeated query in db_session, which don't contain rows inserted by bulk_insert.
+    """
+    cursor = db.get_connection().cursor()
+    ids = {}
+    fears = list(fears)
+    for i in range(0, len(fears), MAX_PARAMS):
+        batch = fears[i:i + MAX_PARAMS]
+        cursor.execute('SELECT "%s", "%s" FROM "%s" WHERE "%s" IN (%s)' %
+                       (entity.fear.column, entity.id.column, entity._table_, entity.fear.column,
+                        ', '.join('?' * len(batch))), batch)
+        ids.update(cursor.fetchall())
+    return ids
+
+
+def bulk_insert(reaction_records, molecule_records):
+    """
+    insert only new molecules, reactions and their links with one query per table.
+    """
+    cursor = db.get_connection().cursor()
+
+    molecules = get_ids(Molecules, (m.fear for m in molecule_records))
+    new_molecules = [m for m in molecule_records if m.fear not in molecules]
+    cursor.executemany('INSERT INTO "%s" ("%s", "%s", "%s", "%s") VALUES (?, ?, ?, ?)' %
+                       (Molecules._table_, Molecules.data.column, Molecules.packed.column, Molecules.fear.column,
+                        Molecules.fingerprint.column),
+                       [(json.dumps(m.data), m.packed, m.fear, m.fingerprint.tobytes()) for m in new_molecules])
+    new_ids = get_ids(Molecules, (m.fear for m in new_molecules))
+    molecules.update(new_ids)
+
+    new_reactions = {}
+    reactions = get_ids(Reactions, (r.fear for r in reaction_records))
+    for r in reaction_records:
+        if r.fear not in reactions:
+            new_reactions.setdefault(r.fear, r)
+    new_reactions = list(new_reactions.values())
+    cursor.executemany('INSERT INTO "%s" ("%s", "%s", "%s") VALUES (?, ?, ?)' %
+                       (Reactions._table_, Reactions.fear.column, Reactions.fingerprint.column, Reactions.cgr.column),
+                       [(r.fear, r.fingerprint.tobytes(), None if r.cgr is None else json.dumps(r.cgr))
+                        for r in new_reactions])
+    reactions = get_ids(Reactions, (r.fear for r in new_reactions))
+
+    cursor.executemany('INSERT INTO "%s" ("%s", "%s", "%s", "%s") VALUES (?, ?, ?, ?)' %
+                       (ReactionsMolecules._table_, ReactionsMolecules.molecule.column,
+                        ReactionsMolecules.reaction.column, ReactionsMolecules.product.column,
+                        ReactionsMolecules.mapping.column),
+                       [(molecules[m.fear], reactions[r.fear], is_product, '{}') for r in new_reactions
+                        for is_product, records in ((False, r.substrats), (True, r.products)) for m in records])
+
+    return ([new_ids[m.fear] for m in new_molecules], [m.fingerprint.tobytes() for m in new_molecules]), \
+           ([reactions[r.fear] for r in new_reactions], [r.fingerprint.tobytes() for r in new_reactions])
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+
+from MARS.models import Molecules
+from pony.orm import db_session, select
+
+
+def migrate_core(**kwargs):
+    chunksize = kwargs['chunksize']
+    last = 0
+    packed = 0
+    while True:
+        with db_session():
+            batch = select(m for m in Molecules if m.packed is None and m.id > last).order_by(Molecules.id)[:chunksize]
+            if not batch:
+                break
+            for m in batch:
+                m.packed = Molecules.get_packed(m.data)
+                if m.packed is not None:
+                    packed += 1
+            last = batch[-1].id
+        print('Packed structures of %d molecules' % packed)
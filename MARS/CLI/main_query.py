@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+client of MARS server. imports only standard library, so query costs one round trip.
+
+protocol: client sends one JSON line with command, its options and payload size, then payload
+(SDF or RDF file). server answers by JSON lines: {"data": text} for each searched chunk in input order,
+then {"done": number of chunks} or {"error": message}.
+"""
+import json
+import socket
+import sys
+
+COMMANDS = ('similar_mol', 'similar_react', 'struct_mol')
+OPTIONS = ('number', 'threshold', 'product', 'reagent', 'chunksize')
+
+
+def query_core(**kwargs):
+    payload = kwargs['input'].buffer.read()
+    header = dict((x, kwargs[x]) for x in OPTIONS)
+    header.update(command=kwargs['command'], size=len(payload))
+
+    with connect(kwargs['host'], kwargs['port'], kwargs['socket']) as sock:
+        sock.sendall(json.dumps(header).encode() + b'\n' + payload)
+        outputdata = kwargs['output']
+        for line in sock.makefile('rb'):
+            message = json.loads(line.decode())
+            if 'data' in message:
+                outputdata.write(message['data'])
+                outputdata.flush()
+            elif 'error' in message:
+                print('Server error: %s' % message['error'], file=sys.stderr)
+                sys.exit(1)
+            else:
+                return
+    print('Connection closed by server before search was finished', file=sys.stderr)
+    sys.exit(1)
+
+
+def connect(host, port, socket_path=None):
+    if socket_path:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socket_path)
+        return sock
+    return socket.create_connection((host, port))
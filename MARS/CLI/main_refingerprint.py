@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+from MARS.models import db, Molecules, Reactions, bump_generation
+from MARS.files.TreeIndex import TreeIndex
+from MARS.files.LSHIndex import LSHIndex
+from MARS.files.Profile import profiler
+from MARS.config import FINGERPRINT_SIZES
+from pony.orm import db_session, select
+from os import path
+
+
+def refingerprint_core(**kwargs):
+    """
+    recompute fingerprints of all molecules and reactions with current fingerprint configuration
+    and rebuild all their similarity indexes, which exist. descriptors are taken from Fragmentor cache if possible.
+    reactions are fingerprinted by CGRs stored at ingestion, because links don't keep atoms mapping.
+    """
+    chunksize = kwargs['chunksize']
+    with db_session():
+        missing = Reactions.count_without_cgr()
+    if missing:
+        raise ValueError('%d reactions are loaded without CGR and can not be refingerprinted. reload them' % missing)
+
+    for entity in (Molecules, Reactions):
+        last = 0
+        done = 0
+        while True:
+            with db_session():
+                batch = select((x.id, x.fear) for x in entity if x.id > last).order_by(1)[:chunksize]
+                if not batch:
+                    break
+                ids = [i for i, _ in batch]
+                fears = [f for _, f in batch]
+                if entity is Molecules:
+                    structures = Molecules.get_structures(ids)
+                    fingerprints = Molecules.get_fingerprints([structures[i] for i in ids], fears)
+                else:
+                    cgrs = Reactions.get_cgrs(ids)
+                    fingerprints = Reactions.get_cgr_fingerprints([cgrs[i] for i in ids], fears)
+
+                with profiler.stage('sql_update', len(ids)):
+                    db.get_connection().cursor().executemany(
+                        'UPDATE "%s" SET "%s" = ? WHERE "%s" = ?' % (entity._table_, entity.fingerprint.column,
+                                                                     entity.id.column),
+                        [(fp.tobytes(), i) for fp, i in zip(fingerprints, ids)])
+                bump_generation()
+            last = ids[-1]
+            done += len(ids)
+            print('%s: %d fingerprints of %d bits' % (entity.__name__, done, FINGERPRINT_SIZES[entity.__name__]))
+
+        treepath = kwargs['treepath']
+        with db_session():
+            TreeIndex.rebuild(entity, treepath, kwargs['jobs'])
+            if path.exists(path.join(treepath, '%s.bin' % entity.__name__)):
+                TreeIndex(entity, reindex=True, engine='balltree', dump_path=treepath)
+            if path.exists(path.join(treepath, '%s.lsh.idx' % entity.__name__)):
+                LSHIndex(entity, reindex=True, dump_path=treepath)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+long-running search server. DB mapping and similarity indexes are loaded once by each worker process,
+Fragmentor is started once per worker. see main_query for protocol.
+"""
+import asyncio
+import json
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO, StringIO
+from CGRtools.files.RDFrw import RDFread, RDFwrite
+from CGRtools.files.SDFrw import SDFread, SDFwrite
+from pony.orm import db_session
+from MARS.CLI.main_query import COMMANDS, OPTIONS
+from MARS.CLI.main_similarity_search import write_similar_molecules, write_similar_reactions
+from MARS.CLI.main_structure_search import write_reactions_by_molecules, molecule_role
+from MARS.files.Stream import rdf_chunks, sdf_chunks
+from MARS.files.TreeIndex import TreeIndex
+from MARS.files.RoleIndex import RoleIndex
+from MARS.models import db, init_db, Molecules, Reactions, fragmentor_mol, fragmentor_rct
+
+_indexes = {}
+
+
+def serve_core(**kwargs):
+    with db_session():
+        # indexes are checked and rebuilt once, before workers open them. rebuilt index has jobs shards
+        for entity in (Molecules, Reactions):
+            TreeIndex(entity, reindex=kwargs['rebuild'], engine=kwargs['engine'], dump_path=kwargs['treepath'],
+                      jobs=kwargs['jobs'])
+        RoleIndex(reindex=kwargs['rebuild'], dump_path=kwargs['treepath'])
+    # forked workers must not share SQLite connection of this process
+    db.disconnect()
+
+    pool = ProcessPoolExecutor(kwargs['workers'] or os.cpu_count(), initializer=_init_worker,
+                               initargs=(kwargs['db'], kwargs['engine'], kwargs['treepath'], kwargs['jobs']))
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    async def handle(reader, writer):
+        await handle_query(reader, writer, pool)
+
+    if kwargs['socket']:
+        server = loop.run_until_complete(asyncio.start_unix_server(handle, kwargs['socket']))
+        print('Serving on %s' % kwargs['socket'])
+    else:
+        server = loop.run_until_complete(asyncio.start_server(handle, kwargs['host'], kwargs['port']))
+        print('Serving on %s:%d' % (kwargs['host'], kwargs['port']))
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+        pool.shutdown()
+        if kwargs['socket'] and os.path.exists(kwargs['socket']):
+            os.remove(kwargs['socket'])
+
+
+async def handle_query(reader, writer, pool):
+    """
+    split payload into chunks and search them in pool. results are streamed in input order
+    as soon as chunk is done. chunks of all connections share the pool.
+    """
+    futures = []
+    try:
+        header = json.loads((await reader.readline()).decode())
+        if header.get('command') not in COMMANDS:
+            raise ValueError('unknown command: %s' % header.get('command'))
+        payload = await reader.readexactly(header['size'])
+        options = dict((x, header.get(x)) for x in OPTIONS)
+
+        split = sdf_chunks if header['command'] in ('similar_mol', 'struct_mol') else rdf_chunks
+        loop = asyncio.get_event_loop()
+        futures = [loop.run_in_executor(pool, search_chunk, header['command'], text, options)
+                   for text, _, _ in split(BytesIO(payload), options['chunksize'] or 100)]
+        for future in futures:
+            writer.write(json.dumps(dict(data=await future)).encode() + b'\n')
+            await writer.drain()
+        writer.write(json.dumps(dict(done=len(futures))).encode() + b'\n')
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    except Exception as e:
+        traceback.print_exc()
+        writer.write(json.dumps(dict(error=str(e) or repr(e))).encode() + b'\n')
+    finally:
+        for future in futures:
+            future.cancel()
+        writer.close()
+
+
+def search_chunk(command, text, options):
+    """
+    search structures of SDF or RDF text in worker process.
+
+    :return: found structures as SDF or RDF text
+    """
+    output = StringIO()
+    with db_session():
+        if command == 'similar_mol':
+            write_similar_molecules(_indexes[Molecules], list(SDFread(StringIO(text))), SDFwrite(output), options)
+        elif command == 'similar_react':
+            write_similar_reactions(_indexes[Reactions], list(RDFread(StringIO(text))), RDFwrite(output), options)
+        else:
+            write_reactions_by_molecules(_indexes[RoleIndex], SDFread(StringIO(text)),
+                                         molecule_role(options['product'], options['reagent']), RDFwrite(output))
+    return output.getvalue()
+
+
+def _init_worker(filename, engine, treepath, jobs):
+    # requests are served by pool of workers, each fragments structures in place
+    fragmentor_mol.workers = fragmentor_rct.workers = 1
+    init_db(filename)
+    with db_session():
+        for entity in (Molecules, Reactions):
+            _indexes[entity] = TreeIndex(entity, engine=engine, dump_path=treepath, jobs=jobs)
+        _indexes[RoleIndex] = RoleIndex(dump_path=treepath)
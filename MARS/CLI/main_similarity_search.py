@@ -3,43 +3,129 @@ import traceback
 from CGRtools.files.RDFrw import RDFread, RDFwrite, ReactionContainer
 from CGRtools.files.SDFrw import SDFread, SDFwrite, MoleculeContainer
 from MARS.files.TreeIndex import TreeIndex
-from MARS.models import Reactions, Molecules
+from MARS.files.LSHIndex import LSHIndex, RecallEvaluation
+from MARS.models import Reactions, Molecules, result_cache, get_db_version
+from MARS.files.Profile import profiler
 from pony.orm import db_session
 from networkx.readwrite import json_graph
+from itertools import islice
 
 
 
 
 def similarity_search_reactions_core(**kwargs):
     outputdata = RDFwrite(kwargs['output'])
-    reactions = RDFread(kwargs['input'])
-    num = kwargs['number']
-    rebuild = kwargs['rebuild']
+    reactions = iter(RDFread(kwargs['input']))
+    cache = open_cache(kwargs)
     with db_session():
-        x = TreeIndex(Reactions, reindex=rebuild)
-        for reaction_container in reactions:
-            print(reaction_container)
-            a,b = TreeIndex.get_similar(x, reaction_container, num)
-            print(a)
-            print(b)
-            for i in b:
-                react_cont = i.structure
-                react_cont.__class__ = ReactionContainer
-                outputdata.write(react_cont)
+        x = open_index(Reactions, kwargs)
+        for batch in iter(lambda: list(islice(reactions, kwargs['chunksize'])), []):
+            write_similar_reactions(x, batch, outputdata, kwargs, cache)
+        if isinstance(x, RecallEvaluation):
+            print(x.report(), file=sys.stderr)
+    if cache is not None:
+        print(cache.report(), file=sys.stderr)
+
 
 def similarity_search_molecules_core(**kwargs):
-    molecules = SDFread(kwargs['input'])
+    molecules = iter(SDFread(kwargs['input']))
     outputdata = SDFwrite(kwargs['output'])
-    num = kwargs['number']
-    rebuild = kwargs['rebuild']
+    cache = open_cache(kwargs)
     with db_session():
-        x = TreeIndex(Molecules, reindex=rebuild)
-        for molecule_container in molecules:
-            a,b = TreeIndex.get_similar(x, molecule_container,num)
-            print(a)
-            print(b)
-            for i in b:
-                mol_cont = json_graph.node_link_graph(i.data)
-                mol_cont.__class__ = MoleculeContainer
-                outputdata.write(mol_cont)
+        x = open_index(Molecules, kwargs)
+        for batch in iter(lambda: list(islice(molecules, kwargs['chunksize'])), []):
+            write_similar_molecules(x, batch, outputdata, kwargs, cache)
+        if isinstance(x, RecallEvaluation):
+            print(x.report(), file=sys.stderr)
+    if cache is not None:
+        print(cache.report(), file=sys.stderr)
+
+
+def open_cache(kwargs):
+    """
+    result cache of DB. it's not used by recall evaluation, which must run both searches
+    """
+    return None if kwargs['no_cache'] or kwargs['evaluate'] else result_cache
+
+
+def open_index(data, kwargs):
+    """
+    exact index or approximate LSH index. with evaluate option both are opened and compared
+    """
+    if not kwargs['approximate']:
+        return TreeIndex(data, reindex=kwargs['rebuild'], engine=kwargs['engine'], dump_path=kwargs['treepath'],
+                         jobs=kwargs['jobs'])
+
+    x = LSHIndex(data, reindex=kwargs['rebuild'], dump_path=kwargs['treepath'], bands=kwargs['bands'],
+                 rows=kwargs['band_rows'])
+    if kwargs['evaluate']:
+        return RecallEvaluation(data, x, TreeIndex(data, reindex=kwargs['rebuild'], engine=kwargs['engine'],
+                                                   dump_path=kwargs['treepath'], jobs=kwargs['jobs']))
+    return x
+
+
+def write_similar_reactions(index, reactions, outputdata, kwargs, cache=None):
+    hits, scores = search(index, reactions, kwargs, cache, Reactions)
+    for react_cont, score in zip(Reactions.get_structures(hits), scores):
+        react_cont.meta['tanimoto'] = score
+        outputdata.write(react_cont)
+
+
+def write_similar_molecules(index, molecules, outputdata, kwargs, cache=None):
+    hits, scores = search(index, molecules, kwargs, cache, Molecules)
+    structures = Molecules.get_structures(hits)
+    for i, score in zip(hits, scores):
+        mol_cont = structures[i].copy()
+        mol_cont.meta['tanimoto'] = score
+        outputdata.write(mol_cont)
+
+
+def search(index, structures, kwargs, cache=None, data=None):
+    """
+    top-k or threshold search for batch of structures. with cache, results are looked up by FEAR strings
+    of structures and only missed structures are searched in index.
+
+    :param data: entity of structures. required with cache
+    :return: ids of hits and their Tanimoto similarities in output order
+    """
+    if cache is None:
+        results = index_search(index, structures, kwargs)
+    else:
+        command = 'similar_%s' % data.__name__
+        parameters = '%s %s' % (index.version, 'threshold=%s' % kwargs['threshold']
+                                if kwargs['threshold'] is not None else 'number=%d' % kwargs['number'])
+        db_version = get_db_version()
+        fears = [data.get_fear(x) for x in structures]
+        with profiler.stage('result_cache', len(fears)):
+            cached = cache.get_many(command, fears, parameters, db_version)
+        missing = {}
+        for s, f in zip(structures, fears):
+            if f not in cached and f not in missing:
+                missing[f] = s
+
+        if missing:
+            new = [(f, ids, scores) for f, (ids, scores) in
+                   zip(missing, index_search(index, list(missing.values()), kwargs, list(missing)))]
+            with profiler.stage('result_cache', len(new)):
+                cache.put_many(command, new, parameters, db_version)
+            cached.update((f, (ids, scores)) for f, ids, scores in new)
+        results = [cached[f] for f in fears]
+
+    hits = []
+    scores = []
+    for ids, similarities in results:
+        hits.extend(ids)
+        scores.extend(similarities)
+    return hits, scores
+
 
+def index_search(index, structures, kwargs, fears=None):
+    """
+    :param fears: FEAR strings of structures if already known
+    :return: list of (ids of hits, Tanimoto similarities) pairs of structures
+    """
+    if kwargs['threshold'] is not None:
+        results = index.get_within_batch(structures, kwargs['threshold'], fears)
+    else:
+        results = index.get_similar_batch(structures, kwargs['number'], fears)
+    return [([i.id for i in entities], [round(float(1 - d), 4) for d in dist]) for dist, entities in results]
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import time
+import numpy as np
+from MARS.config import FINGERPRINT_SIZES
+from MARS.models import db, Molecules, Reactions, ReactionsMolecules, result_cache, bump_generation
+from MARS.files.TreeIndex import TreeIndex
+from MARS.files.Snapshot import SnapshotWriter, SnapshotFormatError, read_snapshot
+from MARS.files.Profile import profiler
+from pony.orm import db_session
+
+# exported attributes of entities in insertion order. fingerprints are stored as uint8 matrices
+TABLES = ((Molecules, ('id', 'fingerprint', 'fear', 'data', 'packed')),
+          (Reactions, ('id', 'fingerprint', 'fear', 'cgr')),
+          (ReactionsMolecules, ('id', 'molecule', 'reaction', 'product', 'mapping')))
+ARRAYS = {'id': np.int64, 'molecule': np.int64, 'reaction': np.int64, 'product': np.uint8}
+
+
+def export_core(**kwargs):
+    """
+    dump DB tables into columnar snapshot. rows are read by raw SQL in id order, chunk by chunk.
+    """
+    start = time.perf_counter()
+    with db_session(), SnapshotWriter(kwargs['output']) as snapshot:
+        cursor = db.get_connection().cursor()
+        for entity, attributes in TABLES:
+            columns = [getattr(entity, x).column for x in attributes]
+            last = 0
+            done = 0
+            while True:
+                with profiler.stage('sql_select'):
+                    cursor.execute('SELECT %s FROM "%s" WHERE "%s" > ? ORDER BY "%s" LIMIT ?' %
+                                   (', '.join('"%s"' % x for x in columns), entity._table_, entity.id.column,
+                                    entity.id.column), (last, kwargs['chunksize']))
+                    rows = cursor.fetchall()
+                if not rows:
+                    break
+                with profiler.stage('snapshot_write', len(rows)):
+                    snapshot.write(entity.__name__, [(c, encode(entity, a, x))
+                                                     for a, c, x in zip(attributes, columns, zip(*rows))])
+                last = rows[-1][0]
+                done += len(rows)
+            print('%s: %d rows exported' % (entity.__name__, done))
+    print('Snapshot is written to %s in %.1fs' % (kwargs['output'], time.perf_counter() - start))
+
+
+def encode(entity, attribute, values):
+    if attribute == 'fingerprint':
+        if len(set(len(x) for x in values)) > 1:
+            raise ValueError('%s fingerprints in DB have different lengths. run refingerprint' % entity.__name__)
+        return np.frombuffer(b''.join(values), dtype=np.uint8).reshape(len(values), -1)
+    if attribute in ARRAYS:
+        return np.array(values, dtype=ARRAYS[attribute])
+    return list(values)
+
+
+def decode(values):
+    if isinstance(values, np.ndarray):
+        return [x.tobytes() for x in values] if values.ndim == 2 else values.tolist()
+    return values
+
+
+def import_core(**kwargs):
+    """
+    load snapshot into empty DB. rows are inserted by raw SQL in one transaction, so failed import
+    leaves DB empty. similarity indexes are built from fingerprints of snapshot without reading DB.
+    """
+    start = time.perf_counter()
+    entities = {entity.__name__: (entity, {getattr(entity, x).column for x in attributes})
+                for entity, attributes in TABLES}
+    fingerprints = {Molecules: ([], []), Reactions: ([], [])}
+    done = dict.fromkeys(entities, 0)
+    with db_session():
+        cursor = db.get_connection().cursor()
+        for entity, _ in entities.values():
+            cursor.execute('SELECT COUNT(*) FROM "%s"' % entity._table_)
+            rows, = cursor.fetchone()
+            if rows:
+                raise ValueError('import requires empty database: %s contains %d rows' % (entity.__name__, rows))
+
+        for table, columns in read_snapshot(kwargs['input']):
+            if table not in entities:
+                raise SnapshotFormatError('unknown table: %s' % table)
+            entity, known = entities[table]
+            names = [n for n, _ in columns]
+            if not known.issuperset(names):
+                raise SnapshotFormatError('unknown columns of %s: %s' % (table, ', '.join(set(names) - known)))
+
+            values = [decode(x) for _, x in columns]
+            with profiler.stage('sql_insert', len(values[0])):
+                cursor.executemany('INSERT INTO "%s" (%s) VALUES (%s)' %
+                                   (entity._table_, ', '.join('"%s"' % x for x in names),
+                                    ', '.join('?' * len(names))), zip(*values))
+            if entity in fingerprints:
+                data = dict(columns)
+                fingerprints[entity][0].append(data[entity.id.column])
+                fingerprints[entity][1].append(data[entity.fingerprint.column])
+            done[table] += len(values[0])
+        bump_generation()
+
+    result_cache.clear()
+    print(', '.join('%s: %d rows' % x for x in done.items()) + ' imported')
+    for entity, (ids, fps) in fingerprints.items():
+        size = FINGERPRINT_SIZES[entity.__name__]
+        ids = np.concatenate(ids) if ids else np.empty(0, dtype=np.int64)
+        fps = np.concatenate(fps) if fps else np.empty((0, size // 8), dtype=np.uint8)
+        if fps.shape[1] * 8 != size:
+            print('%s index is not built: snapshot fingerprints have %d bits, configured %d. run refingerprint' %
+                  (entity.__name__, fps.shape[1] * 8, size))
+            continue
+        with db_session():
+            TreeIndex.build(entity, ids, fps, kwargs['treepath'], kwargs['jobs'])
+    print('Snapshot %s is imported in %.1fs' % (kwargs['input'], time.perf_counter() - start))
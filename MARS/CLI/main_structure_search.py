@@ -3,48 +3,129 @@ import traceback
 from CGRtools.files.RDFrw import RDFread, RDFwrite, ReactionContainer
 from CGRtools.files.SDFrw import SDFread, SDFwrite, MoleculeContainer
 from MARS.files.TreeIndex import TreeIndex
-from MARS.models import Reactions, Molecules
-from pony.orm import db_session
+from CGRtools.CGRreactor import CGRreactor
+from MARS.files.Substructure import reaction_center
+from MARS.files.RoleIndex import RoleIndex
+from MARS.models import Reactions, Molecules, cgr_core, result_cache, get_db_version, MAX_PARAMS
+from MARS.files.Profile import profiler
+from pony.orm import db_session, select
 from networkx.readwrite import json_graph
+from itertools import islice
 
 
 def structure_reaction_search_core(**kwargs):
     inputdata = RDFread(kwargs['input'])
     outputdata = RDFwrite(kwargs['output'])
     search_type = kwargs['enclosure']
-    if search_type == False:
-        print("We are going to use simple hash-search now:")
-    else:
-        print("We are going to use advanced enclosure-search now:")
+    with db_session():
+        if search_type == False:
+            print("We are going to use simple hash-search now:")
+            it = iter(inputdata)
+            for batch in iter(lambda: list(islice(it, kwargs['chunksize'])), []):
+                for react_cont in Reactions.get_structures(exact_reaction_search(batch)):
+                    outputdata.write(react_cont)
+        else:
+            print("We are going to use advanced enclosure-search now:")
+            missing = Reactions.count_without_cgr()
+            if missing:
+                print('%d reactions were loaded without CGR and are skipped. reload them into new DB by dbfill'
+                      % missing, file=sys.stderr)
+            x = TreeIndex(Reactions, reindex=kwargs['rebuild'], dump_path=kwargs['treepath'])
+            for reaction_container in inputdata:
+                for react_cont in enclosure_reaction_search(x, reaction_container):
+                    outputdata.write(react_cont)
+
+
+def exact_reaction_search(reactions):
+    """
+    find reactions stored in DB by CGR FEAR strings. one query per MAX_PARAMS reactions.
+    ids of found reactions are returned in input order.
+    """
+    fears = [Reactions.get_fear(x) for x in reactions]
+    found = {}
+    with profiler.stage('sql_lookup', len(fears)):
+        for i in range(0, len(fears), MAX_PARAMS):
+            batch = fears[i:i + MAX_PARAMS]
+            found.update(select((r.fear, r.id) for r in Reactions if r.fear in batch))
+    return [found[x] for x in fears if x in found]
 
 
-  #  worker = ?
+def enclosure_reaction_search(index, reaction):
+    """
+    find reactions, CGR of which contains reaction center of given reaction. center is matched
+    against CGRs stored at ingestion: reactions rebuilt from DB have no atoms mapping.
+    candidates are screened by fingerprint of the same center, so screen and match agree on what
+    is enclosed. as in substructure search, descriptors of center are expected in CGRs containing it.
+    reaction without center is rejected: its empty screen would pass every reaction in DB.
+
+    :return: generator of found ReactionContainers
+    """
+    center = reaction_center(cgr_core.getCGR(reaction))
+    if not len(center):
+        print('Reaction has no reaction center: it changes no bonds or charges. it is skipped', file=sys.stderr)
+        return
+    cgrr = CGRreactor()
+    candidates = index.get_containing_fingerprint(Reactions.get_cgr_fingerprints([center])[0])
+    for start in range(0, len(candidates), MAX_PARAMS):
+        batch = candidates[start:start + MAX_PARAMS]
+        cgrs = Reactions.get_cgrs(batch)
+        found = [i for i in batch if i in cgrs and cgrr.spgraphmatcher(cgrs[i], center).subgraph_is_isomorphic()]
+        for react_cont in Reactions.get_structures(found):
+            yield react_cont
+
 
 def structure_molecule_search_core(**kwargs):
     molecules = SDFread(kwargs['input'])
     outputdata = RDFwrite(kwargs['output'])
-    product = kwargs['product']
-    if kwargs['product'] == False and kwargs['reagent'] == False:
-        product = None
-    elif kwargs['product'] == True and kwargs['reagent'] == True:
-        print('No,No,No')
-    elif kwargs['product'] == True:
-        product = True
-    elif kwargs['reagent'] == True:
-        product = False
+    product = molecule_role(kwargs['product'], kwargs['reagent'])
     with db_session():
-        for molecule in molecules:
-            required_reacts = Reactions.get_reactions_by_molecule(molecule,product)
-            print(required_reacts)
-            for reaction in required_reacts:
-                react_cont = reaction.structure
-                print(react_cont)
+        index = RoleIndex(reindex=kwargs['rebuild'], dump_path=kwargs['treepath'])
+        if kwargs['intersect'] or kwargs['with_products']:
+            roles = dict(reagents=[], products=[], molecules=[])
+            roles[{None: 'molecules', True: 'products', False: 'reagents'}[product]].extend(
+                Molecules.get_fear(x) for x in molecules)
+            if kwargs['with_products']:
+                roles['products'].extend(Molecules.get_fear(x) for x in SDFread(kwargs['with_products']))
+            for react_cont in Reactions.get_structures(index.search(**roles)):
                 outputdata.write(react_cont)
+        else:
+            cache = None if kwargs['no_cache'] else result_cache
+            write_reactions_by_molecules(index, molecules, product, outputdata, cache)
+            if cache is not None:
+                print(cache.report(), file=sys.stderr)
 
 
+def molecule_role(product, reagent):
+    """
+    :return: True for products, False for reagents and None for any role
+    """
+    if product and reagent:
+        print('No,No,No')
+    if product:
+        return True
+    if reagent:
+        return False
+    return None
 
 
-
-
-
-
+def write_reactions_by_molecules(index, molecules, product, outputdata, cache=None):
+    """
+    write reactions of each molecule. with cache, ids of reactions are looked up by FEAR strings first
+    """
+    role = {None: 'any', True: 'product', False: 'reagent'}[product]
+    db_version = None if cache is None else get_db_version()
+    for molecule in molecules:
+        molecule_fear = Molecules.get_fear(molecule)
+        if cache is None:
+            ids = index.get_reactions(molecule_fear, product)
+        else:
+            with profiler.stage('result_cache'):
+                cached = cache.get_many('struct_mol', [molecule_fear], role, db_version)
+            if cached:
+                ids, _ = cached[molecule_fear]
+            else:
+                ids = index.get_reactions(molecule_fear, product).tolist()
+                with profiler.stage('result_cache'):
+                    cache.put_many('struct_mol', [(molecule_fear, ids, [])], role, db_version)
+        for react_cont in Reactions.get_structures(ids):
+            outputdata.write(react_cont)
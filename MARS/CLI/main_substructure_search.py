@@ -1,10 +1,62 @@
 import sys
+import time
 import traceback
-from CGRtools.files.RDFrw import RDFread, RDFwrite
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from CGRtools.files.SDFrw import SDFread
+from MARS.files.TreeIndex import TreeIndex
+from MARS.files.Substructure import match_batch
+from MARS.models import Molecules
+from pony.orm import db_session, select
+
+BATCH_SIZE = 100
+QUEUE_SIZE = 2
 
 
 def substructure_search_core(**kwargs):
-    inputdata = RDFread(kwargs['input'])
-    outputdata = RDFwrite(kwargs['output'], extralabels=kwargs['save_extralabels'])
+    molecules = SDFread(kwargs['input'])
+    outputdata = kwargs['output']
+    workers = kwargs['workers']
+
+    with db_session():
+        x = TreeIndex(Molecules, reindex=kwargs['rebuild'], dump_path=kwargs['treepath'])
+        with ProcessPoolExecutor(workers) as pool:
+            for n, query in enumerate(molecules):
+                start = time.perf_counter()
+                candidates = x.get_containing(query)
+                screen_time = time.perf_counter() - start
+
+                start = time.perf_counter()
+                found = 0
+                for ids in matched(pool, query, candidates, workers):
+                    for i in ids:
+                        outputdata.write('%d\t%d\n' % (n, i))
+                    outputdata.flush()
+                    found += len(ids)
+                match_time = time.perf_counter() - start
+
+                print('query %d: %d of %d molecules passed screening (%.2f%%), %d matched. '
+                      'screening: %.3fs, isomorphism: %.3fs' %
+                      (n, len(candidates), x.size, len(candidates) / max(x.size, 1) * 100, found,
+                       screen_time, match_time))
+
 
-  #  worker = ?
\ No newline at end of file
+def matched(pool, query, candidates, workers):
+    """
+    check candidates by graph isomorphism in pool. found ids are yielded by batches in candidates order.
+    structures are loaded from DB by batches, number of batches in flight is bounded.
+    """
+    check = partial(match_batch, query)
+    queue = deque()
+    for start in range(0, len(candidates), BATCH_SIZE):
+        batch = [int(i) for i in candidates[start:start + BATCH_SIZE]]
+        data = dict(select((m.id, m.packed) for m in Molecules if m.id in batch))
+        unpacked = [i for i in batch if data[i] is None]
+        if unpacked:
+            data.update(select((m.id, m.data) for m in Molecules if m.id in unpacked))
+        queue.append(pool.submit(check, [(i, data[i]) for i in batch]))
+        if len(queue) >= QUEUE_SIZE * workers:
+            yield queue.popleft().result()
+    while queue:
+        yield queue.popleft().result()
@@ -1,3 +1,23 @@
+from os import cpu_count
+
 ACTIVE_BITS = 2
 BITSTRING_SIZE = 0
-bs_slice = BITSTRING_SIZE+6
\ No newline at end of file
+bs_slice = BITSTRING_SIZE+6
+STRUCTURE_CACHE_SIZE = 10000
+DESCRIPTOR_CACHE_SIZE = 1000000
+# max number of search results kept in result cache of DB
+RESULT_CACHE_SIZE = 100000
+# long-lived Fragmentor processes, between which big lists of structures are split. 1 fragments in place
+FRAGMENTOR_WORKERS = max(cpu_count() or 1, 2)
+# full fingerprint length in bits of each entity: power of 2, ACTIVE_BITS * log2(length) <= 128.
+# DB fingerprints must be regenerated by refingerprint subcommand after change
+FINGERPRINT_SIZES = {'Molecules': 2 ** bs_slice, 'Reactions': 2 ** bs_slice}
+# lengths of OR-folded fingerprints kept in index for cascade screening. only lengths less than full are used
+FOLDED_SIZES = (64, 256)
+# MinHash LSH tables of approximate similarity search: number of bands and signature values per band.
+# more bands give better recall and more candidates, longer bands give less candidates and worse recall
+LSH_BANDS = 32
+LSH_ROWS = 4
+# SQLite DB file. relative path is resolved against MARS package directory
+DB_PATH = 'datatest.db'
+SQL_DEBUG = False
@@ -0,0 +1,151 @@
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from .Profile import profiler, timed
+
+# max number of values in one IN (...) query. SQLite limits number of parameters
+MAX_PARAMS = 900
+
+
+class LRUCache(object):
+    """
+    dict-like cache, which keeps at most maxsize recently used items
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.__data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            self.__data.move_to_end(key)
+        except KeyError:
+            return default
+        return self.__data[key]
+
+    def put(self, key, value):
+        self.__data[key] = value
+        self.__data.move_to_end(key)
+        while len(self.__data) > self.maxsize:
+            self.__data.popitem(last=False)
+
+    def clear(self):
+        self.__data.clear()
+
+    def __len__(self):
+        return len(self.__data)
+
+
+class LazyObject(object):
+    """
+    proxy of object, which is created by factory on first attribute access
+
+    :param stages: dict of method name: profiler stage name. calls of these methods are timed
+    """
+    def __init__(self, factory, stages=None):
+        self.__factory = factory
+        self.__object = None
+        self.__stages = stages or {}
+
+    def __getattr__(self, name):
+        if self.__object is None:
+            self.__object = self.__factory()
+        if profiler.enabled and name in self.__stages:
+            return timed(self.__stages[name])(getattr(self.__object, name))
+        return getattr(self.__object, name)
+
+
+class ResultCache(object):
+    """
+    on-disk cache of search results keyed by command, FEAR string of query and search parameters.
+    results are valid for one version of DB (identity and generation): results of other versions
+    are never returned and are dropped when new version is seen. keeps at most maxsize results, least recently
+    used are evicted. connection is reopened in forked processes.
+
+    :param file_path: SQLite file. it's set by init_db, if cache is created before DB is bound
+    """
+    def __init__(self, file_path, maxsize):
+        self.file_path = file_path
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.__con = None
+        self.__pid = None
+        self.__version = None
+
+    @property
+    def __connection(self):
+        if self.__pid != os.getpid():
+            self.__con = con = sqlite3.connect(self.file_path, timeout=60)
+            with con:
+                columns = [x[1] for x in con.execute('PRAGMA table_info(results)')]
+                if columns and 'version' not in columns:
+                    # results of old format are keyed by generation only
+                    con.execute('DROP TABLE results')
+                con.execute('CREATE TABLE IF NOT EXISTS results (command TEXT, parameters TEXT, fear TEXT, '
+                            'version TEXT, ids TEXT, scores TEXT, used REAL, '
+                            'PRIMARY KEY (command, parameters, fear))')
+                con.execute('CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+            self.__pid = os.getpid()
+            self.__version = None
+        return self.__con
+
+    def __expire(self, con, version):
+        if self.__version != version:
+            with con:
+                con.execute('DELETE FROM results WHERE version != ?', (version,))
+            self.__version = version
+
+    def get_many(self, command, fears, parameters, version):
+        """
+        :param parameters: string of search parameters and index version
+        :param version: current version of DB as returned by get_db_version
+        :return: dict of FEAR: (ids, scores) for cached FEARs
+        """
+        con = self.__connection
+        self.__expire(con, version)
+        unique = list(set(fears))
+        result = {}
+        with con:
+            for start in range(0, len(unique), MAX_PARAMS):
+                batch = unique[start:start + MAX_PARAMS]
+                marks = ', '.join('?' * len(batch))
+                result.update((f, (json.loads(i), json.loads(s))) for f, i, s in
+                              con.execute('SELECT fear, ids, scores FROM results WHERE command = ? AND '
+                                          'parameters = ? AND version = ? AND fear IN (%s)' % marks,
+                                          [command, parameters, version] + batch))
+                con.execute('UPDATE results SET used = ? WHERE command = ? AND parameters = ? AND fear IN (%s)'
+                            % marks, [time.time(), command, parameters] + batch)
+        hits = sum(f in result for f in fears)
+        self.hits += hits
+        self.misses += len(fears) - hits
+        profiler.count('result_cache_hits', hits)
+        profiler.count('result_cache_misses', len(fears) - hits)
+        return result
+
+    def put_many(self, command, items, parameters, version):
+        """
+        :param items: list of (FEAR, ids, scores) triples
+        """
+        con = self.__connection
+        now = time.time()
+        with con:
+            con.executemany('INSERT OR REPLACE INTO results (command, parameters, fear, version, ids, scores, '
+                            'used) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            [(command, parameters, f, version, json.dumps(i), json.dumps(s), now)
+                             for f, i, s in items])
+            size, = con.execute('SELECT COUNT(*) FROM results').fetchone()
+            if size > self.maxsize:
+                con.execute('DELETE FROM results WHERE rowid IN (SELECT rowid FROM results ORDER BY used LIMIT ?)',
+                            (size - self.maxsize,))
+
+    def clear(self):
+        con = self.__connection
+        with con:
+            con.execute('DELETE FROM results')
+
+    def report(self):
+        queries = self.hits + self.misses
+        return 'Result cache: %d hits of %d queries (%.1f%%)' % (self.hits, queries,
+                                                                  self.hits / queries * 100 if queries else 0.)
@@ -0,0 +1,170 @@
+import json
+import os
+import sqlite3
+import time
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from .Profile import profiler
+
+MAX_PARAMS = 900
+POOL_THRESHOLD = 100
+# number of cache hits, use times of which are kept in memory before they are written
+TOUCH_BATCH = 10000
+# share of maxsize kept by eviction, so it isn't run on every put into full cache
+EVICT_RATIO = .9
+
+
+class DescriptorCache(object):
+    """
+    on-disk cache of sparse descriptors vectors keyed by FEAR string. keeps at most maxsize
+    vectors, least recently used are evicted. connection is reopened in forked processes.
+
+    lookups don't write: use times are collected in memory and written by the next put or after
+    TOUCH_BATCH lookups, so worker processes seldom wait for SQLite write lock. number of rows is
+    counted once per connection and then tracked, it's recounted only before eviction.
+
+    :param file_path: SQLite file. it's set by init_db next to DB file, cache is disabled until then
+    """
+    def __init__(self, file_path, maxsize):
+        self.file_path = file_path
+        self.maxsize = maxsize
+        self.__con = None
+        self.__pid = None
+        self.__size = 0
+        self.__touched = {}
+
+    @property
+    def __connection(self):
+        if self.__pid != os.getpid():
+            self.__con = sqlite3.connect(self.file_path, timeout=60)
+            self.__con.execute('CREATE TABLE IF NOT EXISTS descriptors (fear TEXT PRIMARY KEY, data TEXT, used REAL)')
+            self.__con.execute('CREATE INDEX IF NOT EXISTS descriptors_used ON descriptors (used)')
+            self.__size, = self.__con.execute('SELECT COUNT(*) FROM descriptors').fetchone()
+            self.__touched = {}
+            self.__pid = os.getpid()
+        return self.__con
+
+    def get_many(self, fears):
+        """
+        :return: dict of FEAR: {descriptor: value} for cached FEARs
+        """
+        if self.file_path is None:
+            return {}
+        con = self.__connection
+        fears = list(set(fears))
+        result = {}
+        for start in range(0, len(fears), MAX_PARAMS):
+            batch = fears[start:start + MAX_PARAMS]
+            result.update((f, json.loads(d)) for f, d in
+                          con.execute('SELECT fear, data FROM descriptors WHERE fear IN (%s)' %
+                                      ', '.join('?' * len(batch)), batch))
+        now = time.time()
+        self.__touched.update((f, now) for f in result)
+        if len(self.__touched) >= TOUCH_BATCH:
+            with con:
+                self.__flush(con)
+        return result
+
+    def put_many(self, items):
+        """
+        :param items: list of (FEAR, {descriptor: value}) pairs
+        """
+        if self.file_path is None:
+            return
+        con = self.__connection
+        now = time.time()
+        with con:
+            self.__flush(con)
+            changes = con.total_changes
+            con.executemany('INSERT OR IGNORE INTO descriptors (fear, data, used) VALUES (?, ?, ?)',
+                            [(f, json.dumps(d), now) for f, d in items])
+            self.__size += con.total_changes - changes
+            if self.__size > self.maxsize:
+                # other processes add and evict rows too
+                self.__size, = con.execute('SELECT COUNT(*) FROM descriptors').fetchone()
+                if self.__size > self.maxsize:
+                    keep = int(self.maxsize * EVICT_RATIO)
+                    con.execute('DELETE FROM descriptors WHERE fear IN '
+                                '(SELECT fear FROM descriptors ORDER BY used LIMIT ?)', (self.__size - keep,))
+                    self.__size = keep
+
+    def __flush(self, con):
+        if self.__touched:
+            con.executemany('UPDATE descriptors SET used = ? WHERE fear = ?',
+                            [(t, f) for f, t in self.__touched.items()])
+            self.__touched.clear()
+
+
+class FragmentorService(object):
+    """
+    Fragmentor front-end. structures with known FEAR strings are taken from descriptors cache,
+    others are fragmented in place or, for big lists, split between long-lived worker processes.
+    each worker keeps its own Fragmentor, so its setup is paid once per process.
+    workers are started on first big list. processes, which are workers of other pools, set workers to 1.
+    """
+    def __init__(self, fragmentor_class, cache=None, workers=0, **kwargs):
+        self.__fragmentor_class = fragmentor_class
+        self.__kwargs = kwargs
+        self.__cache = cache
+        self.workers = workers
+        self.__fragmentor = None
+        self.__pool = None
+        self.__pool_pid = None
+
+    def get(self, structures, fears=None):
+        """
+        descriptors of structures.
+
+        :param fears: FEAR strings of structures. cache is used only if they are given
+        :return: DataFrame with row per structure
+        """
+        if self.__cache is None or fears is None:
+            return self.__fragment(structures)
+
+        with profiler.stage('descriptors_cache', len(fears)):
+            cached = self.__cache.get_many(fears)
+        missing = {}
+        for s, f in zip(structures, fears):
+            if f not in cached and f not in missing:
+                missing[f] = s
+        profiler.count('descriptors_cache_hits', len(cached))
+        profiler.count('descriptors_cache_misses', len(missing))
+
+        if missing:
+            frame = self.__fragment(list(missing.values()))
+            new = [(f, {k: v.item() if hasattr(v, 'item') else v for k, v in row.items() if v})
+                   for f, row in zip(missing, frame.to_dict('records'))]
+            with profiler.stage('descriptors_cache', len(new)):
+                self.__cache.put_many(new)
+            cached.update(new)
+
+        return pd.DataFrame([cached[f] for f in fears], index=range(len(fears))).fillna(0)
+
+    def __fragment(self, structures):
+        if not structures:
+            return pd.DataFrame(index=range(0))
+        with profiler.stage('fragmentor', len(structures)):
+            if self.workers > 1 and len(structures) >= POOL_THRESHOLD:
+                if self.__pool_pid != os.getpid():
+                    self.__pool = ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                                      initargs=(self.__fragmentor_class, self.__kwargs))
+                    self.__pool_pid = os.getpid()
+                step = -(-len(structures) // self.workers)
+                parts = self.__pool.map(_fragment, [structures[x:x + step] for x in range(0, len(structures), step)])
+                return pd.concat(parts, ignore_index=True).fillna(0)
+
+            if self.__fragmentor is None:
+                self.__fragmentor = self.__fragmentor_class(**self.__kwargs)
+            return self.__fragmentor.get(structures)['X']
+
+
+_worker_fragmentor = None
+
+
+def _init_worker(fragmentor_class, kwargs):
+    global _worker_fragmentor
+    _worker_fragmentor = fragmentor_class(**kwargs)
+
+
+def _fragment(structures):
+    return _worker_fragmentor.get(structures)['X']
@@ -0,0 +1,410 @@
+import json
+import numpy as np
+import os
+import struct
+import tempfile
+from MARS.files.Zulfia import fold
+
+MAGIC = b'MARSIDX\0'
+DELTA_MAGIC = b'MARSDLT\0'
+ROLES_MAGIC = b'MARSROL\0'
+LSH_MAGIC = b'MARSLSH\0'
+VERSION = 3
+ROLES_VERSION = 3
+LSH_VERSION = 2
+HEADER = struct.Struct('<8sIIQQ')
+# sizes in bits of folded fingerprints stored in index file. unused are zero
+MAX_FOLDS = 4
+FOLDS = struct.Struct('<%dI' % MAX_FOLDS)
+ROLES_HEADER = struct.Struct('<8sIQQQQ16s')
+LSH_HEADER = struct.Struct('<8sIIIIIQQ16s')
+HEADER_SIZE = 64
+
+
+class IndexFormatError(Exception):
+    pass
+
+
+class FingerprintIndex(object):
+    """
+    read-only view of index file. all columns are memory-mapped, so opening is cheap and
+    pages are shared between processes.
+
+    layout: 64 bytes header (magic, version, words per row, rows, max id, sizes of folded fingerprints),
+    then uint64 fingerprints matrix, uint64 folded fingerprints matrices, int64 ids and int32 popcounts.
+    every column is 8 bytes aligned. rows are sorted by popcount and id.
+    """
+    def __init__(self, file_path):
+        with open(file_path, 'rb') as f:
+            head = f.read(HEADER_SIZE)
+        if len(head) < HEADER_SIZE:
+            raise IndexFormatError('truncated header: %s' % file_path)
+
+        magic, version, words, rows, max_id = HEADER.unpack_from(head)
+        if magic != MAGIC:
+            raise IndexFormatError('not an index file: %s' % file_path)
+        if version != VERSION:
+            raise IndexFormatError('unsupported index version %d: %s' % (version, file_path))
+
+        folds = [x for x in FOLDS.unpack_from(head, HEADER.size) if x]
+        fingerprints, folded, ids, counts, end = column_offsets(rows, words, folds)
+        if os.path.getsize(file_path) < end:
+            raise IndexFormatError('truncated index: %s' % file_path)
+
+        self.size = rows
+        self.max_id = max_id
+        self.fingerprints = self.__map(file_path, np.uint64, (rows, words), fingerprints)
+        self.folded = [(x, self.__map(file_path, np.uint64, (rows, x // 64), o)) for x, o in zip(folds, folded)]
+        self.ids = self.__map(file_path, np.int64, (rows,), ids)
+        self.counts = self.__map(file_path, np.int32, (rows,), counts)
+
+    @staticmethod
+    def __map(file_path, dtype, shape, offset):
+        if not shape[0]:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(file_path, dtype=dtype, mode='r', shape=shape, offset=offset)
+
+
+class DeltaIndex(object):
+    """
+    append-only segment of entities added after index file was built.
+
+    layout: 64 bytes header (magic, version, words per row, rows, generation of DB) and array of records
+    (id, popcount, fingerprint). records after header's rows count are not committed yet.
+    generation is the one of the last update: index with delta is current up to it.
+    folded fingerprints are not stored, they are computed on opening.
+    """
+    def __init__(self, file_path, min_id=0, folds=()):
+        with open(file_path, 'rb') as f:
+            head = f.read(HEADER_SIZE)
+        if len(head) < HEADER_SIZE:
+            raise IndexFormatError('truncated header: %s' % file_path)
+
+        magic, version, words, rows, generation = HEADER.unpack_from(head)
+        if magic != DELTA_MAGIC:
+            raise IndexFormatError('not a delta file: %s' % file_path)
+        if version != VERSION:
+            raise IndexFormatError('unsupported delta version %d: %s' % (version, file_path))
+
+        dtype = delta_dtype(words)
+        if rows:
+            records = np.memmap(file_path, dtype=dtype, mode='r', shape=(rows,), offset=HEADER_SIZE)
+            if records['id'][0] <= min_id:
+                # rows already merged into index by interrupted compaction
+                records = records[records['id'] > min_id]
+        else:
+            records = np.empty(0, dtype=dtype)
+
+        self.size = len(records)
+        self.generation = generation
+        self.fingerprints = records['fp']
+        self.folded = [(x, fold(np.ascontiguousarray(self.fingerprints), x))
+                       for x in sorted(folds) if x < words * 64]
+        self.ids = records['id']
+        self.counts = records['count']
+
+
+class ShardedIndex(object):
+    """
+    index split into shards by consecutive id ranges. every shard is index file. list of shards,
+    generation number of files and state of DB, for which index was built, are stored in JSON manifest.
+    """
+    def __init__(self, manifest_path):
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except ValueError:
+            raise IndexFormatError('broken manifest: %s' % manifest_path)
+        if manifest.get('version') != VERSION:
+            raise IndexFormatError('unsupported manifest version: %s' % manifest_path)
+
+        base = os.path.dirname(manifest_path)
+        self.generation = manifest['generation']
+        self.state = manifest.get('state')
+        self.files = manifest['shards']
+        self.shards = [FingerprintIndex(os.path.join(base, x)) for x in self.files]
+        self.size = sum(x.size for x in self.shards)
+        self.max_id = max((x.max_id for x in self.shards), default=0)
+
+
+def delta_dtype(words):
+    return np.dtype([('id', '<i8'), ('count', '<i4'), ('pad', '<i4'), ('fp', '<u8', (words,))])
+
+
+def append_delta(file_path, ids, fingerprints, counts, generation=0):
+    """
+    append records to delta file. header is updated only after records are flushed to disk,
+    so partially written records are never seen by readers.
+
+    :param generation: generation of DB, which contains records. records may be empty
+    """
+    rows, words = fingerprints.shape
+    records = np.zeros(rows, dtype=delta_dtype(words))
+    records['id'] = ids
+    records['count'] = counts
+    records['fp'] = fingerprints
+
+    with open(file_path, 'r+b' if os.path.exists(file_path) else 'w+b') as f:
+        head = f.read(HEADER_SIZE)
+        if len(head) < HEADER_SIZE:
+            size = 0
+        else:
+            magic, _, old_words, size, _ = HEADER.unpack_from(head)
+            if magic != DELTA_MAGIC or old_words != words:
+                raise IndexFormatError('incompatible delta file: %s' % file_path)
+
+        f.seek(HEADER_SIZE + size * records.itemsize)
+        records.tofile(f)
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+
+        f.seek(0)
+        f.write(HEADER.pack(DELTA_MAGIC, VERSION, words, size + rows, generation).ljust(HEADER_SIZE, b'\0'))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def column_offsets(rows, words, folds=()):
+    """
+    start of fingerprints column, list of starts of folded fingerprints columns, starts of ids
+    and counts columns and end of file
+    """
+    fingerprints = HEADER_SIZE
+    folded = []
+    offset = fingerprints + rows * words * 8
+    for x in folds:
+        folded.append(offset)
+        offset += rows * x // 8
+    ids = offset
+    counts = ids + rows * 8
+    end = counts + (rows * 4 + 7) // 8 * 8
+    return fingerprints, folded, ids, counts, end
+
+
+def write_index(file_path, ids, fingerprints, counts, folds=()):
+    """
+    atomically (re)write index file. data is written into temporary file in the same
+    directory, which replaces old index only after it's completely flushed to disk.
+    rows are sorted by popcount.
+
+    :param folds: sizes in bits of folded fingerprints to store. sizes not less than fingerprint length are skipped
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int32)
+    order = np.lexsort((ids, counts))
+    ids = np.ascontiguousarray(ids[order])
+    fingerprints = np.ascontiguousarray(np.asarray(fingerprints, dtype=np.uint64)[order])
+    counts = np.ascontiguousarray(counts[order])
+    rows, words = fingerprints.shape
+    folds = sorted(x for x in folds if x < words * 64)[:MAX_FOLDS]
+    header = HEADER.pack(MAGIC, VERSION, words, rows, int(ids.max()) if rows else 0) + \
+        FOLDS.pack(*(folds + [0] * (MAX_FOLDS - len(folds))))
+    _atomic_write(file_path, header, [fingerprints] + [fold(fingerprints, x) for x in folds] + [ids, counts])
+
+
+def write_shards(manifest_path, ids, fingerprints, counts, shards=1, folds=(), state=None):
+    """
+    atomically (re)write sharded index. rows are split by id into shards of equal size.
+    shards of new generation are written next to old ones, then manifest is replaced and
+    files of old generation are removed. readers always see complete set of shards.
+
+    :param state: JSON serializable state of DB, for which index is built
+    """
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    name = os.path.basename(manifest_path).split('.')[0]
+    try:
+        with open(manifest_path) as f:
+            old = json.load(f)
+        generation, old_files = old['generation'] + 1, old['shards']
+    except (OSError, ValueError, KeyError):
+        generation, old_files = 1, []
+
+    ids = np.asarray(ids, dtype=np.int64)
+    fingerprints = np.asarray(fingerprints, dtype=np.uint64)
+    counts = np.asarray(counts, dtype=np.int32)
+    files = []
+    for n, rows in enumerate(np.array_split(np.argsort(ids, kind='mergesort'), max(1, min(shards, len(ids))))):
+        file_name = '%s.%d.%d.idx' % (name, generation, n)
+        write_index(os.path.join(base, file_name), ids[rows], fingerprints[rows], counts[rows], folds)
+        files.append(file_name)
+
+    fd, tmp_path = tempfile.mkstemp(dir=base, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dict(version=VERSION, generation=generation, shards=files, state=state), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, manifest_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    for x in old_files:
+        if x not in files and os.path.exists(os.path.join(base, x)):
+            os.remove(os.path.join(base, x))
+
+
+class RolesIndex(object):
+    """
+    read-only view of molecules to reactions index file.
+
+    layout: 64 bytes header (magic, version, molecules, reagent links, product links, max link id,
+    identity token of DB), then sorted uint64 FEAR hashes of molecules and for reagents and products: int64 offsets of
+    molecules lists and int64 reactions ids. list of each molecule is sorted.
+    """
+    def __init__(self, file_path):
+        with open(file_path, 'rb') as f:
+            head = f.read(HEADER_SIZE)
+        if len(head) < HEADER_SIZE:
+            raise IndexFormatError('truncated header: %s' % file_path)
+
+        magic, version, keys, reagents, products, max_link, identity = ROLES_HEADER.unpack_from(head)
+        if magic != ROLES_MAGIC:
+            raise IndexFormatError('not a roles index file: %s' % file_path)
+        if version != ROLES_VERSION:
+            raise IndexFormatError('unsupported roles index version %d: %s' % (version, file_path))
+        if os.path.getsize(file_path) < HEADER_SIZE + (keys * 3 + 2 + reagents + products) * 8:
+            raise IndexFormatError('truncated index: %s' % file_path)
+
+        self.max_link = max_link
+        self.identity = identity.hex()
+        data = np.memmap(file_path, dtype=np.int64, mode='r', offset=HEADER_SIZE,
+                         shape=(keys * 3 + 2 + reagents + products,))
+        self.keys = data[:keys].view(np.uint64)
+        self.offsets = (data[keys:keys * 2 + 1], data[keys * 2 + 1:keys * 3 + 2])
+        self.reactions = (data[keys * 3 + 2:keys * 3 + 2 + reagents], data[keys * 3 + 2 + reagents:])
+
+    def links(self):
+        """
+        :return: molecules hashes, reactions ids and product flags of all links
+        """
+        hashes = []
+        reactions = []
+        products = []
+        for product, offsets, ids in zip((False, True), self.offsets, self.reactions):
+            hashes.append(np.repeat(self.keys, np.diff(offsets)))
+            reactions.append(np.asarray(ids))
+            products.append(np.full(len(ids), product))
+        return np.concatenate(hashes), np.concatenate(reactions), np.concatenate(products)
+
+
+def write_roles(file_path, hashes, reactions, products, max_link, identity):
+    """
+    atomically (re)write molecules to reactions index from links. duplicated links are dropped.
+
+    :param hashes: uint64 FEAR hashes of molecules
+    :param reactions: reactions ids
+    :param products: True for product links
+    :param max_link: max id of indexed links
+    :param identity: hex identity token of indexed DB
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    reactions = np.asarray(reactions, dtype=np.int64)
+    products = np.asarray(products, dtype=bool)
+    keys = np.unique(hashes)
+
+    offsets = []
+    ids = []
+    for role in (~products, products):
+        h, r = hashes[role], reactions[role]
+        order = np.lexsort((r, h))
+        h, r = h[order], r[order]
+        unique = np.ones(len(h), dtype=bool)
+        unique[1:] = (h[1:] != h[:-1]) | (r[1:] != r[:-1])
+        h, r = h[unique], r[unique]
+        offsets.append(np.searchsorted(h, keys, 'left').astype(np.int64))
+        offsets.append(np.array([len(h)], dtype=np.int64))
+        ids.append(r)
+
+    header = ROLES_HEADER.pack(ROLES_MAGIC, ROLES_VERSION, len(keys), len(ids[0]), len(ids[1]), max_link,
+                               bytes.fromhex(identity))
+    _atomic_write(file_path, header,
+                  (keys, np.concatenate(offsets[:2]), np.concatenate(offsets[2:]), ids[0], ids[1]))
+
+
+class LSHTables(object):
+    """
+    read-only view of MinHash LSH index file.
+
+    layout: 64 bytes header (magic, version, words per row, bands, signature values per band, fingerprint bits,
+    rows, max id, identity token of DB), then uint64 fingerprints matrix, int64 ids, for each band sorted uint64 buckets keys of rows and
+    int64 rows numbers in keys order, and int32 popcounts.
+    """
+    def __init__(self, file_path):
+        with open(file_path, 'rb') as f:
+            head = f.read(HEADER_SIZE)
+        if len(head) < HEADER_SIZE:
+            raise IndexFormatError('truncated header: %s' % file_path)
+
+        magic, version, words, bands, band_rows, bits, rows, max_id, identity = LSH_HEADER.unpack_from(head)
+        if magic != LSH_MAGIC:
+            raise IndexFormatError('not a LSH index file: %s' % file_path)
+        if version != LSH_VERSION:
+            raise IndexFormatError('unsupported LSH index version %d: %s' % (version, file_path))
+
+        ids = HEADER_SIZE + rows * words * 8
+        keys = ids + rows * 8
+        order = keys + bands * rows * 8
+        counts = order + bands * rows * 8
+        if os.path.getsize(file_path) < counts + rows * 4:
+            raise IndexFormatError('truncated index: %s' % file_path)
+
+        self.size = rows
+        self.max_id = max_id
+        self.bands = bands
+        self.band_rows = band_rows
+        self.bits = bits
+        self.identity = identity.hex()
+        self.fingerprints = self.__map(file_path, np.uint64, (rows, words), HEADER_SIZE)
+        self.ids = self.__map(file_path, np.int64, (rows,), ids)
+        self.counts = self.__map(file_path, np.int32, (rows,), counts)
+        self.keys = self.__map(file_path, np.uint64, (bands, rows), keys)
+        self.order = self.__map(file_path, np.int64, (bands, rows), order)
+
+    @staticmethod
+    def __map(file_path, dtype, shape, offset):
+        if not np.prod(shape):
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(file_path, dtype=dtype, mode='r', shape=shape, offset=offset)
+
+
+def write_lsh(file_path, ids, fingerprints, counts, keys, band_rows, bits, identity):
+    """
+    atomically (re)write MinHash LSH index.
+
+    :param keys: uint64 matrix (bands x rows) of buckets keys of rows
+    :param band_rows: number of signature values per band
+    :param bits: size of fingerprints in bits
+    :param identity: hex identity token of indexed DB
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    fingerprints = np.asarray(fingerprints, dtype=np.uint64)
+    counts = np.asarray(counts, dtype=np.int32)
+    keys = np.asarray(keys, dtype=np.uint64)
+    rows, words = fingerprints.shape
+    order = np.argsort(keys, axis=1, kind='mergesort')
+    header = LSH_HEADER.pack(LSH_MAGIC, LSH_VERSION, words, len(keys), band_rows, bits, rows,
+                             int(ids.max()) if rows else 0, bytes.fromhex(identity))
+    _atomic_write(file_path, header, (fingerprints, ids, np.take_along_axis(keys, order, axis=1),
+                                      order.astype(np.int64), counts))
+
+
+def _atomic_write(file_path, header, arrays):
+    """
+    write header and arrays into temporary file in the same directory, which replaces
+    file_path only after it's completely flushed to disk. file is padded to 8 bytes.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header.ljust(HEADER_SIZE, b'\0'))
+            for x in arrays:
+                np.ascontiguousarray(x).tofile(f)
+            f.write(b'\0' * (-f.tell() % 8))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -0,0 +1,255 @@
+import numpy as np
+import time
+from pony.orm import count
+from MARS.files.Zulfia import as_words, fingerprints_from_bytes
+from MARS.files.Tanimoto import popcount, tanimoto, select_top
+from MARS.files.MinHash import signatures, band_keys, bucket_rows, recall
+from MARS.files.IndexFile import LSHTables, DeltaIndex, IndexFormatError, write_lsh, append_delta
+from MARS.files.TreeIndex import load_fingerprints, materialize, COMPACT_RATIO
+from MARS.files.Profile import profiler, timed
+from MARS.models import get_db_identity
+from MARS.config import LSH_BANDS, LSH_ROWS, FINGERPRINT_SIZES
+from os import path, remove
+
+dump_dir = '.'
+
+
+class LSHIndex(object):
+    """
+    approximate similarity index of Molecules or Reactions for very large DBs.
+
+    MinHash signatures of fingerprints are split into bands of rows values. entities, which share
+    bucket with query in any band, are candidates, they are ranked by exact Tanimoto similarity.
+    entity with similarity s is candidate with probability 1 - (1 - s ** rows) ** bands.
+
+    entities added by update are kept in delta segment, which is scanned exactly, and merged
+    into tables when it becomes big. index is rebuilt if number of entities in DB, bands parameters or
+    fingerprints size are changed, or if it was built for other DB.
+    """
+    @timed('lsh_load')
+    def __init__(self, data, reindex=False, dump_path=dump_dir, bands=LSH_BANDS, rows=LSH_ROWS):
+        bits = FINGERPRINT_SIZES[data.__name__]
+        identity = get_db_identity()
+        index = None if reindex else self.__open(data, dump_path)
+        if index is not None:
+            delta = self.__open_delta(data, dump_path, index.max_id)
+            size = count(s for s in data)
+            if index.identity != identity:
+                print('LSH index will be rebuilt: it was built for other database')
+                index = None
+            elif index.bits != bits:
+                print('LSH index will be rebuilt: it contains %d bits fingerprints, %d bits are used' %
+                      (index.bits, bits))
+                index = None
+            elif index.bands != bands or index.band_rows != rows:
+                print('LSH index will be rebuilt: it has %d bands of %d rows' % (index.bands, index.band_rows))
+                index = None
+            elif index.size + (delta.size if delta else 0) != size:
+                print('LSH index will be rebuilt: it contains %d entities, database contains %d' %
+                      (index.size + (delta.size if delta else 0), size))
+                index = None
+
+        if index is None:
+            fps, ids = load_fingerprints(data)
+            words = as_words(fps)
+            index = self.__write(data, dump_path, ids, words, popcount(words),
+                                 band_keys(signatures(words, bands * rows), bands, rows), rows, bits, identity)
+            delta = None
+
+        self.__data = data
+        self.__index = index
+        self.__delta = delta if delta and delta.size else None
+
+    @staticmethod
+    def __open(data, dump_path):
+        file_path = path.join(dump_path, '%s.lsh.idx' % data.__name__)
+        if path.exists(file_path):
+            try:
+                return LSHTables(file_path)
+            except IndexFormatError as e:
+                print('LSH index will be rebuilt: %s' % e)
+
+    @staticmethod
+    def __open_delta(data, dump_path, min_id):
+        delta_path = path.join(dump_path, '%s.lsh.delta.idx' % data.__name__)
+        if path.exists(delta_path):
+            return DeltaIndex(delta_path, min_id)
+
+    @staticmethod
+    def __write(data, dump_path, ids, words, counts, keys, band_rows, bits, identity):
+        """
+        write tables and drop delta segment
+        """
+        file_path = path.join(dump_path, '%s.lsh.idx' % data.__name__)
+        write_lsh(file_path, ids, words, counts, keys, band_rows, bits, identity)
+        delta_path = path.join(dump_path, '%s.lsh.delta.idx' % data.__name__)
+        if path.exists(delta_path):
+            remove(delta_path)
+        return LSHTables(file_path)
+
+    @classmethod
+    @timed('lsh_update')
+    def update(cls, data, ids, fingerprints, dump_path=dump_dir):
+        """
+        append new entities to delta segment of existing index. big delta is merged into tables.
+
+        :param ids: ids of committed entities
+        :param fingerprints: their fingerprints as stored in DB
+        """
+        index = cls.__open(data, dump_path)
+        bits = FINGERPRINT_SIZES[data.__name__]
+        # index of other fingerprints size is rebuilt on open
+        if index is None or index.bits != bits or not ids:
+            return
+
+        words = as_words(fingerprints_from_bytes(fingerprints, bits))
+        append_delta(path.join(dump_path, '%s.lsh.delta.idx' % data.__name__), ids, words, popcount(words))
+
+        if cls.__open_delta(data, dump_path, index.max_id).size > COMPACT_RATIO * index.size:
+            cls.compact(data, dump_path)
+
+    @classmethod
+    @timed('lsh_compact')
+    def compact(cls, data, dump_path=dump_dir):
+        """
+        merge delta segment into tables. only buckets keys of delta are computed, DB is not read.
+        """
+        index = cls.__open(data, dump_path)
+        if index is None:
+            return
+        delta = cls.__open_delta(data, dump_path, index.max_id)
+        if delta is None or not delta.size:
+            return
+
+        # tables keep keys sorted, restore them in rows order
+        keys = np.empty_like(index.keys)
+        np.put_along_axis(keys, index.order, index.keys, axis=1)
+        words = np.ascontiguousarray(delta.fingerprints)
+        keys = np.concatenate((keys, band_keys(signatures(words, index.bands * index.band_rows), index.bands,
+                                                index.band_rows)), axis=1)
+        cls.__write(data, dump_path, np.concatenate((index.ids, delta.ids)),
+                    np.concatenate((index.fingerprints, words)), np.concatenate((index.counts, delta.counts)), keys,
+                    index.band_rows, index.bits, index.identity)
+
+    def __search(self, q):
+        """
+        candidates of fingerprints with their Tanimoto similarities
+
+        :return: list of (similarities, ids) pairs
+        """
+        index = self.__index
+        words = as_words(q)
+        with profiler.stage('lsh_search', len(words)):
+            keys = band_keys(signatures(words, index.bands * index.band_rows), index.bands, index.band_rows)
+            results = []
+            delta = self.__delta
+            for x, rows in zip(words, bucket_rows(index.keys, index.order, keys)):
+                profiler.count('lsh_candidates', len(rows))
+                scores = tanimoto(x, index.fingerprints[rows], index.counts[rows])
+                if delta is None:
+                    results.append((scores, index.ids[rows]))
+                else:
+                    # delta segment is small, it's scanned exactly
+                    results.append((np.concatenate((scores, tanimoto(x, delta.fingerprints, delta.counts))),
+                                    np.concatenate((index.ids[rows], delta.ids))))
+            return results
+
+    def get_similar(self, structure, num):
+        return self.get_similar_batch([structure], num)[0]
+
+    def get_similar_batch(self, structures, num, fears=None):
+        """
+        approximate k nearest entities for each of structures
+
+        :param fears: FEAR strings of structures if already known
+        :return: list of (distances, entities) pairs
+        """
+        return self.get_similar_fingerprints(self.__data.get_fingerprints(structures, fears=fears), num)
+
+    def get_similar_fingerprints(self, q, num):
+        """
+        approximate k nearest entities for each of fingerprints
+
+        :param q: uint8 fingerprints matrix as returned by get_fingerprints of entity
+        :return: list of (distances, entities) pairs
+        """
+        return materialize(self.__data, [select_top(s, i, num) for s, i in self.__search(q)])
+
+    def get_within(self, structure, threshold):
+        return self.get_within_batch([structure], threshold)[0]
+
+    def get_within_batch(self, structures, threshold, fears=None):
+        """
+        entities with Tanimoto similarity not less than threshold among candidates of each of structures
+
+        :param fears: FEAR strings of structures if already known
+        :return: list of (distances, entities) pairs. entities are sorted by similarity
+        """
+        return self.get_within_fingerprints(self.__data.get_fingerprints(structures, fears=fears), threshold)
+
+    def get_within_fingerprints(self, q, threshold):
+        """
+        entities with Tanimoto similarity not less than threshold among candidates of each of fingerprints
+
+        :param q: uint8 fingerprints matrix as returned by get_fingerprints of entity
+        :return: list of (distances, entities) pairs. entities are sorted by similarity
+        """
+        results = []
+        for s, i in self.__search(q):
+            mask = s >= threshold
+            results.append(select_top(s[mask], i[mask], int(np.count_nonzero(mask))))
+        return materialize(self.__data, results)
+
+    @property
+    def size(self):
+        return self.__index.size + (self.__delta.size if self.__delta is not None else 0)
+
+    @property
+    def version(self):
+        """
+        search method of index. part of result cache keys
+        """
+        return 'lsh%dx%d' % (self.__index.bands, self.__index.band_rows)
+
+
+class RecallEvaluation(object):
+    """
+    searches structures by approximate and exact indexes. approximate results are returned,
+    recall of exact results and search times are accumulated. structures are fingerprinted once for both.
+    """
+    def __init__(self, data, approximate, exact):
+        self.__data = data
+        self.__approximate = approximate
+        self.__exact = exact
+        self.queries = 0
+        self.approximate_time = self.exact_time = 0.
+        self.__exact_scores = []
+        self.__approximate_scores = []
+
+    def get_similar_batch(self, structures, num, fears=None):
+        return self.__compare('get_similar_fingerprints', structures, num, fears)
+
+    def get_within_batch(self, structures, threshold, fears=None):
+        return self.__compare('get_within_fingerprints', structures, threshold, fears)
+
+    def __compare(self, method, structures, value, fears):
+        q = self.__data.get_fingerprints(structures, fears=fears)
+        start = time.perf_counter()
+        results = getattr(self.__approximate, method)(q, value)
+        middle = time.perf_counter()
+        exact = getattr(self.__exact, method)(q, value)
+        self.approximate_time += middle - start
+        self.exact_time += time.perf_counter() - middle
+        self.queries += len(structures)
+        self.__approximate_scores.extend(1 - d for d, _ in results)
+        self.__exact_scores.extend(1 - d for d, _ in exact)
+        return results
+
+    @property
+    def recall(self):
+        return recall(self.__exact_scores, self.__approximate_scores)
+
+    def report(self):
+        queries = max(self.queries, 1)
+        return 'Queries: %d, recall: %.4f, approximate search: %.2fms, exact search: %.2fms per query' % \
+               (self.queries, self.recall, self.approximate_time / queries * 1000, self.exact_time / queries * 1000)
@@ -0,0 +1,96 @@
+from functools import lru_cache
+import numpy as np
+
+# permutations must be the same for index and queries
+SEED = 42
+BLOCK_SIZE = 65536
+FNV_OFFSET = np.uint64(14695981039346656037)
+FNV_PRIME = np.uint64(1099511628211)
+
+
+@lru_cache(maxsize=None)
+def permutations(size, hashes):
+    """
+    random permutations of fingerprint bits positions
+    """
+    rnd = np.random.RandomState(SEED)
+    return np.array([rnd.permutation(size) for _ in range(hashes)], dtype=np.uint32)
+
+
+def signatures(words, hashes):
+    """
+    MinHash signatures of rows of uint64 words matrix: minimal permuted position of set bits for each
+    of hashes permutations. probability of equal values in signatures of two rows is their Tanimoto similarity.
+    values of empty rows are equal to fingerprint size.
+
+    :return: uint32 matrix (rows x hashes)
+    """
+    size = words.shape[-1] * 64
+    table = permutations(size, hashes)
+    result = np.full((len(words), hashes), size, dtype=np.uint32)
+    block = max(BLOCK_SIZE // hashes, 1)
+
+    for start in range(0, len(words), block):
+        bits = np.unpackbits(np.ascontiguousarray(words[start:start + block]).view(np.uint8), axis=1)
+        rows, positions = np.nonzero(bits)
+        if not len(rows):
+            continue
+        starts = np.flatnonzero(np.concatenate(([True], rows[1:] != rows[:-1])))
+        result[start + rows[starts]] = np.minimum.reduceat(table[:, positions], starts, axis=1).T
+    return result
+
+
+def band_keys(signatures, bands, band_rows):
+    """
+    buckets keys of signatures in each band: FNV-1a hash of band_rows signature values.
+
+    :return: uint64 matrix (bands x rows)
+    """
+    keys = np.empty((bands, len(signatures)), dtype=np.uint64)
+    for band in range(bands):
+        key = np.full(len(signatures), FNV_OFFSET, dtype=np.uint64)
+        for x in signatures[:, band * band_rows:(band + 1) * band_rows].T:
+            key = (key ^ x.astype(np.uint64)) * FNV_PRIME
+        keys[band] = key
+    return keys
+
+
+def bucket_rows(keys, order, query_keys):
+    """
+    candidates of queries: rows sharing bucket with query in any band.
+
+    :param keys: sorted buckets keys of rows in each band (bands x rows)
+    :param order: rows numbers in keys order (bands x rows)
+    :param query_keys: buckets keys of queries (bands x queries)
+    :return: list of sorted unique rows numbers arrays
+    """
+    starts = [np.searchsorted(k, q, 'left') for k, q in zip(keys, query_keys)]
+    stops = [np.searchsorted(k, q, 'right') for k, q in zip(keys, query_keys)]
+    results = []
+    for n in range(query_keys.shape[1]):
+        found = [o[s[n]:e[n]] for o, s, e in zip(order, starts, stops) if e[n] > s[n]]
+        results.append(np.unique(np.concatenate(found)) if found else np.empty(0, dtype=np.int64))
+    return results
+
+
+def candidate_probability(similarity, bands, band_rows):
+    """
+    probability of row with given similarity to query to be candidate
+    """
+    return 1 - (1 - similarity ** band_rows) ** bands
+
+
+def recall(exact, approximate):
+    """
+    part of exact results found by approximate search. hits tied with the worst exact hit
+    are equivalent to exact ones.
+
+    :param exact: list of similarities arrays of exact results of queries
+    :param approximate: list of similarities arrays of approximate results of the same queries
+    """
+    found = expected = 0
+    for e, a in zip(exact, approximate):
+        if len(e):
+            found += min(int(np.count_nonzero(np.asarray(a) >= np.min(e))), len(e))
+            expected += len(e)
+    return found / expected if expected else 1.
@@ -0,0 +1,148 @@
+import json
+import struct
+import numpy as np
+import networkx as nx
+from CGRtools.files.SDFrw import MoleculeContainer
+
+MAGIC = b'MMOL'
+VERSION = 1
+HEADER = struct.Struct('<4sHII')
+LENGTH = struct.Struct('<I')
+
+
+def pack_molecule(data):
+    """
+    pack molecule graph node-link data into bytes: atom and bond tables with one typed array
+    per attribute. graph ids must be integers.
+    """
+    nodes = data['nodes']
+    links = data['links'] if 'links' in data else data['edges']
+
+    chunks = [HEADER.pack(MAGIC, VERSION, len(nodes), len(links)),
+              struct.pack('<%di' % len(nodes), *(n['id'] for n in nodes)),
+              struct.pack('<%di' % (len(links) * 2), *(x for l in links for x in (l['source'], l['target'])))]
+    chunks.extend(_pack_table([{k: v for k, v in n.items() if k != 'id'} for n in nodes]))
+    chunks.extend(_pack_table([{k: v for k, v in l.items() if k not in ('source', 'target')} for l in links]))
+    chunks.append(_pack_blob(json.dumps(data.get('graph', {})).encode()))
+    return b''.join(chunks)
+
+
+def unpack_molecule(packed):
+    """
+    build MoleculeContainer from bytes created by pack_molecule
+    """
+    magic, version, n_nodes, n_edges = HEADER.unpack_from(packed)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('unsupported packed molecule')
+
+    offset = HEADER.size
+    nodes = struct.unpack_from('<%di' % n_nodes, packed, offset)
+    offset += n_nodes * 4
+    edges = struct.unpack_from('<%di' % (n_edges * 2), packed, offset)
+    offset += n_edges * 8
+    nodes_attrs, offset = _unpack_table(packed, offset, n_nodes)
+    edges_attrs, offset = _unpack_table(packed, offset, n_edges)
+    graph, offset = _unpack_blob(packed, offset)
+
+    molecule = nx.Graph()
+    molecule.graph.update(json.loads(graph.decode()))
+    molecule.add_nodes_from(zip(nodes, nodes_attrs))
+    molecule.add_edges_from(zip(edges[::2], edges[1::2], edges_attrs))
+    molecule.__class__ = MoleculeContainer
+    return molecule
+
+
+def _pack_blob(blob):
+    return LENGTH.pack(len(blob)) + blob
+
+
+def _unpack_blob(packed, offset):
+    length, = LENGTH.unpack_from(packed, offset)
+    offset += LENGTH.size
+    return packed[offset:offset + length], offset + length
+
+
+def _column_type(values):
+    types = set(type(x) for x in values)
+    if types == {int} and all(-2 ** 31 <= x < 2 ** 31 for x in values):
+        return b'i'
+    if types == {float}:
+        return b'd'
+    if types == {str} and not any('\0' in x for x in values):
+        return b's'
+    return b'j'
+
+
+def _pack_table(rows):
+    """
+    columns of attributes table. column is key, type, flag of column presence in all rows,
+    mask of rows having key if it's not in all rows and values of these rows
+    """
+    keys = sorted(set(k for r in rows for k in r))
+    chunks = [LENGTH.pack(len(keys))]
+    for k in keys:
+        mask = [k in r for r in rows]
+        values = [r[k] for r in rows if k in r]
+        column_type = _column_type(values)
+        chunks.append(_pack_blob(k.encode()))
+        chunks.append(column_type)
+        if all(mask):
+            chunks.append(b'\1')
+        else:
+            chunks.append(b'\0')
+            chunks.append(np.packbits(mask).tobytes())
+
+        if column_type in (b'i', b'd'):
+            chunks.append(struct.pack('<%d%s' % (len(values), column_type.decode()), *values))
+        elif column_type == b's':
+            chunks.append(_pack_blob('\0'.join(values).encode()))
+        else:
+            chunks.append(_pack_blob(json.dumps(values).encode()))
+    return chunks
+
+
+def _unpack_table(packed, offset, size):
+    keys = []
+    columns = []
+    sparse = []
+    n_keys, = LENGTH.unpack_from(packed, offset)
+    offset += LENGTH.size
+    for _ in range(n_keys):
+        key, offset = _unpack_blob(packed, offset)
+        key = key.decode()
+        column_type = packed[offset:offset + 1]
+        full = packed[offset + 1] == 1
+        offset += 2
+        if full:
+            present = size
+        else:
+            mask_size = (size + 7) // 8
+            mask = np.unpackbits(np.frombuffer(packed, dtype=np.uint8, count=mask_size, offset=offset))[:size]
+            offset += mask_size
+            present = np.flatnonzero(mask).tolist()
+
+        count = size if full else len(present)
+        if column_type == b'i':
+            values = struct.unpack_from('<%di' % count, packed, offset)
+            offset += count * 4
+        elif column_type == b'd':
+            values = struct.unpack_from('<%dd' % count, packed, offset)
+            offset += count * 8
+        elif column_type == b's':
+            blob, offset = _unpack_blob(packed, offset)
+            values = blob.decode().split('\0') if count else []
+        else:
+            blob, offset = _unpack_blob(packed, offset)
+            values = json.loads(blob.decode())
+
+        if full:
+            keys.append(key)
+            columns.append(values)
+        else:
+            sparse.append((key, present, values))
+
+    rows = [dict(zip(keys, x)) for x in zip(*columns)] if columns else [{} for _ in range(size)]
+    for key, present, values in sparse:
+        for i, v in zip(present, values):
+            rows[i][key] = v
+    return rows, offset
@@ -0,0 +1,176 @@
+import cProfile
+import json
+import sys
+import time
+from functools import wraps
+
+
+class Profiler(object):
+    """
+    per-stage timers and counters. stages are timed inclusively: time of nested stage is also counted
+    by enclosing one. disabled profiler costs one attribute check per instrumented call.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.started = None
+        self.stages = {}
+        self.counters = {}
+
+    def enable(self):
+        self.enabled = True
+        self.started = time.perf_counter()
+
+    def reset(self):
+        self.stages.clear()
+        self.counters.clear()
+
+    def add(self, name, seconds, items=1):
+        stage = self.stages.get(name)
+        if stage is None:
+            self.stages[name] = [1, items, seconds]
+        else:
+            stage[0] += 1
+            stage[1] += items
+            stage[2] += seconds
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def stage(self, name, items=1):
+        """
+        context manager timing block as stage
+        """
+        return _Stage(self, name, items) if self.enabled else _null_stage
+
+    def snapshot(self):
+        return dict(stages=self.stages, counters=self.counters)
+
+    def merge(self, snapshot):
+        """
+        add stages and counters collected in other process
+        """
+        for name, (calls, items, seconds) in snapshot['stages'].items():
+            stage = self.stages.setdefault(name, [0, 0, 0.])
+            stage[0] += calls
+            stage[1] += items
+            stage[2] += seconds
+        for name, value in snapshot['counters'].items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def table(self):
+        wall = time.perf_counter() - self.started if self.started else 0.
+        lines = ['%-24s %10s %12s %12s %12s %7s' % ('stage', 'calls', 'items', 'total, s', 'per call, ms', 'wall')]
+        for name, (calls, items, seconds) in sorted(self.stages.items(), key=lambda x: -x[1][2]):
+            lines.append('%-24s %10d %12d %12.3f %12.3f %6.1f%%' %
+                         (name, calls, items, seconds, seconds / calls * 1000, seconds / wall * 100 if wall else 0))
+        lines.extend('%-24s %10d' % x for x in sorted(self.counters.items()))
+        lines.append('wall time: %.3fs' % wall)
+        return '\n'.join(lines)
+
+    def json(self):
+        return json.dumps(dict(wall=time.perf_counter() - self.started if self.started else 0.,
+                               stages={n: dict(calls=c, items=i, seconds=s) for n, (c, i, s) in self.stages.items()},
+                               counters=self.counters), indent=2, sort_keys=True)
+
+    def prometheus(self):
+        lines = []
+        for metric, column, help_text in (('mars_stage_calls_total', 0, 'Number of stage calls'),
+                                          ('mars_stage_items_total', 1, 'Number of items processed by stage'),
+                                          ('mars_stage_seconds_total', 2, 'Time spent in stage')):
+            lines.append('# HELP %s %s' % (metric, help_text))
+            lines.append('# TYPE %s counter' % metric)
+            lines.extend('%s{stage="%s"} %s' % (metric, n, x[column]) for n, x in sorted(self.stages.items()))
+        for name, value in sorted(self.counters.items()):
+            lines.append('# TYPE mars_%s_total counter' % name)
+            lines.append('mars_%s_total %d' % (name, value))
+        return '\n'.join(lines)
+
+    def report(self, fmt='table', file_path=None):
+        text = getattr(self, fmt)() + '\n'
+        if file_path:
+            with open(file_path, 'w') as f:
+                f.write(text)
+        else:
+            sys.stderr.write(text)
+
+
+class _Stage(object):
+    __slots__ = ('profiler', 'name', 'items', 'start')
+
+    def __init__(self, profiler, name, items):
+        self.profiler = profiler
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.add(self.name, time.perf_counter() - self.start, self.items)
+
+
+class _NullStage(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_null_stage = _NullStage()
+profiler = Profiler()
+
+
+def timed(name):
+    """
+    decorator timing every call of function as stage
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.add(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def profiled_call(function, *args):
+    """
+    call function in worker process with enabled profiler.
+
+    :return: result of function and snapshot of stages of call for Profiler.merge
+    """
+    profiler.enabled = True
+    profiler.reset()
+    result = function(*args)
+    return result, profiler.snapshot()
+
+
+def run(function, kwargs):
+    """
+    run subcommand function with profiling options of kwargs: profile enables stages timers,
+    summary is written in profile_format to profile_output or stderr. cprofile is file of cProfile stats.
+    """
+    if kwargs.get('profile') and not profiler.enabled:
+        profiler.enable()
+    capture = cProfile.Profile() if kwargs.get('cprofile') else None
+    if capture is not None:
+        capture.enable()
+    try:
+        return function(**kwargs)
+    finally:
+        if capture is not None:
+            capture.disable()
+            capture.dump_stats(kwargs['cprofile'])
+            print('cProfile stats are written to %s' % kwargs['cprofile'], file=sys.stderr)
+        if profiler.enabled:
+            profiler.report(kwargs.get('profile_format') or 'table', kwargs.get('profile_output'))
@@ -0,0 +1,121 @@
+import numpy as np
+from hashlib import md5
+from pony.orm import select, max as max_
+from MARS.models import Molecules, ReactionsMolecules, MAX_PARAMS, get_db_identity
+from MARS.files.IndexFile import RolesIndex, IndexFormatError, write_roles
+from MARS.files.Profile import timed
+from os import path
+
+dump_dir = '.'
+
+
+def fear_hash(fear_string):
+    """
+    64-bit key of FEAR string
+    """
+    return int.from_bytes(md5(fear_string.encode()).digest()[:8], 'little')
+
+
+def intersect(a, b):
+    """
+    intersection of sorted unique arrays. every item of shorter array is looked up by binary search
+    in longer one, so intersection of short and long lists costs O(short * log(long)).
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    if not len(a):
+        return a
+    found = np.searchsorted(b, a)
+    return a[b[np.minimum(found, len(b) - 1)] == a]
+
+
+class RoleIndex(object):
+    """
+    inverted index of reactions by molecules. for each molecule FEAR hash keeps sorted ids of reactions,
+    in which molecule is reagent and in which it's product. index is updated with links added to DB
+    after it was built. index built for other DB is rebuilt.
+    """
+    @timed('roles_load')
+    def __init__(self, reindex=False, dump_path=dump_dir):
+        file_path = path.join(dump_path, 'ReactionsMolecules.idx')
+        last = max_(rm.id for rm in ReactionsMolecules) or 0
+        identity = get_db_identity()
+        index = None if reindex else self.__open(file_path)
+        if index is not None and index.identity != identity:
+            print('Roles index will be rebuilt: it was built for other database')
+            index = None
+
+        if index is None or index.max_link > last:
+            write_roles(file_path, *self.__load_links(0, last), last, identity)
+        elif index.max_link < last:
+            new = self.__load_links(index.max_link, last)
+            write_roles(file_path, *(np.concatenate(x) for x in zip(index.links(), new)), last, identity)
+
+        self.__index = RolesIndex(file_path)
+
+    @staticmethod
+    def __open(file_path):
+        if path.exists(file_path):
+            try:
+                return RolesIndex(file_path)
+            except IndexFormatError as e:
+                print('Roles index will be rebuilt: %s' % e)
+
+    @staticmethod
+    def __load_links(first, last):
+        """
+        links with ids in (first, last] range as arrays of molecules hashes, reactions ids and product flags
+        """
+        links = select((rm.molecule.id, rm.reaction.id, rm.product) for rm in ReactionsMolecules
+                       if rm.id > first and rm.id <= last)[:]
+        molecules = list(set(m for m, _, _ in links))
+        hashes = {}
+        for start in range(0, len(molecules), MAX_PARAMS):
+            batch = molecules[start:start + MAX_PARAMS]
+            hashes.update((m, fear_hash(f)) for m, f in select((m.id, m.fear) for m in Molecules if m.id in batch))
+
+        return (np.array([hashes[m] for m, _, _ in links], dtype=np.uint64),
+                np.array([r for _, r, _ in links], dtype=np.int64),
+                np.array([p for _, _, p in links], dtype=bool))
+
+    @timed('roles_lookup')
+    def get_reactions(self, fear_string, product=None):
+        """
+        sorted ids of reactions with molecule.
+
+        :param product: True for reactions producing molecule, False for reactions consuming it, None for any
+        """
+        key = np.uint64(fear_hash(fear_string))
+        n = int(np.searchsorted(self.__index.keys, key))
+        if n == len(self.__index.keys) or self.__index.keys[n] != key:
+            return np.empty(0, dtype=np.int64)
+
+        roles = (False, True) if product is None else (product,)
+        found = [self.__index.reactions[r][self.__index.offsets[r][n]:self.__index.offsets[r][n + 1]] for r in roles]
+        return found[0] if len(found) == 1 else np.union1d(*found)
+
+    @timed('roles_search')
+    def search(self, reagents=(), products=(), molecules=()):
+        """
+        sorted ids of reactions, which contain all given molecules in given roles.
+
+        :param reagents: FEAR strings of reagents
+        :param products: FEAR strings of products
+        :param molecules: FEAR strings of molecules in any role
+        """
+        lists = [self.get_reactions(f, p) for p, fears in ((False, reagents), (True, products), (None, molecules))
+                 for f in fears]
+        if not lists:
+            return np.empty(0, dtype=np.int64)
+
+        lists.sort(key=len)
+        result = lists[0]
+        for x in lists[1:]:
+            if not len(result):
+                break
+            result = intersect(result, x)
+        return np.asarray(result, dtype=np.int64)
+
+    @property
+    def size(self):
+        return len(self.__index.keys)
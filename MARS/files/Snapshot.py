@@ -0,0 +1,129 @@
+import numpy as np
+import os
+import struct
+import tempfile
+
+SNAPSHOT_MAGIC = b'MARSSNP\0'
+SNAPSHOT_VERSION = 1
+HEADER = struct.Struct('<8sI')
+HEADER_SIZE = 64
+# table name, number of rows and columns. chunk with empty table name ends snapshot
+CHUNK = struct.Struct('<32sQI4x')
+# column name, kind, number of rows and row width: columns number of 2d array or total bytes of blobs
+COLUMN = struct.Struct('<32s8sQQ')
+TEXT = b'text'
+BLOB = b'blob'
+
+
+class SnapshotFormatError(Exception):
+    pass
+
+
+class SnapshotWriter(object):
+    """
+    columnar snapshot of DB tables. tables are written by chunks of rows, every chunk keeps its columns
+    one after another: numpy arrays as is, strings and bytes as int64 lengths (-1 for NULL) followed
+    by concatenated data. every column is 8 bytes aligned.
+
+    snapshot is written into temporary file, which replaces file_path only after successful close.
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.__file = None
+        self.__tmp_path = None
+
+    def __enter__(self):
+        fd, self.__tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.file_path)), suffix='.tmp')
+        self.__file = os.fdopen(fd, 'wb')
+        self.__file.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION).ljust(HEADER_SIZE, b'\0'))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                self.__file.write(CHUNK.pack(b'', 0, 0))
+                self.__file.flush()
+                os.fsync(self.__file.fileno())
+            self.__file.close()
+            if exc_type is None:
+                os.replace(self.__tmp_path, self.file_path)
+        finally:
+            if os.path.exists(self.__tmp_path):
+                os.remove(self.__tmp_path)
+
+    def write(self, table, columns):
+        """
+        :param columns: list of (name, values) pairs. values are 1d or 2d numpy array
+        or list of str, bytes or None
+        """
+        rows = len(columns[0][1]) if columns else 0
+        f = self.__file
+        f.write(CHUNK.pack(table.encode(), rows, len(columns)))
+        for name, values in columns:
+            if len(values) != rows:
+                raise ValueError('column %s of %s has %d rows, expected %d' % (name, table, len(values), rows))
+            if isinstance(values, np.ndarray):
+                width = values.shape[1] if values.ndim == 2 else 0
+                f.write(COLUMN.pack(name.encode(), values.dtype.str.encode(), rows, width))
+                np.ascontiguousarray(values).tofile(f)
+            else:
+                text = any(isinstance(x, str) for x in values)
+                data = [x.encode() if isinstance(x, str) else x for x in values]
+                lengths = np.array([-1 if x is None else len(x) for x in data], dtype=np.int64)
+                data = b''.join(x for x in data if x is not None)
+                f.write(COLUMN.pack(name.encode(), TEXT if text else BLOB, rows, len(data)))
+                lengths.tofile(f)
+                f.write(data)
+            f.write(b'\0' * (-f.tell() % 8))
+
+
+def read_snapshot(file_path):
+    """
+    read snapshot chunk by chunk.
+
+    :return: generator of (table name, list of (column name, values) pairs). arrays are returned
+    as numpy arrays, strings and bytes as lists
+    """
+    with open(file_path, 'rb') as f:
+        head = f.read(HEADER_SIZE)
+        if len(head) < HEADER_SIZE:
+            raise SnapshotFormatError('truncated header: %s' % file_path)
+        magic, version = HEADER.unpack_from(head)
+        if magic != SNAPSHOT_MAGIC:
+            raise SnapshotFormatError('not a snapshot file: %s' % file_path)
+        if version != SNAPSHOT_VERSION:
+            raise SnapshotFormatError('unsupported snapshot version %d: %s' % (version, file_path))
+
+        while True:
+            table, rows, number = CHUNK.unpack(_read(f, CHUNK.size, file_path))
+            table = table.rstrip(b'\0').decode()
+            if not table:
+                return
+
+            columns = []
+            for _ in range(number):
+                name, kind, _, width = COLUMN.unpack(_read(f, COLUMN.size, file_path))
+                kind = kind.rstrip(b'\0')
+                if kind in (TEXT, BLOB):
+                    lengths = np.frombuffer(_read(f, rows * 8, file_path), dtype=np.int64)
+                    data = _read(f, width, file_path)
+                    ends = np.cumsum(np.maximum(lengths, 0)).tolist()
+                    values = [None if n < 0 else data[e - n:e] for n, e in zip(lengths.tolist(), ends)]
+                    if kind == TEXT:
+                        values = [None if x is None else x.decode() for x in values]
+                    size = rows * 8 + width
+                else:
+                    dtype = np.dtype(kind.decode())
+                    shape = (rows, width) if width else (rows,)
+                    size = int(np.prod(shape)) * dtype.itemsize
+                    values = np.frombuffer(_read(f, size, file_path), dtype=dtype).reshape(shape)
+                _read(f, -size % 8, file_path)
+                columns.append((name.rstrip(b'\0').decode(), values))
+            yield table, columns
+
+
+def _read(f, size, file_path):
+    data = f.read(size)
+    if len(data) < size:
+        raise SnapshotFormatError('truncated snapshot: %s' % file_path)
+    return data
@@ -0,0 +1,120 @@
+import json
+import os
+import tempfile
+
+RECORD_START = b'$RFMT'
+RECORD_END = b'$$$$'
+
+
+def rdf_chunks(stream, chunksize, offset=0, encoding='utf-8'):
+    """
+    split RDF file into text chunks of chunksize records without parsing. only one chunk is kept in memory.
+    file header is prepended to every chunk, so each of them is valid RDF file.
+
+    :param stream: binary file
+    :param offset: byte offset of record to start from. 0 for file start
+    :return: generator of (text, byte offset of the next record, number of records in chunk)
+    """
+    header = []
+    position = 0
+    for line in iter(stream.readline, b''):
+        if line.startswith(RECORD_START):
+            break
+        header.append(line)
+        position += len(line)
+    else:
+        return
+    header = b''.join(header)
+
+    if offset > position:
+        stream.seek(offset)
+        line = stream.readline()
+        if not line:
+            return
+        if not line.startswith(RECORD_START):
+            raise ValueError('offset %d is not at record start' % offset)
+        position = offset
+
+    lines = []
+    records = 0
+    while line:
+        if line.startswith(RECORD_START):
+            if records == chunksize:
+                text = b''.join(lines)
+                position += len(text)
+                yield (header + text).decode(encoding), position, records
+                lines = []
+                records = 0
+            records += 1
+        lines.append(line)
+        line = stream.readline()
+
+    if records:
+        text = b''.join(lines)
+        position += len(text)
+        yield (header + text).decode(encoding), position, records
+
+
+def sdf_chunks(stream, chunksize, encoding='utf-8'):
+    """
+    split SDF file into text chunks of chunksize records without parsing.
+    last record may have no $$$$ terminator.
+
+    :param stream: binary file
+    :return: generator of (text, byte offset of the next record, number of records in chunk)
+    """
+    position = 0
+    lines = []
+    records = 0
+    unterminated = False
+    for line in iter(stream.readline, b''):
+        lines.append(line)
+        if line.startswith(RECORD_END):
+            unterminated = False
+            records += 1
+            if records == chunksize:
+                text = b''.join(lines)
+                position += len(text)
+                yield text.decode(encoding), position, records
+                lines = []
+                records = 0
+        elif line.strip():
+            unterminated = True
+
+    if records or unterminated:
+        text = b''.join(lines)
+        position += len(text)
+        yield text.decode(encoding), position, records + unterminated
+
+
+def load_checkpoint(file_path, source):
+    """
+    :param source: path of loaded file. checkpoint of other file is error
+    :return: byte offset of the first not loaded record and number of loaded records
+    """
+    if not os.path.exists(file_path):
+        return 0, 0
+
+    with open(file_path) as f:
+        checkpoint = json.load(f)
+    if checkpoint['source'] != os.path.abspath(source):
+        raise ValueError('checkpoint %s belongs to %s' % (file_path, checkpoint['source']))
+    if checkpoint['offset'] > os.path.getsize(source):
+        raise ValueError('checkpoint %s is beyond end of %s' % (file_path, source))
+    return checkpoint['offset'], checkpoint['records']
+
+
+def save_checkpoint(file_path, source, offset, records):
+    """
+    atomically replace checkpoint with new position
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dict(source=os.path.abspath(source), offset=offset, records=records), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -1,5 +1,7 @@
 from CGRtools.CGRreactor import CGRreactor
-from CGRtools.files.SDFrw import SDFread
+from CGRtools.files.SDFrw import SDFread, MoleculeContainer
+from networkx.readwrite.json_graph import node_link_graph
+from MARS.files.Packing import unpack_molecule
 from networkx.algorithms import isomorphism
 #a=list(SDFread(open('hasan.sdf')).read())
 
@@ -11,4 +13,34 @@ def Feruza_isomorph(a): # a - SDF file
             return ('isomorph')
         else:
             if iso.subgraph_is_isomorphic():
-                return ('subgriso')
\ No newline at end of file
+                return ('subgriso')
+
+def match_batch(query, batch):
+    """
+    ids of molecules in batch, which contain query as subgraph
+
+    :param query: MoleculeContainer
+    :param batch: list of (id, packed structure or node-link data) pairs
+    """
+    cgrr = CGRreactor()
+    found = []
+    for i, data in batch:
+        if isinstance(data, bytes):
+            structure = unpack_molecule(data)
+        else:
+            structure = node_link_graph(data)
+            structure.__class__ = MoleculeContainer
+        if cgrr.spgraphmatcher(structure, query).subgraph_is_isomorphic():
+            found.append(i)
+    return found
+
+
+def reaction_center(cgr):
+    """
+    subgraph of CGR atoms, which change charge or bonds in reaction
+    """
+    nodes = set(n for n, attr in cgr.nodes(data=True) if attr.get('s_charge') != attr.get('p_charge'))
+    for u, v, attr in cgr.edges(data=True):
+        if attr.get('s_bond') != attr.get('p_bond'):
+            nodes.update((u, v))
+    return cgr.subgraph(nodes).copy()
@@ -0,0 +1,269 @@
+import heapq
+import numpy as np
+from itertools import islice
+from MARS.files.Zulfia import fold
+
+BLOCK_SIZE = 262144
+QUERY_GROUP = 256
+# number of rows with best folded bounds, which are compared first in cascade top-k search
+CANDIDATES = 1024
+# cascade falls back to scan of all rows if more than this part of them passes coarse screening
+SCAN_RATIO = .5
+
+if hasattr(np, 'bitwise_count'):
+    def popcount(words):
+        """
+        number of set bits in each row of uint64 words matrix
+        """
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int32)
+else:
+    _bits_table = np.array([bin(x).count('1') for x in range(256)], dtype=np.uint8)
+
+    def popcount(words):
+        """
+        number of set bits in each row of uint64 words matrix
+        """
+        return _bits_table[words.view(np.uint8)].sum(axis=-1, dtype=np.int32)
+
+
+def tanimoto(query, words, counts=None):
+    """
+    Tanimoto similarity of query words to each row of words matrix.
+    for matrix of queries returns matrix of similarities (queries x rows).
+    two empty fingerprints are treated as equal, like jaccard metric of BallTree does.
+    """
+    if counts is None:
+        counts = popcount(words)
+    if query.ndim == 2:
+        common = popcount(words[np.newaxis] & query[:, np.newaxis])
+        union = counts + popcount(query)[:, np.newaxis] - common
+    else:
+        common = popcount(words & query)
+        union = counts + popcount(query) - common
+    return np.where(union, common / np.maximum(union, 1), 1.)
+
+
+def select_top(scores, rows, k):
+    """
+    k best scores. ties are resolved by smaller row, so result doesn't depend on blocks order.
+    """
+    if k < 1:
+        return scores[:0], rows[:0]
+    if len(scores) > k:
+        border = np.partition(scores, len(scores) - k)[len(scores) - k]
+        mask = scores >= border
+        scores, rows = scores[mask], rows[mask]
+    order = np.lexsort((rows, -scores))[:k]
+    return scores[order], rows[order]
+
+
+def merge_top(results, k=None):
+    """
+    merge (scores, rows) pairs sorted by select_top into one sorted pair. result is the same as
+    select_top over concatenated pairs.
+
+    :param k: number of best scores to keep. all scores are kept if None
+    """
+    merged = list(islice(heapq.merge(*(zip(-s, r) for s, r in results)), k))
+    if not merged:
+        return np.empty(0), np.empty(0, dtype=np.int64)
+    scores, rows = zip(*merged)
+    return -np.array(scores), np.array(rows, dtype=np.int64)
+
+
+def top_k(query, words, k, counts=None, block=BLOCK_SIZE, labels=None):
+    """
+    exact k nearest rows of words matrix by Tanimoto similarity. matrix is scanned in blocks.
+
+    :param labels: rows labels (ids). if given, ties are resolved and results are returned by labels
+    :return: scores sorted in descending order and rows numbers
+    """
+    return top_k_batch(query[np.newaxis], words, k, counts, block, labels)[0]
+
+
+def top_k_batch(queries, words, k, counts=None, block=BLOCK_SIZE, labels=None):
+    """
+    exact k nearest rows of words matrix for each of queries. every block of matrix is compared
+    with group of queries at once, block size is reduced to keep memory usage bounded.
+
+    :param labels: rows labels (ids). if given, ties are resolved and results are returned by labels
+    :return: list of scores and rows numbers pairs
+    """
+    if counts is None:
+        counts = popcount(words)
+
+    results = []
+    for group in range(0, len(queries), QUERY_GROUP):
+        q = queries[group:group + QUERY_GROUP]
+        step = max(block // len(q), 1024)
+        best = [(np.empty(0), np.empty(0, dtype=np.int64))] * len(q)
+        for start in range(0, len(words), step):
+            scores = tanimoto(q, words[start:start + step], counts[start:start + step])
+            rows = np.arange(start, start + scores.shape[1]) if labels is None else \
+                np.asarray(labels[start:start + scores.shape[1]], dtype=np.int64)
+            for n, s in enumerate(scores):
+                s, r = select_top(s, rows, k)
+                best[n] = select_top(np.concatenate((best[n][0], s)), np.concatenate((best[n][1], r)), k)
+        results.extend(best)
+    return results
+
+
+def count_band(query_count, threshold, counts):
+    """
+    rows range of matrix sorted by popcount, which can reach threshold similarity with query.
+    Swamidass-Baldi bound: Tanimoto(a, b) <= min(|a|, |b|) / max(|a|, |b|), so t * |a| <= |b| <= |a| / t.
+    """
+    start = np.searchsorted(counts, int(np.floor(threshold * query_count)), 'left')
+    if threshold > 0:
+        stop = np.searchsorted(counts, int(np.ceil(query_count / threshold)), 'right')
+    else:
+        stop = len(counts)
+    return int(start), int(stop)
+
+
+def within(query, words, threshold, counts=None, block=BLOCK_SIZE, ordered=False):
+    """
+    rows of words matrix with Tanimoto similarity to query not less than threshold.
+
+    :param ordered: matrix is sorted by popcount. only rows of count_band are compared
+    :return: scores and rows numbers
+    """
+    if counts is None:
+        counts = popcount(words)
+    start, stop = count_band(int(popcount(query)), threshold, counts) if ordered else (0, len(words))
+
+    scores = []
+    rows = []
+    for x in range(start, stop, block):
+        s = tanimoto(query, words[x:min(x + block, stop)], counts[x:min(x + block, stop)])
+        found = np.flatnonzero(s >= threshold)
+        scores.append(s[found])
+        rows.append(found + x)
+    if not scores:
+        return np.empty(0), np.empty(0, dtype=np.int64)
+    return np.concatenate(scores), np.concatenate(rows)
+
+
+def superset_rows(query, words, block=BLOCK_SIZE, counts=None):
+    """
+    rows of words matrix which have all bits of query set.
+    if popcounts of matrix sorted rows are given, rows with less bits than query are skipped.
+    """
+    first = 0 if counts is None else int(np.searchsorted(counts, popcount(query), 'left'))
+    rows = [np.flatnonzero(((words[start:start + block] & query) == query).all(axis=1)) + start
+            for start in range(first, len(words), block)]
+    return np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+
+
+def fold_masks(query, size):
+    """
+    query weights for fingerprints folded into size bits: j-th mask has folded positions,
+    into which more than j bits of query are folded.
+    """
+    width = size // 64
+    folded = np.unpackbits(np.ascontiguousarray(query).reshape(-1, width).view(np.uint8), axis=1).sum(axis=0)
+    return [np.packbits(folded > j).view(np.uint64) for j in range(int(folded.max()))]
+
+
+def similarity_bound(masks, query_count, folded, counts):
+    """
+    upper bound of Tanimoto similarity of query to rows by their folded fingerprints. common bits
+    can't exceed number of query bits folded into positions set in row, nor number of row bits.
+    """
+    common = np.zeros(len(folded), dtype=np.int32)
+    for m in masks:
+        common += popcount(folded & m)
+    common = np.minimum(common, counts)
+    union = counts + query_count - common
+    return np.where(union, common / np.maximum(union, 1), 1.)
+
+
+def cascade_top_k(query, words, k, counts, levels, labels=None, block=BLOCK_SIZE):
+    """
+    exact k nearest rows of words matrix screened by folded fingerprints. CANDIDATES rows with best
+    coarse bounds are compared first, then only rows with bounds on every level reaching k-th best
+    similarity of candidates are compared by full fingerprints. result is the same as of top_k.
+
+    :param levels: list of (size, folded words matrix) pairs from coarse to fine
+    :param labels: rows labels (ids). if given, ties are resolved and results are returned by labels
+    """
+    labels = np.arange(len(words)) if labels is None else np.asarray(labels, dtype=np.int64)
+    if k < 1:
+        return np.empty(0), labels[:0]
+    query_count = int(popcount(query))
+    size, folded = levels[0]
+    bound = similarity_bound(fold_masks(query, size), query_count, folded, counts)
+
+    candidates = max(CANDIDATES, k)
+    if len(bound) <= candidates:
+        return _compare(query, words, counts, labels, np.arange(len(bound)), k, block)
+    best = _compare(query, words, counts, labels, np.argpartition(-bound, candidates - 1)[:candidates], k, block)
+
+    border = best[0][-1]
+    rows = np.flatnonzero(bound >= border)
+    if len(rows) > len(words) * SCAN_RATIO:
+        return top_k(query, words, k, counts, block, labels)
+    for size, folded in levels[1:]:
+        rows = rows[similarity_bound(fold_masks(query, size), query_count, folded[rows], counts[rows]) >= border]
+    return _compare(query, words, counts, labels, rows, k, block)
+
+
+def cascade_within(query, words, threshold, counts, levels, block=BLOCK_SIZE, ordered=False):
+    """
+    rows of words matrix with Tanimoto similarity to query not less than threshold.
+    rows are compared by full fingerprints only if their bounds on every folded level reach threshold.
+
+    :param levels: list of (size, folded words matrix) pairs from coarse to fine
+    :param ordered: matrix is sorted by popcount. only rows of count_band are screened
+    :return: scores and rows numbers
+    """
+    query_count = int(popcount(query))
+    start, stop = count_band(query_count, threshold, counts) if ordered else (0, len(words))
+    size, folded = levels[0]
+    rows = np.flatnonzero(similarity_bound(fold_masks(query, size), query_count, folded[start:stop],
+                                           counts[start:stop]) >= threshold) + start
+    if len(rows) > (stop - start) * SCAN_RATIO:
+        return within(query, words, threshold, counts, block, ordered)
+    for size, folded in levels[1:]:
+        rows = rows[similarity_bound(fold_masks(query, size), query_count, folded[rows], counts[rows]) >= threshold]
+    scores, rows = _compare(query, words, counts, rows, rows, None, block)
+    found = scores >= threshold
+    return scores[found], rows[found]
+
+
+def cascade_superset(query, words, levels, counts=None, block=BLOCK_SIZE):
+    """
+    rows of words matrix which have all bits of query set. folded fingerprint of superstructure
+    contains folded query, so rows are screened by folded levels first.
+
+    :param levels: list of (size, folded words matrix) pairs from coarse to fine
+    :param counts: popcounts of matrix sorted rows. rows with less bits than query are skipped
+    """
+    first = 0 if counts is None else int(np.searchsorted(counts, popcount(query), 'left'))
+    size, folded = levels[0]
+    rows = superset_rows(fold(query, size), folded[first:], block) + first
+    for size, folded in levels[1:]:
+        q = fold(query, size)
+        rows = rows[((folded[rows] & q) == q).all(axis=1)]
+    return rows[((words[rows] & query) == query).all(axis=1)]
+
+
+def _compare(query, words, counts, labels, rows, k, block):
+    """
+    exact similarities of given rows by blocks.
+
+    :param k: number of best rows to keep. all rows are kept in rows order if None
+    """
+    best = (np.empty(0), np.empty(0, dtype=np.int64))
+    scores = []
+    for start in range(0, len(rows), block):
+        r = rows[start:start + block]
+        s = tanimoto(query, words[r], counts[r])
+        if k is None:
+            scores.append(s)
+        else:
+            s, l = select_top(s, labels[r], k)
+            best = select_top(np.concatenate((best[0], s)), np.concatenate((best[1], l)), k)
+    if k is None:
+        return (np.concatenate(scores) if scores else np.empty(0)), np.asarray(labels)
+    return best
@@ -1,42 +1,376 @@
 import numpy as np
 import pickle
 from sklearn.neighbors import BallTree
-from pony.orm import select
-from MARS.models import Molecules, Reactions
-from os import path
+from pony.orm import select, count
+from MARS.models import Molecules, Reactions, MAX_PARAMS, get_db_identity, get_generation
+from MARS.files.Zulfia import fingerprints_from_bytes, as_words
+from MARS.files.Tanimoto import popcount, top_k_batch, select_top, merge_top, superset_rows, within, \
+    cascade_top_k, cascade_within, cascade_superset
+from MARS.files.IndexFile import ShardedIndex, FingerprintIndex, DeltaIndex, IndexFormatError, write_shards, \
+    append_delta
+from MARS.files.Profile import profiler, timed
+from MARS.config import FINGERPRINT_SIZES, FOLDED_SIZES
+from concurrent.futures import ThreadPoolExecutor
+from os import path, remove
 
 dump_dir = '.'
+ENGINES = ('popcount', 'balltree')
+COMPACT_RATIO = .1
+
+
+@timed('sql_fingerprints')
+def load_fingerprints(data):
+    """
+    fingerprints of all entities in DB as uint8 matrix and list of their ids in ascending order
+    """
+    fps = []
+    ids = []
+    for fp, i in select((s.fingerprint, s.id) for s in data).order_by(2):
+        fps.append(fp)
+        ids.append(i)
+    fps = fingerprints_from_bytes(fps, FINGERPRINT_SIZES[data.__name__])
+    if fps.shape[1] * 8 != FINGERPRINT_SIZES[data.__name__]:
+        raise ValueError('%s fingerprints in DB have %d bits, configured %d. run refingerprint' %
+                         (data.__name__, fps.shape[1] * 8, FINGERPRINT_SIZES[data.__name__]))
+    return fps, ids
+
+
+def index_state(data):
+    """
+    state of DB, for which index of entity is built: identity of DB, fingerprint size and generation of DB content
+    """
+    return dict(db=get_db_identity(), bits=FINGERPRINT_SIZES[data.__name__], generation=get_generation())
+
+
+def is_stale(built, state, generation=0):
+    """
+    check that index built for DB state doesn't match current state
+
+    :param built: state of index or None for index of old format
+    :param generation: generation of the last incremental update of index
+    """
+    if not built or built['db'] != state['db']:
+        print('Index will be rebuilt: it was built for other database')
+    elif built['bits'] != state['bits']:
+        print('Index will be rebuilt: it has %d bits fingerprints, configured %d' % (built['bits'], state['bits']))
+    elif max(built['generation'], generation) != state['generation']:
+        print('Index will be rebuilt: it was built for generation %d of database, current is %d' %
+              (max(built['generation'], generation), state['generation']))
+    else:
+        return False
+    return True
+
+
+def materialize(data, results):
+    """
+    replace ids of search results by entities and similarities by distances.
+    entities are loaded from DB by one query per MAX_PARAMS ids.
+
+    :param results: list of (similarities, ids) pairs
+    :return: list of (distances, entities) pairs
+    """
+    ids = list(set(int(x) for _, found in results for x in found))
+    entities = {}
+    with profiler.stage('materialize', len(ids)):
+        for start in range(0, len(ids), MAX_PARAMS):
+            batch = ids[start:start + MAX_PARAMS]
+            entities.update((s.id, s) for s in select(s for s in data if s.id in batch))
+    return [(1 - scores, [entities[int(x)] for x in found]) for scores, found in results]
 
 
 class TreeIndex(object):
+    """
+    fingerprints index of Molecules or Reactions.
+
+    popcount engine keeps index split into shards by id ranges. queries are sent to all shards
+    in thread pool of jobs size and per-shard hits are merged, so results don't depend on shards number.
+    index is built with jobs shards; use reindex to change shards number of existing index.
+
+    index keeps identity of DB, fingerprint size and generation of DB content it was built for.
+    index built for other DB, fingerprints or generation is rebuilt. update advances generation of index.
+    """
+    @timed('index_load')
+    def __init__(self, data, reindex=False, engine='popcount', dump_path=dump_dir, jobs=1):
+        if engine not in ENGINES:
+            raise ValueError('unknown engine: %s' % engine)
+
+        self.__data = data
+        self.__engine = engine
+        self.__pool = ThreadPoolExecutor(jobs) if jobs > 1 else None
+        rows = count(s for s in data)
+        state = index_state(data)
 
-    def __init__(self, data, reindex=False):
-        data_path = path.join(dump_dir, '%s.bin' % data.__name__)
+        if engine == 'balltree':
+            data_path = path.join(dump_path, '%s.bin' % data.__name__)
+            if not reindex and path.exists(data_path):
+                with open(data_path, 'rb') as f:
+                    dump = pickle.load(f)
+                # dumps of old format have no state
+                tree, ids, built = dump if len(dump) == 3 else dump + (None,)
+                delta = self.__open_delta(data, dump_path, max(ids, default=0))
+                reindex = is_stale(built, state, delta.generation if delta else 0) or \
+                    self.__is_stale(len(ids) + (delta.size if delta else 0), rows)
 
-        if reindex or not path.exists(data_path):
-            a = []
-            ids = []
-            for fp, i in select((s.fingerprint, s.id) for s in data):
-                by_x = np.unpackbits(np.fromstring(fp, dtype=np.uint8))
-                a.append(by_x)
-                ids.append(i)
+            if reindex or not path.exists(data_path):
+                fps, ids = load_fingerprints(data)
+                # BallTree can't be built on empty table
+                tree = BallTree(np.unpackbits(fps, axis=1).astype(bool), metric='jaccard') if ids else None
+                with open(data_path, 'wb') as f:
+                    pickle.dump((tree, ids, state), f)
+                delta = None
 
-            tree = BallTree(np.matrix(a), metric='jaccard')
-            with open(data_path, 'wb') as f:
-                pickle.dump((tree,ids), f)
+            self.__tree = tree
+            self.__ids = ids
+            self.__shards = []
         else:
-            with open(data_path, 'rb') as f:
-                tree, ids = pickle.load(f)
+            index = None
+            if not reindex:
+                index = self.__open(data, dump_path)
+                if index is not None:
+                    delta = self.__open_delta(data, dump_path, index.max_id)
+                    if is_stale(index.state, state, delta.generation if delta else 0) or \
+                            self.__is_stale(index.size + (delta.size if delta else 0), rows):
+                        index = None
 
-        self.__tree = tree
-        self.__data = data
-        self.__ids = ids
+            if index is None:
+                index = self.rebuild(data, dump_path, jobs)
+                delta = None
+
+            self.__shards = index.shards
+
+        self.__delta = delta if delta and delta.size else None
+        self.__segments = self.__shards + ([self.__delta] if self.__delta is not None else [])
+
+    @staticmethod
+    def __is_stale(size, rows):
+        if size != rows:
+            print('Index will be rebuilt: it contains %d entities, database contains %d' % (size, rows))
+            return True
+        return False
+
+    @staticmethod
+    def __open(data, dump_path):
+        manifest_path = path.join(dump_path, '%s.shards.json' % data.__name__)
+        if path.exists(manifest_path):
+            try:
+                return ShardedIndex(manifest_path)
+            except (IndexFormatError, OSError) as e:
+                print('Index will be rebuilt: %s' % e)
+
+    @staticmethod
+    def __open_delta(data, dump_path, min_id):
+        delta_path = path.join(dump_path, '%s.delta.idx' % data.__name__)
+        if path.exists(delta_path):
+            return DeltaIndex(delta_path, min_id, FOLDED_SIZES)
+
+    @classmethod
+    def rebuild(cls, data, dump_path=dump_dir, shards=1):
+        """
+        build index from all entities in DB. delta segment is dropped.
+
+        :param shards: number of index files
+        """
+        fps, ids = load_fingerprints(data)
+        return cls.build(data, ids, fps, dump_path, shards)
+
+    @classmethod
+    @timed('index_build')
+    def build(cls, data, ids, fingerprints, dump_path=dump_dir, shards=1):
+        """
+        build index of given entities instead of entities in DB. delta segment is dropped.
+        index is marked as built for current state of DB.
+
+        :param ids: ids of entities in ascending order
+        :param fingerprints: uint8 fingerprints matrix
+        """
+        words = as_words(fingerprints)
+        manifest_path = path.join(dump_path, '%s.shards.json' % data.__name__)
+        write_shards(manifest_path, ids, words, popcount(words), shards, FOLDED_SIZES, index_state(data))
+
+        delta_path = path.join(dump_path, '%s.delta.idx' % data.__name__)
+        if path.exists(delta_path):
+            remove(delta_path)
+        return ShardedIndex(manifest_path)
+
+    @classmethod
+    @timed('index_update')
+    def update(cls, data, ids, fingerprints, generation, dump_path=dump_dir):
+        """
+        append new entities to delta segment of existing index and advance its generation.
+        big delta is compacted.
+
+        :param ids: ids of committed entities. may be empty, if only other entities are added
+        :param fingerprints: their fingerprints as stored in DB
+        :param generation: generation of DB, in which entities are committed
+        """
+        index = cls.__open(data, dump_path)
+        if index is None:
+            return
+
+        words = as_words(fingerprints_from_bytes(fingerprints, FINGERPRINT_SIZES[data.__name__]))
+        delta_path = path.join(dump_path, '%s.delta.idx' % data.__name__)
+        append_delta(delta_path, ids, words, popcount(words), generation)
+
+        if cls.__open_delta(data, dump_path, index.max_id).size > COMPACT_RATIO * index.size:
+            cls.compact(data, dump_path)
+
+    @classmethod
+    @timed('index_compact')
+    def compact(cls, data, dump_path=dump_dir):
+        """
+        merge delta segment into index. shards are rebalanced, their number is kept.
+        empty delta is kept: it holds generation of index.
+        """
+        index = cls.__open(data, dump_path)
+        if index is None:
+            return
+        delta = cls.__open_delta(data, dump_path, index.max_id)
+        if delta and delta.size:
+            segments = index.shards + [delta]
+            state = index.state and dict(index.state, generation=max(index.state['generation'], delta.generation))
+            write_shards(path.join(dump_path, '%s.shards.json' % data.__name__),
+                         np.concatenate([x.ids for x in segments]),
+                         np.concatenate([x.fingerprints for x in segments]),
+                         np.concatenate([x.counts for x in segments]), len(index.shards), FOLDED_SIZES, state)
+            remove(path.join(dump_path, '%s.delta.idx' % data.__name__))
+
+    def __map(self, function):
+        """
+        apply function to each segment (shards and delta) in thread pool.
+        numpy releases GIL in bitwise operations, so segments are scanned in parallel.
+        """
+        if self.__pool is None or len(self.__segments) < 2:
+            return [function(x) for x in self.__segments]
+        return list(self.__pool.map(function, self.__segments))
+
+    @staticmethod
+    def __no_hits(queries):
+        """
+        empty results of BallTree of empty table or of search of no neighbors
+        """
+        return [(np.empty(0), np.empty(0, dtype=np.int64)) for _ in range(queries)]
 
     def get_similar(self, structure, num):
-        q1 = self.__data.get_fingerprints([structure])
-        by_q = np.unpackbits(np.fromstring(q1[0].bytes, dtype=np.uint8))
-        q = np.matrix([by_q])
-        dist, ind = self.__tree.query(q, k=num)
-        return dist[0], [self.__data[self.__ids[x]] for x in ind[0]]
+        return self.get_similar_batch([structure], num)[0]
+
+    def get_similar_batch(self, structures, num, fears=None):
+        """
+        k nearest entities for each of structures. structures are fingerprinted by one Fragmentor call,
+        hits are loaded from DB by one query per MAX_PARAMS entities.
+
+        :param fears: FEAR strings of structures if already known
+        :return: list of (distances, entities) pairs
+        """
+        return self.get_similar_fingerprints(self.__data.get_fingerprints(structures, fears=fears), num)
+
+    def get_similar_fingerprints(self, q, num):
+        """
+        k nearest entities for each of fingerprints.
+
+        :param q: uint8 fingerprints matrix as returned by get_fingerprints of entity
+        :return: list of (distances, entities) pairs
+        """
+        words = as_words(q)
+        def search(segment):
+            if segment.folded:
+                return [cascade_top_k(x, segment.fingerprints, num, segment.counts, segment.folded, segment.ids)
+                        for x in words]
+            return top_k_batch(words, segment.fingerprints, num, segment.counts, labels=segment.ids)
+
+        with profiler.stage('similarity_search', len(words)):
+            parts = self.__map(search)
+            if self.__engine == 'balltree':
+                if self.__tree is None or num < 1:
+                    parts.append(self.__no_hits(len(words)))
+                else:
+                    dist, ind = self.__tree.query(np.unpackbits(q, axis=1).astype(bool), k=min(num, len(self.__ids)))
+                    ids = np.array(self.__ids, dtype=np.int64)
+                    parts.append([select_top(1 - d, ids[i], num) for d, i in zip(dist, ind)])
+            results = [merge_top(x, num) for x in zip(*parts)]
+
+        return materialize(self.__data, results)
+
+    def get_within(self, structure, threshold):
+        return self.get_within_batch([structure], threshold)[0]
+
+    def get_within_batch(self, structures, threshold, fears=None):
+        """
+        all entities with Tanimoto similarity not less than threshold for each of structures.
+        popcount engine compares only rows with popcounts, which can reach threshold.
+
+        :param fears: FEAR strings of structures if already known
+        :return: list of (distances, entities) pairs. entities are sorted by similarity
+        """
+        return self.get_within_fingerprints(self.__data.get_fingerprints(structures, fears=fears), threshold)
+
+    def get_within_fingerprints(self, q, threshold):
+        """
+        all entities with Tanimoto similarity not less than threshold for each of fingerprints.
+
+        :param q: uint8 fingerprints matrix as returned by get_fingerprints of entity
+        :return: list of (distances, entities) pairs. entities are sorted by similarity
+        """
+        words = as_words(q)
+
+        def search(segment):
+            ordered = isinstance(segment, FingerprintIndex)
+            found = []
+            for x in words:
+                if segment.folded:
+                    scores, ind = cascade_within(x, segment.fingerprints, threshold, segment.counts, segment.folded,
+                                                 ordered=ordered)
+                else:
+                    scores, ind = within(x, segment.fingerprints, threshold, segment.counts, ordered=ordered)
+                found.append(select_top(scores, segment.ids[ind], len(scores)))
+            return found
+
+        with profiler.stage('threshold_search', len(words)):
+            parts = self.__map(search)
+            if self.__engine == 'balltree':
+                if self.__tree is None:
+                    parts.append(self.__no_hits(len(words)))
+                else:
+                    ind, dist = self.__tree.query_radius(np.unpackbits(q, axis=1).astype(bool), r=1 - threshold,
+                                                         return_distance=True)
+                    ids = np.array(self.__ids, dtype=np.int64)
+                    parts.append([select_top(1 - d, ids[i], len(d)) for d, i in zip(dist, ind)])
+            results = [merge_top(x) for x in zip(*parts)]
+
+        return materialize(self.__data, results)
+
+    def get_containing(self, structure):
+        """
+        screen for possible superstructures of structure: ids of entities, fingerprints of which
+        contain all bits of structure fingerprint. works only with popcount engine.
+        ids are sorted.
+        """
+        return self.get_containing_fingerprint(self.__data.get_fingerprints([structure])[0])
+
+    def get_containing_fingerprint(self, fingerprint):
+        """
+        screen for entities, fingerprints of which contain all bits of uint8 fingerprint. ids are sorted.
+        """
+        if self.__engine != 'popcount':
+            raise ValueError('screening requires popcount engine')
+
+        q = as_words(fingerprint)
+        def search(segment):
+            counts = segment.counts if isinstance(segment, FingerprintIndex) else None
+            if segment.folded:
+                return segment.ids[cascade_superset(q, segment.fingerprints, segment.folded, counts)]
+            return segment.ids[superset_rows(q, segment.fingerprints, counts=counts)]
+
+        with profiler.stage('screening'):
+            parts = self.__map(search)
+            return np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+
+    @property
+    def size(self):
+        return sum(x.size for x in self.__segments) + (len(self.__ids) if self.__engine == 'balltree' else 0)
 
-#
\ No newline at end of file
+    @property
+    def version(self):
+        """
+        search method of index. part of result cache keys
+        """
+        return self.__engine
@@ -1,25 +1,81 @@
 from hashlib import md5
-from bitstring import BitArray
-from ..config import ACTIVE_BITS,bs_slice
-
-
-def get_bitstring(descriptors):
-    d = {}
-    result = []
-    for i in descriptors.columns:
-        a = md5(i.encode()).digest()
-        xx = BitArray(a)
-        l = []
-        for j in range(ACTIVE_BITS):
-            s = xx[j*bs_slice:(j+1)*bs_slice].uint
-            l.append(s)
-        d[i] = l
-    for _, i in descriptors.iterrows():
-        hfp = BitArray(2 ** bs_slice)
-        for k, v in i.items():
-            if v:
-                hfp.set(True, d[k])
-        result.append(hfp)
+from functools import lru_cache
+import numpy as np
+from .Profile import timed
+from ..config import ACTIVE_BITS, bs_slice
+
+FINGERPRINT_SIZE = 2 ** bs_slice
+BLOCK_SIZE = 65536
+
+
+@lru_cache(maxsize=None)
+def get_bit_positions(descriptor, size=FINGERPRINT_SIZE):
+    """
+    positions of bits activated by descriptor in fingerprint of size bits. md5 digest is cut into
+    log2(size)-bit big-endian slices, as BitArray(digest)[j*bs_slice:(j+1)*bs_slice].uint did.
+    """
+    slice_size = size.bit_length() - 1
+    if size != 1 << slice_size or slice_size * ACTIVE_BITS > 128:
+        raise ValueError('unsupported fingerprint size: %d' % size)
+    digest = int.from_bytes(md5(descriptor.encode()).digest(), 'big')
+    mask = size - 1
+    return tuple((digest >> (128 - (j + 1) * slice_size)) & mask for j in range(ACTIVE_BITS))
+
+
+@timed('bitstring')
+def get_bitstring(descriptors, size=FINGERPRINT_SIZE):
+    """
+    build fingerprints of all rows of Fragmentor descriptors DataFrame.
+
+    :param size: fingerprint length in bits
+    :return: uint8 matrix of shape (rows, size / 8). row bits are MSB first,
+    so row.tobytes() is equal to BitArray fingerprint .bytes stored in DB.
+    """
+    positions = np.array([get_bit_positions(i, size) for i in descriptors.columns],
+                         dtype=np.intp).reshape(-1, ACTIVE_BITS)
+    values = descriptors.values
+    result = np.empty((len(values), size // 8), dtype=np.uint8)
+    block = max(BLOCK_SIZE * FINGERPRINT_SIZE // size, 1)
+
+    for start in range(0, len(values), block):
+        rows, cols = np.nonzero(values[start:start + block] != 0)
+        bits = np.zeros((min(block, len(values) - start), size), dtype=bool)
+        bits[rows[:, np.newaxis], positions[cols]] = True
+        result[start:start + block] = np.packbits(bits, axis=1)
 
     return result
 
+
+def fingerprints_from_bytes(fingerprints, size=FINGERPRINT_SIZE):
+    """
+    stack fingerprints stored in DB into uint8 matrix
+    """
+    if not fingerprints:
+        return np.empty((0, size // 8), dtype=np.uint8)
+    return np.frombuffer(b''.join(fingerprints), dtype=np.uint8).reshape(len(fingerprints), -1)
+
+
+def as_words(fingerprints):
+    """
+    view uint8 fingerprints matrix as uint64 words. rows are zero padded up to 8 bytes.
+    words are in native byte order, so use them only for bitwise operations.
+    """
+    fingerprints = np.asarray(fingerprints, dtype=np.uint8)
+    if fingerprints.ndim == 1:
+        return as_words(fingerprints[np.newaxis])[0]
+
+    pad = -fingerprints.shape[1] % 8
+    if pad:
+        fingerprints = np.hstack((fingerprints, np.zeros((len(fingerprints), pad), dtype=np.uint8)))
+    return np.ascontiguousarray(fingerprints).view(np.uint64)
+
+
+def fold(words, size):
+    """
+    OR-fold rows of uint64 words matrix into size bits (multiple of 64): bit i goes to bit i mod size.
+    fold of substructure fingerprint is subset of fold of its superstructure fingerprint.
+    """
+    width = size // 64
+    if words.shape[-1] <= width:
+        return words
+    return np.bitwise_or.reduce(words.reshape(words.shape[:-1] + (-1, width)), axis=-2)
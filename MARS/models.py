@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-from pony.orm import Database, PrimaryKey, Required, Set, Json, buffer, left_join, sql_debug, select, commit
+from pony.orm import Database, PrimaryKey, Required, Optional, Set, Json, buffer, left_join, sql_debug, select, commit
 from CGRtools.FEAR import FEAR
 from networkx.readwrite.json_graph import node_link_data, node_link_graph
 from MODtools.descriptors.fragmentor import Fragmentor
@@ -7,67 +7,177 @@ from CGRtools.CGRcore import CGRcore
 from functools import reduce
 from CGRtools.files.SDFrw import MoleculeContainer
 from CGRtools.files.RDFrw import RDFread, ReactionContainer
+from collections import namedtuple
 import networkx as nx
+import sqlite3
+import struct
+import uuid
+from os import path
 from .files.Zulfia import get_bitstring
+from .files.Packing import pack_molecule, unpack_molecule
+from .files.Cache import LRUCache, LazyObject, ResultCache
+from .files.Profile import profiler
+from .files.Fragmentation import FragmentorService, DescriptorCache
+from .config import STRUCTURE_CACHE_SIZE, DESCRIPTOR_CACHE_SIZE, RESULT_CACHE_SIZE, FRAGMENTOR_WORKERS, DB_PATH, \
+    SQL_DEBUG, FINGERPRINT_SIZES
 
 db = Database()
-fear = FEAR()
-cgr_core=CGRcore()
-fragmentor_mol = Fragmentor()
-fragmentor_rct = Fragmentor()
+# chemistry engines are created on first use
+fear = LazyObject(FEAR, stages={'get_cgr_string': 'fear'})
+cgr_core = LazyObject(CGRcore, stages={'getCGR': 'cgr'})
+db_dir = path.dirname(path.abspath(__file__))
+# descriptors caches files are placed next to DB by init_db
+descriptor_cache_mol = DescriptorCache(None, DESCRIPTOR_CACHE_SIZE)
+descriptor_cache_rct = DescriptorCache(None, DESCRIPTOR_CACHE_SIZE)
+fragmentor_mol = FragmentorService(Fragmentor, workers=FRAGMENTOR_WORKERS, cache=descriptor_cache_mol)
+fragmentor_rct = FragmentorService(Fragmentor, workers=FRAGMENTOR_WORKERS, cache=descriptor_cache_rct)
+# decoded Molecules structures by id. shared by all searches
+structure_cache = LRUCache(STRUCTURE_CACHE_SIZE)
+# search results by query FEAR string. file is placed next to DB by init_db
+result_cache = ResultCache(None, RESULT_CACHE_SIZE)
+# max number of values in one IN (...) query. SQLite limits number of parameters
+MAX_PARAMS = 900
+
+# precomputed data of structures passed through ingestion pipeline. data and cgr are node-link data
+MoleculeRecord = namedtuple('MoleculeRecord', ['fear', 'data', 'packed', 'fingerprint'])
+ReactionRecord = namedtuple('ReactionRecord', ['fear', 'cgr', 'fingerprint', 'substrats', 'products'])
 
 class Molecules(db.Entity):
     id = PrimaryKey(int, auto=True)
-    data = Required(Json)
+    data = Required(Json, lazy=True)
+    packed = Optional(bytes)
     fear = Required(str, unique=True)
     fingerprint = Required(bytes)
     reactions = Set('ReactionsMolecules')
 
-    def __init__(self, molecule, fingerprint=None):
-        fear_str = self.get_fear(molecule)
-        data = node_link_data(molecule)
+    def __init__(self, molecule=None, fingerprint=None, fear_string=None, data=None, packed=None):
+        """
+        fingerprint, fear_string, node-link data and packed structure are computed from molecule if not given
+        """
+        fear_str = self.get_fear(molecule) if fear_string is None else fear_string
+        if data is None:
+            data = node_link_data(molecule)
+        if packed is None:
+            packed = self.get_packed(data)
 
         if fingerprint is None:
             fingerprint = self.get_fingerprints([molecule])[0]
 
-        super(Molecules,self).__init__(data=data, fear=fear_str, fingerprint=fingerprint.bytes)
+        super(Molecules,self).__init__(data=data, packed=packed, fear=fear_str, fingerprint=fingerprint.tobytes())
 
     @staticmethod
     def get_molecule(molecule):
-        return Molecules.get(fear=fear.get_cgr_string(Molecules))
+        return Molecules.get(fear=Molecules.get_fear(molecule))
 
     @staticmethod
-    def get_fingerprints(molecules):
-        dataframe = fragmentor_mol.get(molecules)['X']
-        return get_bitstring(dataframe)
+    def get_fingerprints(molecules, fears=None):
+        """
+        :param fears: FEAR strings of molecules if already known. used as descriptors cache keys
+        """
+        if fears is None:
+            fears = [Molecules.get_fear(x) for x in molecules]
+        dataframe = fragmentor_mol.get(molecules, fears)
+        return get_bitstring(dataframe, FINGERPRINT_SIZES['Molecules'])
 
     @staticmethod
     def get_fear(molecule):
         return fear.get_cgr_string(molecule)
 
-    @property
-    def structure(self):
-        molcont = node_link_graph(self.data)
+    @staticmethod
+    def get_packed(data):
+        """
+        compact binary form of node-link data. None for graphs, which can't be packed.
+        """
+        try:
+            return pack_molecule(data)
+        except (TypeError, ValueError, struct.error):
+            return None
+
+    @staticmethod
+    def decode(packed, data=None):
+        if packed is not None:
+            return unpack_molecule(packed)
+        molcont = node_link_graph(data)
         molcont.__class__ = MoleculeContainer
         return molcont
 
+    @staticmethod
+    def get_structures(ids):
+        """
+        structures of molecules by ids. not cached structures are loaded by set-based queries.
+
+        :return: dict of id: MoleculeContainer
+        """
+        result = {}
+        missing = []
+        for i in set(ids):
+            molcont = structure_cache.get(i)
+            if molcont is None:
+                missing.append(i)
+            else:
+                result[i] = molcont
+        profiler.count('structure_cache_hits', len(result))
+        profiler.count('structure_cache_misses', len(missing))
+
+        for start in range(0, len(missing), MAX_PARAMS):
+            batch = missing[start:start + MAX_PARAMS]
+            with profiler.stage('sql_structures', len(batch)):
+                packed = dict(select((m.id, m.packed) for m in Molecules if m.id in batch))
+                unpacked = [i for i, x in packed.items() if x is None]
+                data = dict(select((m.id, m.data) for m in Molecules if m.id in unpacked)) if unpacked else {}
+            for i, x in packed.items():
+                result[i] = molcont = Molecules.decode(x, data.get(i))
+                structure_cache.put(i, molcont)
+
+        return {i: x.copy() for i, x in result.items()}
+
+    @property
+    def structure(self):
+        molcont = structure_cache.get(self.id)
+        if molcont is None:
+            molcont = self.decode(self.packed, None if self.packed is not None else self.data)
+            structure_cache.put(self.id, molcont)
+        return molcont.copy()
+
 
 class Reactions(db.Entity):
     id = PrimaryKey(int, auto=True)
     fear = Required(str, unique=True)
     fingerprint = Required(bytes) #Boris: changed buffer to bytes
+    # node-link data of CGR. stored at ingestion, because links don't keep atoms mapping of reaction
+    cgr = Optional(Json, lazy=True, nullable=True)
     molecules = Set('ReactionsMolecules', cascade_delete=True)
 
     #Таблица реакиц это просто запись, что там нужно делать, к ней нужно подключить таблицу молекул, а была ли такая молекула в таблице молекул
     # если нет то добавить с марингом и изоморфным вложение и указанием роли. ИМ чтобы выяснить. МАР - словарь превратить в словарь цифр, пар столько сколько и атомов лист имеет четкое число элементов.
     #добавление объектов мэни ту мэни в пони
-    def __init__(self, reaction, fingerprint=None):
-        tempfear = Reactions.get_fear(reaction)
+    def __init__(self, reaction=None, fingerprint=None, fear_string=None, substrats=None, products=None,
+                 cgr=None):
+        """
+        fingerprint, fear_string and cgr are computed from reaction if not given. cgr is node-link data of CGR.
+        substrats and products are lists of MoleculeRecord. if given, molecules of reaction are not used.
+        """
+        reaction_cgr = None
+        if reaction is not None and (fear_string is None or fingerprint is None or cgr is None):
+            reaction_cgr = cgr_core.getCGR(reaction)
+        tempfear = fear.get_cgr_string(reaction_cgr) if fear_string is None else fear_string
         # Boris: deleted entity check, cause it's supposed to be done outside of the class
         if fingerprint is None:  # Boris: added situation when FP is None
-            fingerprint = self.get_fingerprints([reaction])[0]
-
-        super(Reactions,self).__init__(fear=tempfear, fingerprint=fingerprint.bytes) # Boris: swapped Reactions and self
+            fingerprint = self.get_cgr_fingerprints([reaction_cgr], [tempfear])[0]
+        if cgr is None and reaction_cgr is not None:
+            cgr = node_link_data(reaction_cgr)
+
+        super(Reactions,self).__init__(fear=tempfear, fingerprint=fingerprint.tobytes(), cgr=cgr) # Boris: swapped Reactions and self
+
+        if substrats is not None and products is not None:
+            for is_product, records in ((False, substrats), (True, products)):
+                for record in records:
+                    molecule = Molecules.get(fear=record.fear)
+                    if not molecule:
+                        molecule = Molecules(fingerprint=record.fingerprint, fear_string=record.fear,
+                                             data=record.data, packed=record.packed)
+                    ReactionsMolecules(molecule=molecule, reaction=self, product=is_product, mapping=dict([]))
+            return
 
         for molecs in reaction.substrats:
             tempfearm1 = Molecules.get_fear(molecs)
@@ -92,15 +202,54 @@ class Reactions(db.Entity):
             ReactionsMolecules(molecule=molecule, reaction=self, product=True, mapping=dict([]))
 
     @staticmethod
-    def get_fingerprints(reactions, get_cgr=False):
+    def get_fingerprints(reactions, get_cgr=False, fears=None):
+        """
+        :param fears: FEAR strings of reactions if already known. used as descriptors cache keys
+        """
         cgrs = []
         for reaction in reactions:
             cgr = cgr_core.getCGR(reaction)
             cgrs.append(cgr)
 
-        dataframe = fragmentor_rct.get(cgrs)['X']
+        fingerprints = Reactions.get_cgr_fingerprints(cgrs, fears)
+        return (fingerprints, cgrs) if get_cgr else fingerprints
+
+    @staticmethod
+    def get_cgr_fingerprints(cgrs, fears=None):
+        """
+        fingerprints of CGRs. FEAR strings of CGRs are computed if not given
+        """
+        if fears is None:
+            fears = [fear.get_cgr_string(x) for x in cgrs]
+        dataframe = fragmentor_rct.get(cgrs, fears)
+        return get_bitstring(dataframe, FINGERPRINT_SIZES['Reactions'])
+
+    @staticmethod
+    def get_cgrs(ids):
+        """
+        CGRs stored at ingestion by ids. reactions loaded before CGRs were stored are missing.
+
+        :return: dict of id: CGR
+        """
+        ids = list(set(int(x) for x in ids))
+        result = {}
+        for start in range(0, len(ids), MAX_PARAMS):
+            batch = ids[start:start + MAX_PARAMS]
+            with profiler.stage('sql_cgrs', len(batch)):
+                for i, data in select((r.id, r.cgr) for r in Reactions if r.id in batch):
+                    if data is not None:
+                        # CGR is graph of the same container class as molecules
+                        result[i] = Molecules.decode(None, data)
+        return result
 
-        return (get_bitstring(dataframe), cgrs) if get_cgr else get_bitstring(dataframe)
+    @staticmethod
+    def count_without_cgr():
+        """
+        number of reactions loaded before CGRs were stored
+        """
+        cursor = db.get_connection().cursor()
+        cursor.execute('SELECT COUNT(*) FROM "%s" WHERE "%s" IS NULL' % (Reactions._table_, Reactions.cgr.column))
+        return cursor.fetchone()[0]
 
     @staticmethod
     def get_reaction(reaction):
@@ -109,39 +258,68 @@ class Reactions(db.Entity):
 
     @staticmethod
     def get_reactions_by_molecule(molecule, product=None):
+        molecule_fear = Molecules.get_fear(molecule)
         if product is None:
-            q = left_join(
-                rs.reaction for m in Molecules if m.fear == fear.get_cgr_string(molecule) for rs in m.reactions)
+            q = left_join(rs.reaction for m in Molecules if m.fear == molecule_fear for rs in m.reactions)
         else:
-            q = left_join(rs.reaction for m in Molecules if m.fear == fear.get_cgr_string(molecule) for rs in m.reactions if
+            q = left_join(rs.reaction for m in Molecules if m.fear == molecule_fear for rs in m.reactions if
                           rs.product == product)
         return list(q)
 
     @staticmethod
-    def get_reactions_by_molecules(molecule, product=None, reagent=None):
+    def get_reactions_by_molecules(product=None, reagent=None):
+        """
+        reactions, which contain all given products and reagents.
+        RoleIndex answers the same question without joins.
+        """
         d = dict()
-        if product is not None:
-            for i in product:
-                d[fear.get_cgr_string(molecule)] = set()
-            for m, r in left_join(
-                    (m.fear, r) for m in Molecules if m.fear in [fear.get_cgr_string(x) for x in product] for rs in
-                    m.reactions if rs.product for r in rs.reactions):
-                d[m].add(r)
-
-        if reagent is not None:
-            for i in reagent:
-                d[fear.get_cgr_string(molecule)] = set()
-            for m, r in left_join(
-                    (m.fear, r) for m in Molecules if m.fear in [fear.get_cgr_string(x) for x in reagent] for rs in
-                    m.reactions if not rs.product for r in rs.reactions):
-                d[m].add(r)
-
-        return reduce(set.intersection, d.values())
+        for is_product, molecules in ((True, product), (False, reagent)):
+            if molecules is None:
+                continue
+            fears = [Molecules.get_fear(x) for x in molecules]
+            for f in fears:
+                d[(is_product, f)] = set()
+            for m, r in left_join((m.fear, rs.reaction) for m in Molecules if m.fear in fears
+                                  for rs in m.reactions if rs.product == is_product):
+                d[(is_product, m)].add(r)
+
+        return reduce(set.intersection, d.values()) if d else set()
 
     @staticmethod
     def get_fear(reaction):
         return fear.get_cgr_string(cgr_core.getCGR(reaction))
 
+    @staticmethod
+    def get_structures(ids):
+        """
+        materialize reactions by ids. participants links and molecules are loaded by set-based
+        queries for all reactions at once.
+
+        :return: generator of ReactionContainers in order of ids
+        """
+        ids = [int(x) for x in ids]
+        unique = list(set(ids))
+        links = {}
+        for start in range(0, len(unique), MAX_PARAMS):
+            batch = unique[start:start + MAX_PARAMS]
+            with profiler.stage('sql_links', len(batch)):
+                for _, r, m, product, mapping in select((rm.id, rm.reaction.id, rm.molecule.id, rm.product,
+                                                         rm.mapping) for rm in ReactionsMolecules
+                                                        if rm.reaction.id in batch).order_by(1):
+                    links.setdefault(r, []).append((m, product, mapping))
+
+        molecules = Molecules.get_structures(m for x in links.values() for m, _, _ in x)
+        for i in ids:
+            products = []
+            substrats = []
+            for m, product, mapping in links.get(i, []):
+                molcont = nx.relabel_nodes(molecules[m], dict(mapping))
+                if product:
+                    products.append(molcont)
+                else:
+                    substrats.append(molcont)
+            yield ReactionContainer(products=products, substrats=substrats)
+
     @property
     def structure(self):
         products = []
@@ -163,7 +341,79 @@ class ReactionsMolecules(db.Entity):
     mapping = Required(Json)
 
 
-db.bind("sqlite", "datatest.db")
-db.generate_mapping(create_tables=True)
-sql_debug(True)
+def migrate_schema(filename):
+    """
+    add columns introduced after database was created and random identity of database
+    """
+    con = sqlite3.connect(filename)
+    try:
+        columns = [x[1] for x in con.execute('PRAGMA table_info("Molecules")')]
+        if columns and 'packed' not in columns:
+            con.execute('ALTER TABLE "Molecules" ADD COLUMN "packed" BLOB')
+            con.commit()
+        columns = [x[1] for x in con.execute('PRAGMA table_info("Reactions")')]
+        if columns and 'cgr' not in columns:
+            con.execute('ALTER TABLE "Reactions" ADD COLUMN "cgr" TEXT')
+            con.commit()
+        # distinguishes DB from other DBs created at the same path
+        con.execute('CREATE TABLE IF NOT EXISTS "Identity" ("token" TEXT NOT NULL)')
+        if not con.execute('SELECT COUNT(*) FROM "Identity"').fetchone()[0]:
+            con.execute('INSERT INTO "Identity" ("token") VALUES (?)', (uuid.uuid4().hex,))
+        con.commit()
+    finally:
+        con.close()
+
+
+
+def init_db(filename=None):
+    """
+    bind DB, migrate its schema and create missing tables. only the first call binds DB.
+
+    :param filename: SQLite file. relative path is resolved against working directory.
+    DB_PATH from config is used by default, it's resolved against MARS package directory
+    """
+    if db.provider is not None:
+        return
+    filename = path.join(db_dir, DB_PATH) if filename is None else path.abspath(filename)
+    migrate_schema(filename)
+    db.bind("sqlite", filename, create_db=True)
+    db.generate_mapping(create_tables=True)
+    sql_debug(SQL_DEBUG)
+    result_cache.file_path = '%s.results' % filename
+    descriptor_cache_mol.file_path = '%s.descriptors_mol' % filename
+    descriptor_cache_rct.file_path = '%s.descriptors_rct' % filename
+
+
+def get_generation():
+    """
+    generation of DB content. it's kept in SQLite user_version and is incremented by every transaction,
+    which changes searched data, so results of older generations are stale
+    """
+    cursor = db.get_connection().cursor()
+    cursor.execute('PRAGMA user_version')
+    return cursor.fetchone()[0]
+
+
+def get_db_identity():
+    """
+    random token of DB created with it. DBs recreated at the same path have different tokens
+    """
+    cursor = db.get_connection().cursor()
+    cursor.execute('SELECT "token" FROM "Identity"')
+    return cursor.fetchone()[0]
+
+
+def get_db_version():
+    """
+    identity of DB and generation of its content. cached search results are valid for one version only
+    """
+    return '%s.%d' % (get_db_identity(), get_generation())
+
+
+def bump_generation():
+    """
+    start new generation of DB content in current transaction
+    """
+    db.get_connection().cursor().execute('PRAGMA user_version = %d' % (get_generation() + 1))
+
 
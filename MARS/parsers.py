@@ -1,12 +1,42 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-from .CLI.main_structure_search import structure_reaction_search_core
-from .CLI.main_structure_search import structure_molecule_search_core
-from .CLI.main_substructure_search import substructure_search_core
-from .CLI.main_similarity_search import similarity_search_reactions_core
-from .CLI.main_similarity_search import similarity_search_molecules_core
-from .CLI.main_fill_database import fill_database_core
+from importlib import import_module
+from .config import LSH_BANDS, LSH_ROWS
+
+
+def handler(module, function, bind=True):
+    """
+    subcommand function. CLI module with its dependencies is imported and DB is bound
+    only when subcommand is run, so parsing and help don't pay for them.
+    subcommand is run with profiling options.
+
+    :param bind: subcommand works with DB
+    """
+    def run(**kwargs):
+        profile = import_module('.files.Profile', __package__)
+        if kwargs.get('profile'):
+            profile.profiler.enable()
+        with profile.profiler.stage('startup'):
+            core = getattr(import_module('.CLI.%s' % module, __package__), function)
+            if bind:
+                import_module('.models', __package__).init_db(kwargs['db'])
+        return profile.run(core, kwargs)
+    return run
+
+
+def positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError('%d is not positive' % value)
+    return value
+
+
+def similarity(value):
+    value = float(value)
+    if not 0 < value <= 1:
+        raise argparse.ArgumentTypeError('%s is not in (0, 1]' % value)
+    return value
 
 
 def structure_search_molecules(subparsers):
@@ -21,8 +51,16 @@ def structure_search_molecules(subparsers):
 
     parser.add_argument("--reagent", "-re", action = 'store_true', help="Use this if you are"
                                     " looking for reactions, in which your molecule is a reagent(DO NOT WRITE ANY ARGS)")
+    parser.add_argument("--intersect", "-in", action='store_true',
+                        help='Find reactions, which contain all input molecules instead of each of them')
+    parser.add_argument("--with-products", "-wp", default=None, type=argparse.FileType('r'),
+                        help='SDF file of molecules, which must be products of found reactions. implies --intersect')
+    parser.add_argument("--treepath", "-tp", default=".", type=str, help='Directory of index files')
+    parser.add_argument("--rebuild", '-rb', action='store_true', help='Use this if want to rebuild your index')
+    parser.add_argument("--no-cache", "-nc", action='store_true',
+                        help='Search every structure instead of taking results of repeated queries from result cache')
 
-    parser.set_defaults(func=structure_molecule_search_core)
+    parser.set_defaults(func=handler('main_structure_search', 'structure_molecule_search_core'))
 
 
 def structure_search_reactions(subparsers):
@@ -34,8 +72,25 @@ def structure_search_reactions(subparsers):
                         help="RDF file containing needed reactions")
     parser.add_argument("--enclosure", '-en',action = 'store_true',help = 'Use this if you want '
                                     'to use advanced non-hash reaction search ' )
+    parser.add_argument("--chunksize", "-cs", type=int, default=100,
+                        help='Number of reactions looked up by one query in simple hash-search')
+    parser.add_argument("--treepath", "-tp", default=".", type=str, help='Directory of similarity index files')
+    parser.add_argument("--rebuild", '-rb', action='store_true', help='Use this if want to rebuild your index')
+
+    parser.set_defaults(func=handler('main_structure_search', 'structure_reaction_search_core'))
 
-    parser.set_defaults(func=structure_reaction_search_core)
+
+def approximate_options(parser):
+    parser.add_argument("--approximate", "-ap", action='store_true',
+                        help='Search candidates in MinHash LSH index and rank them by Tanimoto index. '
+                             'Much faster on very large databases, but some similar structures can be missed')
+    parser.add_argument("--bands", "-b", type=int, default=LSH_BANDS,
+                        help='Number of LSH bands. More bands give better recall and slower search')
+    parser.add_argument("--band-rows", "-br", type=int, default=LSH_ROWS,
+                        help='Number of MinHash values in LSH band. More rows give faster search and worse recall')
+    parser.add_argument("--evaluate", "-ev", action='store_true',
+                        help='With --approximate also run exact search and print recall of approximate search '
+                             'and time of both searches')
 
 
 def similarity_search_reactions(subparsers):
@@ -47,11 +102,24 @@ def similarity_search_reactions(subparsers):
                         help="RDF inputfile")
     parser.add_argument("--output", "-o", default="output.rdf", type=argparse.FileType('w'),
                         help="RDFile containing similar reactions with Tanimoto Index as property.")
-    parser.add_argument("--treepath","-tp", default="C://", type=str, help='Path to BallTree')
-    parser.add_argument("--rebuild",'-rb', action='store_true', help='Use this if want to rebuild your BallTree')
-    parser.add_argument("--number","-n", type=int, default=10, help='Number of similar reactions, that you want to get')
+    parser.add_argument("--treepath", "-tp", default=".", type=str, help='Directory of similarity index files')
+    parser.add_argument("--rebuild", '-rb', action='store_true', help='Use this if want to rebuild your index')
+    parser.add_argument("--number","-n", type=positive_int, default=10,
+                        help='Number of similar reactions, that you want to get')
+    parser.add_argument("--engine", "-e", default='popcount', choices=('popcount', 'balltree'),
+                        help='Similarity search backend: packed fingerprints popcount scan or BallTree')
+    parser.add_argument("--chunksize", "-cs", type=int, default=1000,
+                        help='Number of input structures searched at once')
+    parser.add_argument("--threshold", "-t", type=similarity, default=None,
+                        help='Find all structures with Tanimoto index not less than threshold instead of top number')
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help='Number of threads searching index shards. '
+                             'Index is built with this number of shards; use --rebuild to reshard existing index')
+    approximate_options(parser)
+    parser.add_argument("--no-cache", "-nc", action='store_true',
+                        help='Search every structure instead of taking results of repeated queries from result cache')
 
-    parser.set_defaults(func=similarity_search_reactions_core)
+    parser.set_defaults(func=handler('main_similarity_search', 'similarity_search_reactions_core'))
 
 
 def similarity_search_molecules(subparsers):
@@ -63,12 +131,24 @@ def similarity_search_molecules(subparsers):
                         help="SDF inputfile")
     parser.add_argument("--output", "-o", default="output.sdf", type=argparse.FileType('w'),
                         help="SDFile containing similar molecules with Tanimoto Index as property.")
-    parser.add_argument("--treepath", "-tp", default="C:\\MARS", type=str, help='Path to BallTree')
-    parser.add_argument("--rebuild", '-rb', action='store_true', help='Use this if want to rebuild your BallTree')
-    parser.add_argument("--number", "-n", type=int, default=10,
+    parser.add_argument("--treepath", "-tp", default=".", type=str, help='Directory of similarity index files')
+    parser.add_argument("--rebuild", '-rb', action='store_true', help='Use this if want to rebuild your index')
+    parser.add_argument("--number", "-n", type=positive_int, default=10,
                         help='Number of similar molecules, that you want to get')
+    parser.add_argument("--engine", "-e", default='popcount', choices=('popcount', 'balltree'),
+                        help='Similarity search backend: packed fingerprints popcount scan or BallTree')
+    parser.add_argument("--chunksize", "-cs", type=int, default=1000,
+                        help='Number of input structures searched at once')
+    parser.add_argument("--threshold", "-t", type=similarity, default=None,
+                        help='Find all structures with Tanimoto index not less than threshold instead of top number')
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help='Number of threads searching index shards. '
+                             'Index is built with this number of shards; use --rebuild to reshard existing index')
+    approximate_options(parser)
+    parser.add_argument("--no-cache", "-nc", action='store_true',
+                        help='Search every structure instead of taking results of repeated queries from result cache')
 
-    parser.set_defaults(func=similarity_search_molecules_core)
+    parser.set_defaults(func=handler('main_similarity_search', 'similarity_search_molecules_core'))
 
 
 def substructure_search(subparsers):
@@ -76,12 +156,17 @@ def substructure_search(subparsers):
                                    help=' Subsctructure search.This one searches Molecules with'
                                         ' certain fragment in their structure ',
                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument("--input", "-i", default="input.rdf", type=argparse.FileType('r'),
-                        help="RDF inputfile")
+    parser.add_argument("--input", "-i", default="input.sdf", type=argparse.FileType('r'),
+                        help="SDF inputfile with fragments")
     parser.add_argument("--output", "-o", default="output.txt", type=argparse.FileType('w'),
-                        help="Indexes of Molecules with needed fragment in database")
+                        help="Indexes of Molecules with needed fragment in database: "
+                             "fragment number and molecule id per line")
+    parser.add_argument("--treepath", "-tp", default=".", type=str, help='Directory of similarity index files')
+    parser.add_argument("--rebuild", '-rb', action='store_true', help='Use this if want to rebuild your index')
+    parser.add_argument("--workers", "-w", type=int, default=1,
+                        help='Number of processes checking graph isomorphism')
 
-    parser.set_defaults(func=substructure_search_core)
+    parser.set_defaults(func=handler('main_substructure_search', 'substructure_search_core'))
 
 
 def fill_database(subparsers):
@@ -91,5 +176,93 @@ def fill_database(subparsers):
     parser.add_argument("--input", "-i", default="input.rdf", type=argparse.FileType('r'),
                         help="RDF inputfile")
     parser.add_argument("--chunksize","-cs",type=int, default =100, help='RDFread portion size')
+    parser.add_argument("--treepath", "-tp", default=".", type=str, help='Directory of similarity index files')
+    parser.add_argument("--compact", '-cm', action='store_true',
+                        help='Merge new entities into similarity index files after filling')
+    parser.add_argument("--workers", "-w", type=int, default=1,
+                        help='Number of processes computing FEAR strings, CGRs and fingerprints')
+    parser.add_argument("--resume", '-rs', action='store_true',
+                        help='Continue loading from the last committed chunk saved in checkpoint')
+    parser.add_argument("--checkpoint", "-cp", default=None, type=str,
+                        help='Checkpoint file. Default is input file name with .checkpoint suffix')
+
+    parser.set_defaults(func=handler('main_fill_database', 'fill_database_core'))
+
+
+def migrate_database(subparsers):
+    parser = subparsers.add_parser('migrate',
+                                   help=' This utility fills columns added in new versions for existing entities ',
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--chunksize", "-cs", type=int, default=1000, help='Number of entities updated in one transaction')
+
+    parser.set_defaults(func=handler('main_migrate', 'migrate_core'))
+
+
+def serve(subparsers):
+    parser = subparsers.add_parser('serve', help='Search server, which keeps DB and similarity indexes loaded',
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1", type=str, help='Listened address')
+    parser.add_argument("--port", "-p", default=8765, type=int, help='Listened port')
+    parser.add_argument("--socket", "-s", default=None, type=str, help='Listen unix socket instead of TCP port')
+    parser.add_argument("--workers", "-w", type=int, default=0,
+                        help='Number of search processes. 0 for number of CPUs')
+    parser.add_argument("--treepath", "-tp", default=".", type=str, help='Directory of similarity index files')
+    parser.add_argument("--rebuild", '-rb', action='store_true', help='Use this if want to rebuild your index')
+    parser.add_argument("--engine", "-e", default='popcount', choices=('popcount', 'balltree'),
+                        help='Similarity index engine')
+    parser.add_argument("--jobs", "-j", type=int, default=1, help='Number of threads searching index shards')
+
+    parser.set_defaults(func=handler('main_server', 'serve_core'))
+
+
+def query(subparsers):
+    parser = subparsers.add_parser('query', help='Send search to running MARS server',
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("command", choices=('similar_mol', 'similar_react', 'struct_mol'), help='Search type')
+    parser.add_argument("--input", "-i", default="input.sdf", type=argparse.FileType('r'),
+                        help="SDF file of molecules or RDF file of reactions")
+    parser.add_argument("--output", "-o", default="output.sdf", type=argparse.FileType('w'),
+                        help="SDF or RDF output file")
+    parser.add_argument("--host", default="127.0.0.1", type=str, help='Server address')
+    parser.add_argument("--port", "-p", default=8765, type=int, help='Server port')
+    parser.add_argument("--socket", "-s", default=None, type=str, help='Server unix socket')
+    parser.add_argument("--number", "-n", type=positive_int, default=10, help='Number of similar structures')
+    parser.add_argument("--threshold", "-t", type=similarity, default=None,
+                        help='Find all structures with Tanimoto index not less than threshold instead of top number')
+    parser.add_argument("--product", "-pr", action='store_true', help='struct_mol: molecule is product')
+    parser.add_argument("--reagent", "-re", action='store_true', help='struct_mol: molecule is reagent')
+    parser.add_argument("--chunksize", "-cs", type=int, default=100,
+                        help='Number of input structures searched by one server worker at once')
+
+    parser.set_defaults(func=handler('main_query', 'query_core', bind=False))
+
+
+def refingerprint(subparsers):
+    parser = subparsers.add_parser('refingerprint',
+                                   help='Recompute fingerprints of DB after change of fingerprint configuration',
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--chunksize", "-cs", type=int, default=1000,
+                        help='Number of entities updated in one transaction')
+    parser.add_argument("--treepath", "-tp", default=".", type=str, help='Directory of similarity index files')
+    parser.add_argument("--jobs", "-j", type=int, default=1, help='Number of shards of rebuilt indexes')
+
+    parser.set_defaults(func=handler('main_refingerprint', 'refingerprint_core'))
+
+
+def export_database(subparsers):
+    parser = subparsers.add_parser('export', help='Dump DB into columnar snapshot file',
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--output", "-o", default="mars.snapshot", type=str, help='Snapshot file')
+    parser.add_argument("--chunksize", "-cs", type=int, default=10000, help='Number of rows in snapshot chunk')
+
+    parser.set_defaults(func=handler('main_snapshot', 'export_core'))
+
+
+def import_database(subparsers):
+    parser = subparsers.add_parser('import', help='Load snapshot file into empty DB and build similarity indexes',
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--input", "-i", default="mars.snapshot", type=str, help='Snapshot file')
+    parser.add_argument("--treepath", "-tp", default=".", type=str, help='Directory of similarity index files')
+    parser.add_argument("--jobs", "-j", type=int, default=1, help='Number of shards of built indexes')
 
-    parser.set_defaults(func=fill_database_core)
+    parser.set_defaults(func=handler('main_snapshot', 'import_core'))
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+folded fingerprints cascade benchmark. synthetic corpus of clustered descriptor sets is fingerprinted
+with every configured length. for each length reports recall@k of fingerprint top-k against exact
+Jaccard top-k of descriptor sets and timings of full scan and cascade for top-k, threshold and
+substructure screening. cascade results are checked to be equal to full scan results.
+
+usage: python -m benchmarks.cascade [--rows 100000] [--queries 50] [--k 10] [--sizes 64 256 1024]
+"""
+import argparse
+import time
+import numpy as np
+from scipy.sparse import csr_matrix
+from MARS.config import FOLDED_SIZES, ACTIVE_BITS
+from MARS.files.Zulfia import as_words, fold
+from MARS.files.Tanimoto import popcount, top_k, within, superset_rows, cascade_top_k, cascade_within, \
+    cascade_superset, select_top
+from benchmarks.corpus import VOCABULARY, descriptor_sets, fingerprints
+
+THRESHOLD = .7
+
+
+def sparse(sets):
+    indices = np.concatenate(sets)
+    indptr = np.cumsum([0] + [len(x) for x in sets])
+    return csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(sets), VOCABULARY))
+
+
+def timed(function, queries):
+    start = time.perf_counter()
+    results = [function(q) for q in queries]
+    return results, (time.perf_counter() - start) / len(queries) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='folded fingerprints cascade benchmark')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 256, 1024])
+    args = parser.parse_args()
+
+    data, queries, substructures = descriptor_sets(args.rows, args.queries)
+    matrix, query_matrix = sparse(data), sparse(queries)
+    common = (query_matrix @ matrix.T).toarray()
+    union = np.asarray(query_matrix.sum(axis=1)) + np.asarray(matrix.sum(axis=1)).T - common
+    jaccard = common / union
+    labels = np.arange(args.rows)
+    truth = [set(select_top(x, labels, args.k)[1]) for x in jaccard]
+
+    print('rows: %d, queries: %d, k: %d, active bits: %d' % (args.rows, args.queries, args.k, ACTIVE_BITS))
+    for size in args.sizes:
+        words = as_words(fingerprints(data, size))
+        counts = popcount(words)
+        order = np.lexsort((labels, counts))
+        words, counts, ids = words[order], counts[order], labels[order]
+        levels = [(x, fold(words, x)) for x in FOLDED_SIZES if x < size]
+        q = as_words(fingerprints(queries, size))
+        s = as_words(fingerprints(substructures, size))
+
+        full, full_time = timed(lambda x: top_k(x, words, args.k, counts, labels=ids), q)
+        recall = np.mean([len(truth[n] & set(x[1])) / args.k for n, x in enumerate(full)])
+        full_within, full_within_time = timed(lambda x: within(x, words, THRESHOLD, counts, ordered=True), q)
+        full_screen, full_screen_time = timed(lambda x: superset_rows(x, words, counts=counts), s)
+        print('%d bits: recall@%d %.3f, screening selectivity %.3f%%' %
+              (size, args.k, recall, np.mean([len(x) for x in full_screen]) / args.rows * 100))
+        print('  full scan: top-k %.3fms, threshold %.1f %.3fms, substructure %.3fms per query' %
+              (full_time, THRESHOLD, full_within_time, full_screen_time))
+        if not levels:
+            continue
+
+        cascade, cascade_time = timed(lambda x: cascade_top_k(x, words, args.k, counts, levels, ids), q)
+        cascade_within_, cascade_within_time = timed(lambda x: cascade_within(x, words, THRESHOLD, counts, levels,
+                                                                              ordered=True), q)
+        cascade_screen, cascade_screen_time = timed(lambda x: cascade_superset(x, words, levels, counts), s)
+        for a, b in zip(full, cascade):
+            assert np.array_equal(a[0], b[0]) and np.array_equal(a[1], b[1]), 'cascade top-k mismatch'
+        for a, b in zip(full_within, cascade_within_):
+            assert np.array_equal(np.sort(a[1]), np.sort(b[1])), 'cascade threshold mismatch'
+        for a, b in zip(full_screen, cascade_screen):
+            assert np.array_equal(np.sort(a), np.sort(b)), 'cascade screening mismatch'
+        print('  cascade %s: top-k %.3fms, threshold %.1f %.3fms, substructure %.3fms per query' %
+              ('/'.join(str(x) for x, _ in levels), cascade_time, THRESHOLD, cascade_within_time, cascade_screen_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+deterministic synthetic corpora for benchmarks. structures are replaced by sets of descriptors,
+so corpora of any size are generated without Fragmentor. the same seed gives the same corpus.
+
+descriptors frequencies follow Zipf law. sets are grouped around random centers, so every set
+has near neighbours, as structures of real databases do.
+"""
+import numpy as np
+import pandas as pd
+from MARS.files.Zulfia import get_bit_positions
+
+VOCABULARY = 20000
+BLOCK_SIZE = 65536
+_weights = np.cumsum(1 / np.arange(1, VOCABULARY + 1))
+_weights /= _weights[-1]
+
+
+def zipf(rnd, size, population=VOCABULARY):
+    """
+    random items of range(population) with Zipf distribution
+    """
+    if population == VOCABULARY:
+        cdf = _weights
+    else:
+        cdf = np.cumsum(1 / np.arange(1, population + 1))
+        cdf /= cdf[-1]
+    return np.minimum(np.searchsorted(cdf, rnd.random_sample(size), 'right'), population - 1)
+
+
+def _gather(offsets, lengths, items, picked):
+    """
+    rows numbers and items of sets picked from CSR collection
+    """
+    counts = lengths[picked]
+    rows = np.repeat(np.arange(len(picked)), counts)
+    shift = np.repeat(offsets[picked] - np.concatenate(([0], np.cumsum(counts)[:-1])), counts)
+    return rows, items[np.arange(counts.sum()) + shift]
+
+
+def _split(rows, items, size):
+    """
+    list of sorted unique items sets of rows
+    """
+    order = np.lexsort((items, rows))
+    rows, items = rows[order], items[order]
+    unique = np.ones(len(rows), dtype=bool)
+    unique[1:] = (rows[1:] != rows[:-1]) | (items[1:] != items[:-1])
+    rows, items = rows[unique], items[unique]
+    return np.split(items, np.cumsum(np.bincount(rows, minlength=size))[:-1])
+
+
+def _csr(sets):
+    lengths = np.array([len(x) for x in sets], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+    items = np.concatenate(sets) if sets else np.empty(0, dtype=np.int64)
+    return offsets, lengths, items
+
+
+def descriptor_sets(rows, queries=0, seed=0):
+    """
+    descriptors sets grouped around random centers. queries are mutated centers, their substructures
+    are random subsets of query sets.
+
+    :return: lists of sets, query sets and substructures sets
+    """
+    rnd = np.random.RandomState(seed)
+    centers = max(rows // 20, 1)
+    lengths = rnd.randint(20, 60, centers)
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    items = zipf(rnd, lengths.sum())
+
+    def mutate(size):
+        r, i = _gather(offsets, lengths, items, rnd.randint(centers, size=size))
+        keep = rnd.random_sample(len(i)) > .15
+        extra = rnd.randint(0, 8, size)
+        return _split(np.concatenate((r[keep], np.repeat(np.arange(size), extra))),
+                      np.concatenate((i[keep], zipf(rnd, extra.sum()))), size)
+
+    data = mutate(rows)
+    query = mutate(queries)
+    substructures = [x[rnd.random_sample(len(x)) < .3] for x in query]
+    return data, query, substructures
+
+
+def reaction_sets(reactions, seed=0):
+    """
+    molecules and reactions of synthetic DB. every reaction has 1-3 reagents and 1-2 products drawn
+    from molecules pool of reactions size with Zipf distribution, so popular molecules take part
+    in many reactions. reaction set is union of participants sets and a few reaction center descriptors.
+
+    :return: lists of molecules sets, reactions sets, reagents and products of reactions as molecules numbers
+    """
+    rnd = np.random.RandomState(seed)
+    molecules, _, _ = descriptor_sets(reactions, seed=seed + 1)
+    popularity = rnd.permutation(reactions)
+
+    participants = []
+    for low, high in ((1, 4), (1, 3)):
+        counts = rnd.randint(low, high, reactions)
+        participants.append(_split(np.repeat(np.arange(reactions), counts),
+                                   popularity[zipf(rnd, counts.sum(), reactions)], reactions))
+    reagents, products = participants
+
+    offsets, lengths, items = _csr(molecules)
+    picked = np.concatenate(reagents + products)
+    owners = np.concatenate([np.repeat(np.arange(reactions), [len(x) for x in p]) for p in participants])
+    r, i = _gather(offsets, lengths, items, picked)
+    center = rnd.randint(1, 5, reactions)
+    sets = _split(np.concatenate((owners[r], np.repeat(np.arange(reactions), center))),
+                  np.concatenate((i, zipf(rnd, center.sum()))), reactions)
+    return molecules, sets, reagents, products
+
+
+def fingerprints(sets, size):
+    """
+    uint8 fingerprints matrix of descriptors sets. descriptors are hashed like Fragmentor columns
+    """
+    positions = np.array([get_bit_positions(str(x), size) for x in range(VOCABULARY)], dtype=np.intp)
+    result = np.empty((len(sets), size // 8), dtype=np.uint8)
+    for start in range(0, len(sets), BLOCK_SIZE):
+        block = sets[start:start + BLOCK_SIZE]
+        rows = np.repeat(np.arange(len(block)), [len(x) for x in block])
+        bits = np.zeros((len(block), size), dtype=bool)
+        if len(rows):
+            bits[rows[:, np.newaxis], positions[np.concatenate(block)]] = True
+        result[start:start + len(block)] = np.packbits(bits, axis=1)
+    return result
+
+
+def descriptor_frame(sets):
+    """
+    Fragmentor-like descriptors DataFrame of sets: columns are descriptors, values are counts
+    """
+    columns, inverse = np.unique(np.concatenate(sets), return_inverse=True)
+    values = np.zeros((len(sets), len(columns)), dtype=np.uint8)
+    values[np.repeat(np.arange(len(sets)), [len(x) for x in sets]), inverse] = 1
+    return pd.DataFrame(values, columns=[str(x) for x in columns])
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+dbfill writer benchmark. measures rows/second of bulk and ORM insert paths.
+chunks are prepared before timing, so only existence checks and inserts are measured.
+
+both modes write into the given database, so run each of them against an empty one:
+
+usage: python -m benchmarks.fill input.rdf --db empty.db --mode {bulk,orm} [--chunksize 1000]
+"""
+import argparse
+import time
+from MARS.CLI.main_fill_database import prepare_text, write_chunk
+from MARS.files.Stream import rdf_chunks
+from MARS.models import init_db
+
+
+def main():
+    parser = argparse.ArgumentParser(description='dbfill writer benchmark')
+    parser.add_argument('input', type=argparse.FileType('rb'))
+    parser.add_argument('--mode', choices=('bulk', 'orm'), default='bulk')
+    parser.add_argument('--chunksize', type=int, default=1000)
+    parser.add_argument('--db', default=None, help='SQLite database file')
+    args = parser.parse_args()
+    init_db(args.db)
+
+    prepared = [prepare_text(x) for x, _, _ in rdf_chunks(args.input, args.chunksize)]
+    reactions = sum(len(x[0]) for x in prepared)
+    molecules = sum(len(x[1]) for x in prepared)
+
+    start = time.perf_counter()
+    for x in prepared:
+        write_chunk(*x, bulk=args.mode == 'bulk')
+    total = time.perf_counter() - start
+
+    print('mode: %s, reactions: %d, unique molecules per chunk: %d' % (args.mode, reactions, molecules))
+    print('time: %.3fs, %.0f reactions/s' % (total, reactions / total))
+
+
+if __name__ == '__main__':
+    main()
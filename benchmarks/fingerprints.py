@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+get_bitstring benchmark. compares vectorized fingerprint builder with old per-row BitArray loop.
+
+usage: python -m benchmarks.fingerprints [--rows 100000] [--columns 500]
+"""
+import argparse
+import time
+from hashlib import md5
+import numpy as np
+import pandas as pd
+from bitstring import BitArray
+from MARS.config import ACTIVE_BITS, bs_slice
+from MARS.files.Zulfia import get_bitstring
+
+
+def get_bitstring_legacy(descriptors):
+    d = {}
+    result = []
+    for i in descriptors.columns:
+        xx = BitArray(md5(i.encode()).digest())
+        d[i] = [xx[j * bs_slice:(j + 1) * bs_slice].uint for j in range(ACTIVE_BITS)]
+    for _, i in descriptors.iterrows():
+        hfp = BitArray(bytes(2 ** bs_slice // 8))
+        for k, v in i.items():
+            if v:
+                hfp.set(True, d[k])
+        result.append(hfp)
+    return result
+
+
+def descriptors_frame(rows, columns, density=.05, seed=0):
+    rnd = np.random.RandomState(seed)
+    values = rnd.poisson(2, size=(rows, columns)) * (rnd.random_sample((rows, columns)) < density)
+    return pd.DataFrame(values, columns=['frag_%d' % x for x in range(columns)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='get_bitstring benchmark')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--columns', type=int, default=500)
+    args = parser.parse_args()
+
+    frame = descriptors_frame(args.rows, args.columns)
+
+    start = time.perf_counter()
+    new = get_bitstring(frame)
+    new_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    old = get_bitstring_legacy(frame)
+    old_time = time.perf_counter() - start
+
+    assert all(x.tobytes() == y.bytes for x, y in zip(new, old)), 'fingerprints mismatch'
+    print('rows: %d, columns: %d' % (args.rows, args.columns))
+    print('BitArray loop: %.3fs, vectorized: %.3fs, speedup: %.1fx' % (old_time, new_time, old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+MinHash LSH benchmark. synthetic corpus of clustered descriptor sets is indexed with several bands settings.
+for each setting reports recall@k against exact top-k search, number of candidates and search time per query.
+
+usage: python -m benchmarks.lsh [--rows 100000] [--queries 100] [--k 10] [--size 1024]
+"""
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+from MARS.files.Tanimoto import popcount, tanimoto, top_k, select_top
+from MARS.files.MinHash import signatures, band_keys, bucket_rows, recall
+from MARS.files.IndexFile import LSHTables, write_lsh
+from MARS.files.Zulfia import as_words
+from benchmarks.corpus import descriptor_sets, fingerprints
+
+# (bands, rows per band)
+SETTINGS = ((8, 2), (16, 2), (32, 2), (64, 2), (16, 4), (32, 4), (64, 4))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MinHash LSH benchmark')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--size', type=int, default=1024)
+    args = parser.parse_args()
+
+    data, queries, _ = descriptor_sets(args.rows, args.queries)
+    words = as_words(fingerprints(data, args.size))
+    counts = popcount(words)
+    ids = np.arange(args.rows)
+    q = as_words(fingerprints(queries, args.size))
+
+    start = time.perf_counter()
+    exact = [top_k(x, words, args.k, counts, labels=ids) for x in q]
+    exact_time = (time.perf_counter() - start) / args.queries * 1000
+    print('rows: %d, queries: %d, k: %d, size: %d bits, exact search: %.3fms per query' %
+          (args.rows, args.queries, args.k, args.size, exact_time))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for bands, band_rows in SETTINGS:
+            file_path = os.path.join(tmp, '%d.%d.lsh.idx' % (bands, band_rows))
+            start = time.perf_counter()
+            # tables aren't built for DB, identity token is empty
+            write_lsh(file_path, ids, words, counts, band_keys(signatures(words, bands * band_rows), bands, band_rows),
+                      band_rows, args.size, '0' * 32)
+            build_time = time.perf_counter() - start
+            index = LSHTables(file_path)
+
+            start = time.perf_counter()
+            keys = band_keys(signatures(q, bands * band_rows), bands, band_rows)
+            candidates = bucket_rows(index.keys, index.order, keys)
+            found = [select_top(tanimoto(x, index.fingerprints[r], index.counts[r]), index.ids[r], args.k)
+                     for x, r in zip(q, candidates)]
+            search_time = (time.perf_counter() - start) / args.queries * 1000
+
+            print('%d bands x %d rows: recall@%d %.3f, candidates %.1f%%, search %.3fms per query, build %.1fs' %
+                  (bands, band_rows, args.k, recall([s for s, _ in exact], [s for s, _ in found]),
+                   np.mean([len(x) for x in candidates]) / args.rows * 100, search_time, build_time))
+            del index
+
+
+if __name__ == '__main__':
+    main()
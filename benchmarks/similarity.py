@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+similarity search benchmark. compares BallTree with jaccard metric and packed popcount scan.
+
+usage: python -m benchmarks.similarity [--rows 1000000] [--queries 100] [--k 10]
+"""
+import argparse
+import time
+import numpy as np
+from sklearn.neighbors import BallTree
+from MARS.files.Zulfia import FINGERPRINT_SIZE, as_words
+from MARS.files.Tanimoto import popcount, top_k
+
+
+def random_fingerprints(rows, density=.25, seed=0):
+    rnd = np.random.RandomState(seed)
+    return np.packbits(rnd.random_sample((rows, FINGERPRINT_SIZE)) < density, axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='similarity search benchmark')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args()
+
+    fps = random_fingerprints(args.rows)
+    queries = random_fingerprints(args.queries, seed=1)
+
+    start = time.perf_counter()
+    unpacked = np.unpackbits(fps, axis=1)
+    tree = BallTree(unpacked, metric='jaccard')
+    tree_build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    words = as_words(fps)
+    counts = popcount(words)
+    packed_build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tree_dist, _ = tree.query(np.unpackbits(queries, axis=1), k=args.k)
+    tree_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    packed_dist = [1 - top_k(q, words, args.k, counts)[0] for q in as_words(queries)]
+    packed_time = time.perf_counter() - start
+
+    assert np.allclose(np.sort(tree_dist, axis=1), np.sort(packed_dist, axis=1)), 'top-k scores mismatch'
+    print('rows: %d, queries: %d, k: %d' % (args.rows, args.queries, args.k))
+    print('memory: BallTree data %.1fMB, packed %.1fMB' % (unpacked.nbytes / 2 ** 20,
+                                                         (words.nbytes + counts.nbytes) / 2 ** 20))
+    print('build: BallTree %.3fs, packed %.3fs' % (tree_build, packed_build))
+    print('query: BallTree %.3fms, packed %.3fms per query' % (tree_time / args.queries * 1000,
+                                                             packed_time / args.queries * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+CLI startup benchmark. measures wall time of light commands and import time of every subcommand module.
+each measurement runs in fresh interpreter, best of --repeat runs is reported.
+
+usage: python -m benchmarks.startup [--repeat 5]
+"""
+import argparse
+import subprocess
+import sys
+import time
+from os import path
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+COMMANDS = (['--version'], ['--help'], ['dbfill', '--help'], ['similar_mol', '--help'])
+MODULES = ('main_structure_search', 'main_substructure_search', 'main_similarity_search', 'main_fill_database',
+           'main_migrate', 'main_refingerprint', 'main_snapshot', 'main_server', 'main_query')
+IMPORT = 'import time; start = time.perf_counter(); import MARS.CLI.%s; print(time.perf_counter() - start)'
+
+
+def best_run(args, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=ROOT, stdout=subprocess.DEVNULL, check=True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def best_import(module, repeat):
+    best = None
+    for _ in range(repeat):
+        done = subprocess.run([sys.executable, '-c', IMPORT % module], cwd=ROOT, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True)
+        if done.returncode:
+            return None
+        elapsed = float(done.stdout)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CLI startup benchmark')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print('interpreter: %.1fms' % (best_run(['-c', 'pass'], args.repeat) * 1000))
+    for command in COMMANDS:
+        print('main.py %s: %.1fms' % (' '.join(command), best_run(['main.py'] + command, args.repeat) * 1000))
+    for module in MODULES:
+        elapsed = best_import(module, args.repeat)
+        if elapsed is None:
+            print('import %s: failed' % module)
+        else:
+            print('import %s: %.1fms' % (module, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
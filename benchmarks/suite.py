@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark suite. deterministic synthetic database of given scale is loaded into scratch SQLite DB,
+then ingestion throughput, index build and load times, search latency percentiles and fingerprinting
+throughput are measured. structures are replaced by descriptors sets, so Fragmentor is not used.
+
+results are written as JSON. compare mode reports metrics, which got worse than tolerance,
+and exits with status 1 if there are any. changes of timings less than NOISE are ignored.
+
+usage: python -m benchmarks.suite run [--scale 10k] [--output results.json] [--queries 200] [--k 10]
+       python -m benchmarks.suite compare base.json new.json [--tolerance .1]
+"""
+import argparse
+import json
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from hashlib import md5
+from os import path, cpu_count
+from pony.orm import db_session, count
+from MARS.config import FINGERPRINT_SIZES
+from MARS.models import init_db, Molecules, Reactions, MoleculeRecord, ReactionRecord
+from MARS.files.Zulfia import get_bitstring
+from MARS.files.TreeIndex import TreeIndex, materialize
+from MARS.files.RoleIndex import RoleIndex
+from MARS.files.LSHIndex import LSHIndex
+from MARS.CLI.main_fill_database import write_chunk
+from benchmarks.corpus import descriptor_sets, reaction_sets, fingerprints, descriptor_frame
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+SCALES = {'10k': 10000, '100k': 100000, '1M': 1000000}
+PERCENTILES = (50, 90, 99)
+THRESHOLD = .7
+BITSTRING_ROWS = 5000
+# absolute changes of timings, which are treated as noise in comparison
+NOISE = {'s': .01, 'ms': .1}
+# node-link data of molecules. structures are not used by measured paths
+EMPTY_GRAPH = {'directed': False, 'multigraph': False, 'graph': {}, 'nodes': [], 'links': []}
+
+
+class Metrics(object):
+    def __init__(self):
+        self.data = {}
+
+    def add(self, name, value, unit, better='lower'):
+        self.data[name] = dict(value=float(value), unit=unit, better=better)
+        print('%-45s %12.3f %s' % (name, value, unit))
+
+    def latency(self, name, function, queries):
+        """
+        time function on every query and add latency percentiles
+        """
+        times = []
+        for q in queries:
+            start = time.perf_counter()
+            function(q)
+            times.append((time.perf_counter() - start) * 1000)
+        for p in PERCENTILES:
+            self.add('%s.p%d' % (name, p), np.percentile(times, p), 'ms')
+
+
+def fear_string(prefix, seed, n):
+    return md5(('%s%d.%d' % (prefix, seed, n)).encode()).hexdigest()
+
+
+def synthetic_chunks(reactions, seed, chunksize):
+    """
+    chunks of ReactionRecord and unique MoleculeRecord lists of synthetic DB, as dbfill prepares them
+
+    :return: chunks list, FEAR strings of molecules, reactions sets, reagents and products
+    """
+    molecules, sets, reagents, products = reaction_sets(reactions, seed)
+    packed = Molecules.get_packed(EMPTY_GRAPH)
+    fears = [fear_string('M', seed, n) for n in range(len(molecules))]
+    records = [MoleculeRecord(f, EMPTY_GRAPH, packed, fp)
+               for f, fp in zip(fears, fingerprints(molecules, FINGERPRINT_SIZES['Molecules']))]
+
+    chunks = []
+    reaction_fps = fingerprints(sets, FINGERPRINT_SIZES['Reactions'])
+    for start in range(0, reactions, chunksize):
+        stop = min(start + chunksize, reactions)
+        chunk = [ReactionRecord(fear_string('R', seed, n), None, reaction_fps[n],
+                                [records[m] for m in reagents[n]], [records[m] for m in products[n]])
+                 for n in range(start, stop)]
+        used = np.unique(np.concatenate(reagents[start:stop] + products[start:stop]))
+        chunks.append((chunk, [records[m] for m in used]))
+    return chunks, fears, sets, reagents, products
+
+
+def load_reactions(ids):
+    return materialize(Reactions, [(np.ones(len(ids)), ids)])
+
+
+def run(args):
+    rows = SCALES[args.scale]
+    workdir = args.workdir or tempfile.mkdtemp(prefix='mars-bench-')
+    metrics = Metrics()
+    try:
+        init_db(path.join(path.abspath(workdir), 'benchmark.db'))
+        rnd = np.random.RandomState(args.seed)
+
+        start = time.perf_counter()
+        chunks, fears, sets, reagents, products = synthetic_chunks(rows, args.seed, args.chunksize)
+        print('corpus of %d reactions generated in %.1fs' % (rows, time.perf_counter() - start))
+
+        start = time.perf_counter()
+        for chunk in chunks:
+            write_chunk(*chunk, treepath=workdir)
+        elapsed = time.perf_counter() - start
+        metrics.add('ingest.reactions_per_s', rows / elapsed, '1/s', 'higher')
+        with db_session():
+            metrics.add('ingest.molecules_per_s', count(m for m in Molecules) / elapsed, '1/s', 'higher')
+
+        with db_session():
+            for name, build in (('molecules', lambda: TreeIndex.rebuild(Molecules, workdir, args.jobs)),
+                                ('reactions', lambda: TreeIndex.rebuild(Reactions, workdir, args.jobs)),
+                                ('roles', lambda: RoleIndex(reindex=True, dump_path=workdir)),
+                                ('lsh_reactions', lambda: LSHIndex(Reactions, reindex=True, dump_path=workdir))):
+                start = time.perf_counter()
+                build()
+                metrics.add('build.%s' % name, time.perf_counter() - start, 's')
+
+            indexes = {}
+            for name, load in (('molecules', lambda: TreeIndex(Molecules, dump_path=workdir, jobs=args.jobs)),
+                               ('reactions', lambda: TreeIndex(Reactions, dump_path=workdir, jobs=args.jobs)),
+                               ('roles', lambda: RoleIndex(dump_path=workdir)),
+                               ('lsh_reactions', lambda: LSHIndex(Reactions, dump_path=workdir))):
+                start = time.perf_counter()
+                indexes[name] = load()
+                metrics.add('load.%s' % name, time.perf_counter() - start, 's')
+
+            _, queries, _ = descriptor_sets(rows, args.queries, args.seed + 2)
+            molecule_queries = fingerprints(queries, FINGERPRINT_SIZES['Molecules'])[:, np.newaxis]
+            picked = rnd.randint(rows, size=args.queries)
+            reaction_queries = fingerprints([x[rnd.random_sample(len(x)) > .15] for x in (sets[n] for n in picked)],
+                                            FINGERPRINT_SIZES['Reactions'])[:, np.newaxis]
+
+            x = indexes['molecules']
+            metrics.latency('similar_mol.top_k', lambda q: x.get_similar_fingerprints(q, args.k), molecule_queries)
+            metrics.latency('similar_mol.threshold', lambda q: x.get_within_fingerprints(q, THRESHOLD),
+                            molecule_queries)
+            y = indexes['reactions']
+            metrics.latency('similar_react.top_k', lambda q: y.get_similar_fingerprints(q, args.k), reaction_queries)
+            metrics.latency('similar_react.threshold', lambda q: y.get_within_fingerprints(q, THRESHOLD),
+                            reaction_queries)
+            z = indexes['lsh_reactions']
+            metrics.latency('similar_react.approximate_top_k', lambda q: z.get_similar_fingerprints(q, args.k),
+                            reaction_queries)
+
+            roles = indexes['roles']
+            metrics.latency('struct_mol.lookup', lambda n: load_reactions(roles.get_reactions(fears[n])),
+                            [reagents[n][0] for n in picked])
+            metrics.latency('struct_mol.intersect',
+                            lambda n: load_reactions(roles.search([fears[reagents[n][0]]], [fears[products[n][0]]])),
+                            picked)
+
+        frame = descriptor_frame(sets[:BITSTRING_ROWS])
+        start = time.perf_counter()
+        get_bitstring(frame, FINGERPRINT_SIZES['Reactions'])
+        metrics.add('get_bitstring.rows_per_s', len(frame) / (time.perf_counter() - start), '1/s', 'higher')
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    result = dict(meta=dict(scale=args.scale, rows=rows, seed=args.seed, queries=args.queries, k=args.k,
+                            jobs=args.jobs, chunksize=args.chunksize, fingerprint_sizes=FINGERPRINT_SIZES,
+                            commit=git_commit(), python=platform.python_version(), numpy=np.__version__,
+                            platform=platform.platform(), cpus=cpu_count(),
+                            date=time.strftime('%Y-%m-%dT%H:%M:%S')),
+                  metrics=metrics.data)
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    print('results are written to %s' % args.output)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    for key in ('scale', 'seed', 'queries', 'k', 'jobs', 'fingerprint_sizes'):
+        if base['meta'].get(key) != new['meta'].get(key):
+            print('warning: runs differ in %s: %s vs %s' % (key, base['meta'].get(key), new['meta'].get(key)))
+
+    regressions = 0
+    for name, old in sorted(base['metrics'].items()):
+        current = new['metrics'].get(name)
+        if current is None:
+            print('%-45s missing in new run' % name)
+            continue
+        change = current['value'] / old['value'] - 1 if old['value'] else 0.
+        if abs(current['value'] - old['value']) < NOISE.get(old['unit'], 0):
+            change = 0.
+        worse = change > args.tolerance if old['better'] == 'lower' else change < -args.tolerance
+        better = change < -args.tolerance if old['better'] == 'lower' else change > args.tolerance
+        regressions += worse
+        print('%-45s %12.3f %12.3f %+8.1f%% %s' % (name, old['value'], current['value'], change * 100,
+                                                   'REGRESSION' if worse else 'improved' if better else ''))
+
+    print('%d regressions with tolerance %.0f%%' % (regressions, args.tolerance * 100))
+    if regressions:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MARS benchmark suite')
+    subparsers = parser.add_subparsers(title='mode', dest='mode')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser('run', help='generate synthetic DB and measure')
+    run_parser.add_argument('--scale', choices=SCALES, default='10k', help='number of reactions')
+    run_parser.add_argument('--output', default='results.json', help='JSON results file')
+    run_parser.add_argument('--queries', type=int, default=200, help='number of queries of every search')
+    run_parser.add_argument('--k', type=int, default=10, help='number of similar structures')
+    run_parser.add_argument('--jobs', type=int, default=1, help='number of index shards and search threads')
+    run_parser.add_argument('--chunksize', type=int, default=1000, help='reactions in ingestion chunk')
+    run_parser.add_argument('--seed', type=int, default=0, help='corpus seed')
+    run_parser.add_argument('--workdir', default=None,
+                            help='directory of scratch DB and indexes. temporary directory is used and removed '
+                                 'by default')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser('compare', help='compare results of two runs')
+    compare_parser.add_argument('base', help='JSON results of baseline run')
+    compare_parser.add_argument('new', help='JSON results of new run')
+    compare_parser.add_argument('--tolerance', type=float, default=.1,
+                                help='relative change of metric, which is reported as regression')
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+threshold search benchmark. compares full scan with popcount band pruning over index sorted by popcount.
+
+usage: python -m benchmarks.threshold [--rows 1000000] [--queries 100]
+"""
+import argparse
+import time
+import numpy as np
+from MARS.files.Zulfia import FINGERPRINT_SIZE, as_words
+from MARS.files.Tanimoto import popcount, count_band, within
+
+THRESHOLDS = (.5, .6, .7, .8, .9)
+
+
+def random_fingerprints(rows, seed=0):
+    """
+    fingerprints with density varying from row to row, as in real databases
+    """
+    rnd = np.random.RandomState(seed)
+    density = rnd.uniform(.05, .5, (rows, 1))
+    return np.packbits(rnd.random_sample((rows, FINGERPRINT_SIZE)) < density, axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='threshold search benchmark')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=100)
+    args = parser.parse_args()
+
+    words = as_words(random_fingerprints(args.rows))
+    counts = popcount(words)
+    order = np.argsort(counts, kind='mergesort')
+    words, counts = words[order], counts[order]
+    queries = as_words(random_fingerprints(args.queries, seed=1))
+
+    print('rows: %d, queries: %d' % (args.rows, args.queries))
+    for threshold in THRESHOLDS:
+        start = time.perf_counter()
+        full = [within(q, words, threshold, counts) for q in queries]
+        full_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        pruned = [within(q, words, threshold, counts, ordered=True) for q in queries]
+        pruned_time = time.perf_counter() - start
+
+        for (_, f), (_, p) in zip(full, pruned):
+            assert np.array_equal(np.sort(f), np.sort(p)), 'pruned search lost hits'
+
+        skipped = np.mean([1 - np.subtract(*count_band(int(popcount(q)), threshold, counts)[::-1]) / args.rows
+                           for q in queries])
+        hits = np.mean([len(x) for _, x in pruned])
+        print('threshold %.1f: %.1f hits, %.1f%% rows pruned, full scan %.3fms, pruned %.3fms per query' %
+              (threshold, hits, skipped * 100, full_time / args.queries * 1000, pruned_time / args.queries * 1000))
+
+
+if __name__ == '__main__':
+    main()
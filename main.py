@@ -8,12 +8,28 @@ from MARS.parsers import similarity_search_reactions
 from MARS.parsers import similarity_search_molecules
 from MARS.parsers import substructure_search
 from MARS.parsers import fill_database
+from MARS.parsers import migrate_database
+from MARS.parsers import serve
+from MARS.parsers import query
+from MARS.parsers import refingerprint
+from MARS.parsers import export_database
+from MARS.parsers import import_database
 from importlib.util import find_spec
 import importlib
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Molecules And Reactions Search", epilog="(c) KFU - 07-613 - 2016", prog='MARS')
     parser.add_argument("--version", "-v", action="version", version=version(), default=False)
+    parser.add_argument("--db", default=None, type=str,
+                        help='SQLite database file. Default is DB_PATH from MARS config, relative to MARS package')
+    parser.add_argument("--profile", action='store_true',
+                        help='Time stages of ingestion and search and print summary when command is finished')
+    parser.add_argument("--profile-format", default='table', choices=('table', 'json', 'prometheus'),
+                        help='Format of profile summary')
+    parser.add_argument("--profile-output", default=None, type=str,
+                        help='File of profile summary. Default is stderr')
+    parser.add_argument("--cprofile", default=None, type=str,
+                        help='Capture cProfile stats of command into this file')
     subparsers = parser.add_subparsers(title='subcommands', description='available utilities')
 
     structure_search_molecules(subparsers)
@@ -22,6 +38,12 @@ def parse_args():
     similarity_search_molecules(subparsers)
     similarity_search_reactions(subparsers)
     fill_database(subparsers)
+    migrate_database(subparsers)
+    serve(subparsers)
+    query(subparsers)
+    refingerprint(subparsers)
+    export_database(subparsers)
+    import_database(subparsers)
 
 
     if find_spec('argcomplete'):
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+temporary DB of tests. pony binds DB once per process, so all tests share one file
+"""
+import os
+import tempfile
+try:
+    from pony.orm import db_session
+    from MARS.models import init_db, db, Molecules, Reactions, ReactionsMolecules
+except ImportError as e:
+    missing = e
+else:
+    missing = None
+
+_tmp = None
+
+
+def bind():
+    """
+    bind temporary DB and delete all its rows
+
+    :return: directory of DB file
+    """
+    global _tmp
+    if _tmp is None:
+        _tmp = tempfile.TemporaryDirectory()
+        init_db(os.path.join(_tmp.name, 'test.db'))
+    with db_session():
+        cursor = db.get_connection().cursor()
+        for entity in (ReactionsMolecules, Reactions, Molecules):
+            cursor.execute('DELETE FROM "%s"' % entity._table_)
+    return _tmp.name
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import tempfile
+import unittest
+from itertools import count
+from unittest import mock
+from MARS.files.Cache import LRUCache, ResultCache
+from MARS.files.Fragmentation import DescriptorCache
+
+
+def clock():
+    """
+    time.time replacement, which always goes forward, so LRU order doesn't depend on timer resolution
+    """
+    return mock.patch('time.time', side_effect=count(1).__next__)
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.put(1, 'a')
+        cache.put(2, 'b')
+        self.assertEqual(cache.get(1), 'a')
+        cache.put(3, 'c')
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), 'a')
+        self.assertEqual(cache.get(3), 'c')
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp.name, 'db.results')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        cache = ResultCache(self.file_path, 10)
+        cache.put_many('c', [('f1', [1, 2], [1., .5]), ('f2', [], [])], 'p', 'a.1')
+        self.assertEqual(cache.get_many('c', ['f1', 'f2', 'f3', 'f1'], 'p', 'a.1'),
+                         {'f1': ([1, 2], [1., .5]), 'f2': ([], [])})
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+        # other command or parameters are other results
+        self.assertEqual(cache.get_many('d', ['f1'], 'p', 'a.1'), {})
+        self.assertEqual(cache.get_many('c', ['f1'], 'q', 'a.1'), {})
+
+    def test_invalidation(self):
+        cache = ResultCache(self.file_path, 10)
+        cache.put_many('c', [('f', [1], [1.])], 'p', 'a.1')
+        self.assertEqual(cache.get_many('c', ['f'], 'p', 'a.2'), {})
+        # results of other versions are dropped, so older version doesn't return them too
+        self.assertEqual(cache.get_many('c', ['f'], 'p', 'a.1'), {})
+
+        # DB recreated at the same path starts from the same generation with other identity
+        cache.put_many('c', [('f', [1], [1.])], 'p', 'a.1')
+        self.assertEqual(cache.get_many('c', ['f'], 'p', 'b.1'), {})
+
+        cache.put_many('c', [('f', [1], [1.])], 'p', 'b.1')
+        cache.clear()
+        self.assertEqual(cache.get_many('c', ['f'], 'p', 'b.1'), {})
+
+    def test_old_format(self):
+        con = sqlite3.connect(self.file_path)
+        con.execute('CREATE TABLE results (command TEXT, parameters TEXT, fear TEXT, generation INTEGER, '
+                    'ids TEXT, scores TEXT, used REAL, PRIMARY KEY (command, parameters, fear))')
+        con.execute("INSERT INTO results VALUES ('c', 'p', 'f', 0, '[1]', '[1]', 0)")
+        con.commit()
+        con.close()
+        cache = ResultCache(self.file_path, 10)
+        self.assertEqual(cache.get_many('c', ['f'], 'p', 'a.0'), {})
+
+    def test_eviction(self):
+        cache = ResultCache(self.file_path, 3)
+        with clock():
+            cache.put_many('c', [('f%d' % i, [i], [1.]) for i in range(3)], 'p', 'a.1')
+            cache.get_many('c', ['f0'], 'p', 'a.1')
+            cache.put_many('c', [('f3', [3], [1.])], 'p', 'a.1')
+        self.assertEqual(sorted(cache.get_many('c', ['f%d' % i for i in range(4)], 'p', 'a.1')), ['f0', 'f2', 'f3'])
+
+
+class TestDescriptorCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp.name, 'db.descriptors_mol')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_disabled(self):
+        cache = DescriptorCache(None, 10)
+        cache.put_many([('f', {'a': 1})])
+        self.assertEqual(cache.get_many(['f']), {})
+        self.assertFalse(os.path.exists(self.file_path))
+
+    def test_round_trip(self):
+        cache = DescriptorCache(self.file_path, 10)
+        cache.put_many([('f1', {'a': 1}), ('f2', {})])
+        cache.put_many([('f1', {'a': 2})])
+        self.assertEqual(cache.get_many(['f1', 'f2', 'f3']), {'f1': {'a': 1}, 'f2': {}})
+        # cache is shared through file
+        self.assertEqual(DescriptorCache(self.file_path, 10).get_many(['f1']), {'f1': {'a': 1}})
+
+    def test_lookups_dont_write(self):
+        cache = DescriptorCache(self.file_path, 10)
+        cache.put_many([('f', {'a': 1})])
+        con = sqlite3.connect(self.file_path)
+        used, = con.execute('SELECT used FROM descriptors').fetchone()
+        cache.get_many(['f'])
+        self.assertEqual(con.execute('SELECT used FROM descriptors').fetchone()[0], used)
+
+    def test_eviction(self):
+        cache = DescriptorCache(self.file_path, 10)
+        with clock():
+            cache.put_many([('f%d' % i, {}) for i in range(10)])
+            cache.get_many(['f0'])
+            cache.put_many([('f10', {})])
+        # recently used rows are kept, cache is shrunk below maxsize
+        found = cache.get_many(['f%d' % i for i in range(11)])
+        self.assertIn('f0', found)
+        self.assertIn('f10', found)
+        self.assertLess(len(found), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
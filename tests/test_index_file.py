@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import json
+import numpy as np
+import os
+import tempfile
+import unittest
+from MARS.files.Zulfia import fold
+from MARS.files.Tanimoto import popcount
+from MARS.files.MinHash import signatures, band_keys, bucket_rows
+from MARS.files.IndexFile import FingerprintIndex, ShardedIndex, DeltaIndex, LSHTables, IndexFormatError, \
+    write_index, write_shards, append_delta, write_lsh
+from tests.test_tanimoto import random_words
+
+
+class TestIndexFile(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.words = random_words(500)
+        self.counts = popcount(self.words)
+        self.ids = np.arange(1, 501, dtype=np.int64) * 2
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def test_index_round_trip(self):
+        write_index(self.path('x.idx'), self.ids, self.words, self.counts, folds=(128, 256, 4096))
+        index = FingerprintIndex(self.path('x.idx'))
+        self.assertEqual(index.size, 500)
+        self.assertEqual(index.max_id, 1000)
+        # rows are sorted by popcount and id
+        order = np.lexsort((self.ids, self.counts))
+        self.assertTrue(np.array_equal(index.ids, self.ids[order]))
+        self.assertTrue(np.array_equal(index.counts, self.counts[order]))
+        self.assertTrue(np.array_equal(index.fingerprints, self.words[order]))
+        # folds not less than fingerprint length are skipped
+        self.assertEqual([x for x, _ in index.folded], [128, 256])
+        for x, folded in index.folded:
+            self.assertTrue(np.array_equal(folded, fold(self.words[order], x)))
+
+    def test_empty_index(self):
+        write_index(self.path('x.idx'), [], np.empty((0, 16), dtype=np.uint64), [])
+        index = FingerprintIndex(self.path('x.idx'))
+        self.assertEqual(index.size, 0)
+        self.assertEqual(index.fingerprints.shape, (0, 16))
+
+    def test_broken_index(self):
+        write_index(self.path('x.idx'), self.ids, self.words, self.counts)
+        with open(self.path('x.idx'), 'r+b') as f:
+            f.truncate(1000)
+        self.assertRaises(IndexFormatError, FingerprintIndex, self.path('x.idx'))
+        with open(self.path('y.idx'), 'wb') as f:
+            f.write(b'\0' * 100)
+        self.assertRaises(IndexFormatError, FingerprintIndex, self.path('y.idx'))
+
+    def test_shards(self):
+        manifest = self.path('Molecules.shards.json')
+        write_shards(manifest, self.ids, self.words, self.counts, 3)
+        index = ShardedIndex(manifest)
+        self.assertEqual(len(index.shards), 3)
+        self.assertEqual(index.size, 500)
+        self.assertEqual(index.max_id, 1000)
+        # shards keep consecutive id ranges
+        ranges = sorted((x.ids.min(), x.ids.max()) for x in index.shards)
+        self.assertTrue(all(a[1] < b[0] for a, b in zip(ranges, ranges[1:])))
+        self.assertTrue(np.array_equal(np.sort(np.concatenate([x.ids for x in index.shards])), self.ids))
+
+        old = index.files
+        write_shards(manifest, self.ids[:10], self.words[:10], self.counts[:10], 2)
+        index = ShardedIndex(manifest)
+        self.assertEqual(index.generation, 2)
+        self.assertEqual(index.size, 10)
+        self.assertFalse(any(os.path.exists(self.path(x)) for x in old))
+
+    def test_broken_manifest(self):
+        with open(self.path('Molecules.shards.json'), 'w') as f:
+            json.dump(dict(version=-1), f)
+        self.assertRaises(IndexFormatError, ShardedIndex, self.path('Molecules.shards.json'))
+
+    def test_delta(self):
+        delta = self.path('x.delta.idx')
+        append_delta(delta, self.ids[:10], self.words[:10], self.counts[:10], 3)
+        append_delta(delta, self.ids[10:15], self.words[10:15], self.counts[10:15], 4)
+        index = DeltaIndex(delta, folds=(128,))
+        self.assertEqual((index.size, index.generation), (15, 4))
+        self.assertTrue(np.array_equal(index.ids, self.ids[:15]))
+        self.assertTrue(np.array_equal(index.counts, self.counts[:15]))
+        self.assertTrue(np.array_equal(index.fingerprints, self.words[:15]))
+        self.assertTrue(np.array_equal(index.folded[0][1], fold(self.words[:15], 128)))
+
+        # empty update advances generation only
+        append_delta(delta, [], self.words[:0], [], 5)
+        index = DeltaIndex(delta)
+        self.assertEqual((index.size, index.generation), (15, 5))
+
+        # rows merged into index by interrupted compaction are skipped
+        index = DeltaIndex(delta, min_id=self.ids[9])
+        self.assertTrue(np.array_equal(index.ids, self.ids[10:15]))
+        self.assertRaises(IndexFormatError, append_delta, delta, self.ids[:1], self.words[:1, :2], self.counts[:1])
+
+    def test_lsh(self):
+        keys = band_keys(signatures(self.words, 32), 16, 2)
+        write_lsh(self.path('x.lsh.idx'), self.ids, self.words, self.counts, keys, 2, 1024, 'ab' * 16)
+        index = LSHTables(self.path('x.lsh.idx'))
+        self.assertEqual((index.size, index.bands, index.band_rows, index.max_id), (500, 16, 2, 1000))
+        self.assertEqual((index.bits, index.identity), (1024, 'ab' * 16))
+        self.assertTrue(np.all(index.keys[:, 1:] >= index.keys[:, :-1]))
+        self.assertTrue(np.array_equal(np.take_along_axis(keys, index.order, axis=1), index.keys))
+
+        # every row is candidate of itself
+        found = bucket_rows(index.keys, index.order, keys[:, :50])
+        self.assertTrue(all(n in rows for n, rows in enumerate(found)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import unittest
+from MARS.files.Tanimoto import tanimoto
+from MARS.files.MinHash import signatures, band_keys, bucket_rows, candidate_probability, recall
+from tests.test_tanimoto import random_words
+
+
+class TestMinHash(unittest.TestCase):
+    def test_signatures(self):
+        words = random_words(300)
+        s = signatures(words, 64)
+        self.assertEqual(s.shape, (300, 64))
+        # signatures don't depend on blocks
+        self.assertTrue(np.array_equal(s[100:], signatures(words[100:], 64)))
+        self.assertTrue(np.array_equal(s[9], s[10]))
+        self.assertTrue(np.all(signatures(np.zeros((2, 16), dtype=np.uint64), 8) == 1024))
+
+    def test_similarity_estimate(self):
+        words = random_words(50)
+        s = signatures(words, 1024)
+        estimate = (s[0] == s).mean(axis=1)
+        self.assertLess(np.abs(estimate - tanimoto(words[0], words)).max(), .1)
+
+    def test_buckets(self):
+        words = random_words(200)
+        keys = band_keys(signatures(words, 32), 8, 4)
+        order = np.argsort(keys, axis=1, kind='mergesort')
+        found = bucket_rows(np.take_along_axis(keys, order, axis=1), order, keys)
+        for n, rows in enumerate(found):
+            self.assertIn(n, rows)
+            self.assertTrue(np.array_equal(rows, np.unique(rows)))
+        # duplicate rows share all buckets
+        self.assertIn(10, found[9])
+
+    def test_candidate_probability(self):
+        self.assertEqual(candidate_probability(1., 32, 4), 1.)
+        self.assertEqual(candidate_probability(0., 32, 4), 0.)
+        self.assertGreater(candidate_probability(.8, 32, 4), candidate_probability(.5, 32, 4))
+
+    def test_recall(self):
+        self.assertEqual(recall([[.9, .8]], [[.9, .8]]), 1.)
+        self.assertEqual(recall([[.9, .8]], [[.9, .5]]), .5)
+        # tie with the worst exact hit is exact hit
+        self.assertEqual(recall([[.9, .8]], [[.8, .8]]), 1.)
+        self.assertEqual(recall([[]], [[]]), 1.)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+molecules to reactions index. links are inserted into temporary DB with raw SQL
+"""
+import numpy as np
+import os
+import tempfile
+import unittest
+from MARS.files.IndexFile import RolesIndex, write_roles
+from tests.database import bind, missing
+if missing is None:
+    from pony.orm import db_session
+    from MARS.models import db, Molecules, Reactions, ReactionsMolecules, get_db_identity
+    from MARS.files.RoleIndex import RoleIndex
+
+
+class TestRolesFile(unittest.TestCase):
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            file_path = os.path.join(tmp, 'roles.idx')
+            hashes = np.array([5, 3, 5, 5, 3], dtype=np.uint64)
+            write_roles(file_path, hashes, [2, 1, 1, 2, 4], [False, False, False, False, True], 7, 'ab' * 16)
+            index = RolesIndex(file_path)
+            self.assertEqual(index.max_link, 7)
+            self.assertEqual(index.identity, 'ab' * 16)
+            self.assertEqual(list(index.keys), [3, 5])
+            # duplicated link is dropped
+            self.assertEqual([list(x) for x in index.reactions], [[1, 1, 2], [4]])
+            self.assertEqual(sorted(zip(*(list(x) for x in index.links()))),
+                             [(3, 1, False), (3, 4, True), (5, 1, False), (5, 2, False)])
+
+
+@unittest.skipIf(missing, 'dependencies are not installed: %s' % missing)
+class TestRoleIndex(unittest.TestCase):
+    def setUp(self):
+        self.dump_path = tempfile.mkdtemp(dir=bind())
+        self.links = 0
+        with db_session():
+            cursor = db.get_connection().cursor()
+            cursor.executemany('INSERT INTO "%s" ("id", "data", "fear", "fingerprint") VALUES (?, ?, ?, ?)' %
+                               Molecules._table_, [(i, '{}', 'fear%d' % i, b'') for i in range(1, 4)])
+            cursor.executemany('INSERT INTO "%s" ("id", "fear", "fingerprint") VALUES (?, ?, ?)' %
+                               Reactions._table_, [(i, 'reaction%d' % i, b'') for i in range(1, 3)])
+
+    def link(self, molecule, reaction, product):
+        with db_session():
+            db.get_connection().cursor().execute(
+                'INSERT INTO "%s" ("%s", "%s", "%s", "%s") VALUES (?, ?, ?, ?)' %
+                (ReactionsMolecules._table_, ReactionsMolecules.molecule.column, ReactionsMolecules.reaction.column,
+                 ReactionsMolecules.product.column, ReactionsMolecules.mapping.column),
+                (molecule, reaction, product, '{}'))
+
+    def test_update(self):
+        self.link(1, 1, False)
+        self.link(2, 1, True)
+        with db_session():
+            index = RoleIndex(dump_path=self.dump_path)
+            self.assertEqual(list(index.search(['fear1'], ['fear2'])), [1])
+            self.assertEqual(list(index.get_reactions('fear3')), [])
+
+        # links added after build are merged
+        self.link(1, 2, False)
+        self.link(3, 2, True)
+        with db_session():
+            index = RoleIndex(dump_path=self.dump_path)
+            self.assertEqual(index.size, 3)
+            self.assertEqual(list(index.get_reactions('fear1', False)), [1, 2])
+            self.assertEqual(list(index.search(products=['fear3'])), [2])
+
+    def test_other_database(self):
+        self.link(1, 1, False)
+        file_path = os.path.join(self.dump_path, 'ReactionsMolecules.idx')
+        with db_session():
+            RoleIndex(dump_path=self.dump_path)
+            identity = get_db_identity()
+            self.assertEqual(RolesIndex(file_path).identity, identity)
+            cursor = db.get_connection().cursor()
+            cursor.execute('UPDATE "Identity" SET "token" = ?', ('cd' * 16,))
+            try:
+                # number of links is the same, but index is rebuilt for new DB
+                index = RoleIndex(dump_path=self.dump_path)
+                self.assertEqual(RolesIndex(file_path).identity, 'cd' * 16)
+                self.assertEqual(index.size, 1)
+            finally:
+                cursor.execute('UPDATE "Identity" SET "token" = ?', (identity,))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import os
+import tempfile
+import unittest
+from MARS.files.Snapshot import SnapshotWriter, SnapshotFormatError, read_snapshot
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp.name, 'db.snapshot')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        ids = np.arange(5, dtype=np.int64)
+        fingerprints = np.arange(15, dtype=np.uint8).reshape(5, 3)
+        text = ['a', None, 'юникод', '', 'e']
+        blobs = [b'\0\1', None, b'', b'x', b'yz']
+        with SnapshotWriter(self.file_path) as snapshot:
+            snapshot.write('Molecules', [('id', ids), ('fingerprint', fingerprints), ('fear', text),
+                                         ('packed', blobs)])
+            snapshot.write('Molecules', [('id', ids[:1]), ('fingerprint', fingerprints[:1]), ('fear', ['z']),
+                                         ('packed', [None])])
+            snapshot.write('Reactions', [('id', np.empty(0, dtype=np.int64))])
+
+        chunks = list(read_snapshot(self.file_path))
+        self.assertEqual([t for t, _ in chunks], ['Molecules', 'Molecules', 'Reactions'])
+        columns = dict(chunks[0][1])
+        self.assertEqual(list(columns), ['id', 'fingerprint', 'fear', 'packed'])
+        self.assertTrue(np.array_equal(columns['id'], ids))
+        self.assertEqual(columns['id'].dtype, np.int64)
+        self.assertTrue(np.array_equal(columns['fingerprint'], fingerprints))
+        self.assertEqual(columns['fear'], text)
+        self.assertEqual(columns['packed'], blobs)
+        self.assertEqual(dict(chunks[1][1])['packed'], [None])
+        self.assertEqual(len(dict(chunks[2][1])['id']), 0)
+
+    def test_failed_write(self):
+        with self.assertRaises(ValueError):
+            with SnapshotWriter(self.file_path) as snapshot:
+                snapshot.write('Molecules', [('id', np.arange(2)), ('fear', ['a'])])
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_broken(self):
+        with SnapshotWriter(self.file_path) as snapshot:
+            snapshot.write('Molecules', [('id', np.arange(100))])
+        with open(self.file_path, 'r+b') as f:
+            f.truncate(300)
+        with self.assertRaises(SnapshotFormatError):
+            list(read_snapshot(self.file_path))
+
+        with open(self.file_path, 'wb') as f:
+            f.write(b'\0' * 64)
+        with self.assertRaises(SnapshotFormatError):
+            list(read_snapshot(self.file_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
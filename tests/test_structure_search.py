@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+enclosure reaction search. CGRs and fingerprints of query reactions are mocked
+"""
+import io
+import unittest
+from contextlib import redirect_stderr
+from unittest import mock
+try:
+    import networkx as nx
+    from MARS.CLI import main_structure_search
+    from MARS.models import Reactions
+except ImportError as e:
+    missing = e
+else:
+    missing = None
+
+
+@unittest.skipIf(missing, 'dependencies are not installed: %s' % missing)
+class TestEnclosureSearch(unittest.TestCase):
+    def search(self, cgr):
+        index = mock.Mock()
+        index.get_containing_fingerprint.return_value = []
+        stderr = io.StringIO()
+        with mock.patch.object(main_structure_search, 'cgr_core', mock.Mock(**{'getCGR.return_value': cgr})), \
+                mock.patch.object(Reactions, 'get_cgr_fingerprints', return_value=[b'\x01']), \
+                redirect_stderr(stderr):
+            found = list(main_structure_search.enclosure_reaction_search(index, None))
+        return found, index, stderr.getvalue()
+
+    def test_empty_center(self):
+        cgr = nx.Graph()
+        cgr.add_node(1, s_charge=0, p_charge=0)
+        cgr.add_node(2, s_charge=0, p_charge=0)
+        cgr.add_edge(1, 2, s_bond=1, p_bond=1)
+        found, index, message = self.search(cgr)
+        self.assertEqual(found, [])
+        self.assertIn('no reaction center', message)
+        # every reaction would pass empty screen, so index isn't scanned
+        index.get_containing_fingerprint.assert_not_called()
+
+    def test_center(self):
+        cgr = nx.Graph()
+        cgr.add_node(1, s_charge=0, p_charge=0)
+        cgr.add_node(2, s_charge=0, p_charge=0)
+        cgr.add_edge(1, 2, s_bond=1, p_bond=2)
+        found, index, message = self.search(cgr)
+        self.assertEqual((found, message), ([], ''))
+        index.get_containing_fingerprint.assert_called_once_with(b'\x01')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import unittest
+from MARS.files.Zulfia import as_words, fold
+from MARS.files.Tanimoto import popcount, tanimoto, select_top, merge_top, top_k_batch, within, superset_rows, \
+    cascade_top_k, cascade_within, cascade_superset
+
+
+def random_words(rows, size=1024, seed=0):
+    """
+    fingerprints with varying density. every tenth row repeats previous one, so there are ties
+    """
+    rnd = np.random.RandomState(seed)
+    bits = rnd.random_sample((rows, size)) < rnd.uniform(.02, .3, (rows, 1))
+    bits[10::10] = bits[9:-1:10]
+    return as_words(np.packbits(bits, axis=1))
+
+
+def brute_similarity(query, words):
+    q = np.unpackbits(query.view(np.uint8))
+    m = np.unpackbits(words.view(np.uint8), axis=1)
+    common = (m & q).sum(axis=1)
+    union = (m | q).sum(axis=1)
+    return np.where(union, common / np.maximum(union, 1), 1.)
+
+
+def brute_top_k(query, words, k, labels):
+    s = brute_similarity(query, words)
+    order = np.lexsort((labels, -s))[:k]
+    return s[order], labels[order]
+
+
+class TestTanimoto(unittest.TestCase):
+    def setUp(self):
+        self.words = random_words(3000)
+        self.counts = popcount(self.words)
+        self.queries = random_words(20, seed=1)
+        self.labels = np.arange(3000, dtype=np.int64) * 3 + 1
+
+    def test_popcount(self):
+        self.assertTrue(np.array_equal(self.counts, np.unpackbits(self.words.view(np.uint8), axis=1).sum(axis=1)))
+
+    def test_tanimoto(self):
+        for q in self.queries:
+            self.assertTrue(np.allclose(tanimoto(q, self.words, self.counts), brute_similarity(q, self.words)))
+        self.assertTrue(np.allclose(tanimoto(self.queries, self.words),
+                                    [brute_similarity(q, self.words) for q in self.queries]))
+
+    def test_empty_fingerprints_are_equal(self):
+        empty = np.zeros((2, 16), dtype=np.uint64)
+        self.assertTrue(np.array_equal(tanimoto(empty[0], empty), [1., 1.]))
+
+    def test_top_k_batch(self):
+        # small block makes scan merge many blocks
+        for block in (1024 * 20, 10 ** 7):
+            results = top_k_batch(self.queries, self.words, 7, self.counts, block=block, labels=self.labels)
+            for q, (s, i) in zip(self.queries, results):
+                es, ei = brute_top_k(q, self.words, 7, self.labels)
+                self.assertTrue(np.allclose(s, es))
+                self.assertTrue(np.array_equal(i, ei))
+
+    def test_top_k_of_duplicate(self):
+        s, i = top_k_batch(self.words[9:10], self.words, 2, self.counts)[0]
+        self.assertTrue(np.array_equal(s, [1., 1.]))
+        self.assertTrue(np.array_equal(i, [9, 10]))
+
+    def test_merge_of_shards(self):
+        for q in self.queries:
+            parts = [select_top(tanimoto(q, self.words[x]), self.labels[x], 5)
+                     for x in np.array_split(np.arange(3000), 4)]
+            s, i = merge_top(parts, 5)
+            es, ei = brute_top_k(q, self.words, 5, self.labels)
+            self.assertTrue(np.allclose(s, es))
+            self.assertTrue(np.array_equal(i, ei))
+        s, i = merge_top([], 5)
+        self.assertEqual(len(s), 0)
+        self.assertEqual(len(i), 0)
+
+    def test_no_neighbors(self):
+        for s, i in top_k_batch(self.queries[:2], self.words, 0, self.counts, labels=self.labels):
+            self.assertEqual((len(s), len(i)), (0, 0))
+        s, i = select_top(np.ones(3), np.arange(3), 0)
+        self.assertEqual((len(s), len(i)), (0, 0))
+
+    def test_within_pruning(self):
+        order = np.argsort(self.counts, kind='mergesort')
+        words, counts = self.words[order], self.counts[order]
+        for threshold in (0., .2, .5, 1.):
+            for q in self.queries[:5]:
+                expected = np.flatnonzero(brute_similarity(q, words) >= threshold)
+                for ordered in (False, True):
+                    s, rows = within(q, words, threshold, counts, block=500, ordered=ordered)
+                    self.assertTrue(np.array_equal(np.sort(rows), expected))
+                    self.assertTrue(np.all(s >= threshold))
+
+    def test_superset(self):
+        order = np.argsort(self.counts, kind='mergesort')
+        words, counts = self.words[order], self.counts[order]
+        for n in (0, 100, 2999):
+            # random sparse substructure of row
+            q = words[n] & random_words(1, seed=n)[0]
+            expected = np.flatnonzero(((words & q) == q).all(axis=1))
+            self.assertIn(n, expected)
+            self.assertTrue(np.array_equal(superset_rows(q, words, block=700), expected))
+            self.assertTrue(np.array_equal(superset_rows(q, words, counts=counts), expected))
+
+    def test_cascade(self):
+        order = np.argsort(self.counts, kind='mergesort')
+        words, counts, labels = self.words[order], self.counts[order], self.labels[order]
+        levels = [(x, fold(words, x)) for x in (128, 512)]
+        for q in self.queries[:5]:
+            s, i = cascade_top_k(q, words, 10, counts, levels, labels)
+            es, ei = brute_top_k(q, words, 10, labels)
+            self.assertTrue(np.allclose(s, es))
+            self.assertTrue(np.array_equal(i, ei))
+
+            for threshold in (.1, .3):
+                _, rows = cascade_within(q, words, threshold, counts, levels, ordered=True)
+                self.assertTrue(np.array_equal(np.sort(rows), np.flatnonzero(brute_similarity(q, words) >= threshold)))
+
+        s, i = cascade_top_k(self.queries[0], words, 0, counts, levels, labels)
+        self.assertEqual((len(s), len(i)), (0, 0))
+
+        for n in (0, 100, 2999):
+            q = words[n] & random_words(1, seed=n)[0]
+            self.assertTrue(np.array_equal(np.sort(cascade_superset(q, words, levels, counts)),
+                                           np.flatnonzero(((words & q) == q).all(axis=1))))
+
+
+if __name__ == '__main__':
+    unittest.main()
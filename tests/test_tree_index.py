@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+update paths of similarity indexes. Molecules table of temporary DB is filled with random fingerprints
+"""
+import json
+import numpy as np
+import os
+import pickle
+import tempfile
+import unittest
+from tests.test_tanimoto import brute_similarity
+from tests.database import bind, missing
+if missing is None:
+    from pony.orm import db_session
+    from MARS.models import db, Molecules, bump_generation, get_generation
+    from MARS.config import FINGERPRINT_SIZES
+    from MARS.files.Zulfia import as_words
+    from MARS.files.TreeIndex import TreeIndex, COMPACT_RATIO
+    from MARS.files.IndexFile import ShardedIndex, LSHTables, write_lsh
+    from MARS.files.LSHIndex import LSHIndex
+
+
+@unittest.skipIf(missing, 'dependencies are not installed: %s' % missing)
+class IndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rnd = np.random.RandomState(0)
+        self.dump_path = tempfile.mkdtemp(dir=bind())
+        self.fingerprints = np.empty((0, FINGERPRINT_SIZES['Molecules'] // 8), dtype=np.uint8)
+
+    def add(self, rows):
+        """
+        insert molecules with random fingerprints
+
+        :return: ids and fingerprints as stored in DB
+        """
+        start = len(self.fingerprints) + 1
+        fps = np.packbits(self.rnd.random_sample((rows, FINGERPRINT_SIZES['Molecules'])) <
+                          self.rnd.uniform(.05, .3, (rows, 1)), axis=1)
+        self.fingerprints = np.vstack((self.fingerprints, fps))
+        ids = list(range(start, start + rows))
+        with db_session():
+            db.get_connection().cursor().executemany(
+                'INSERT INTO "%s" ("id", "data", "fear", "fingerprint") VALUES (?, ?, ?, ?)' % Molecules._table_,
+                [(i, '{}', 'fear%d' % i, x.tobytes()) for i, x in zip(ids, fps)])
+        return ids, [x.tobytes() for x in fps]
+
+    def commit(self, rows):
+        """
+        add molecules in new generation of DB
+
+        :return: ids, fingerprints and generation
+        """
+        ids, fps = self.add(rows)
+        with db_session():
+            bump_generation()
+            return ids, fps, get_generation()
+
+    def brute_top_k(self, q, k):
+        s = brute_similarity(as_words(q), as_words(self.fingerprints))
+        order = np.lexsort((np.arange(len(s)), -s))[:k]
+        return list(order + 1)
+
+    def path(self, name):
+        return os.path.join(self.dump_path, name)
+
+
+class TestTreeIndex(IndexTestCase):
+    def test_engines(self):
+        self.add(100)
+        q = self.fingerprints[[0, 50]]
+        with db_session():
+            for engine in ('popcount', 'balltree'):
+                index = TreeIndex(Molecules, engine=engine, dump_path=self.dump_path)
+                for x, (d, found) in zip(q, index.get_similar_fingerprints(q, 5)):
+                    s = brute_similarity(as_words(x), as_words(self.fingerprints))
+                    self.assertTrue(np.allclose(1 - d, np.sort(s)[::-1][:5]))
+                    self.assertTrue(np.allclose(1 - d, s[[m.id - 1 for m in found]]))
+
+    def test_empty_table(self):
+        with db_session():
+            for engine in ('popcount', 'balltree'):
+                index = TreeIndex(Molecules, engine=engine, dump_path=self.dump_path)
+                q = np.zeros((2, FINGERPRINT_SIZES['Molecules'] // 8), dtype=np.uint8)
+                self.assertEqual([len(x) for _, x in index.get_similar_fingerprints(q, 3)], [0, 0])
+
+    def test_update_and_compact(self):
+        self.add(200)
+        with db_session():
+            TreeIndex(Molecules, dump_path=self.dump_path, jobs=2)
+        manifest = self.path('Molecules.shards.json')
+        TreeIndex.update(Molecules, *self.commit(5), dump_path=self.dump_path)
+        self.assertTrue(os.path.exists(self.path('Molecules.delta.idx')))
+
+        q = self.fingerprints[[0, 202]]
+        with db_session():
+            index = TreeIndex(Molecules, dump_path=self.dump_path, jobs=2)
+            self.assertEqual(index.size, 205)
+            # index with delta isn't rebuilt
+            self.assertEqual(ShardedIndex(manifest).generation, 1)
+            for x, (_, found) in zip(q, index.get_similar_fingerprints(q, 5)):
+                self.assertEqual([m.id for m in found], self.brute_top_k(x, 5))
+            _, found = index.get_within_fingerprints(q[1:], 1.)[0]
+            self.assertIn(203, [m.id for m in found])
+
+        # update without entities of index advances its generation
+        TreeIndex.update(Molecules, [], [], self.commit(0)[2], dump_path=self.dump_path)
+        TreeIndex.update(Molecules, *self.commit(int(COMPACT_RATIO * 200)), dump_path=self.dump_path)
+        self.assertFalse(os.path.exists(self.path('Molecules.delta.idx')))
+        self.assertEqual(ShardedIndex(manifest).generation, 2)
+        with db_session():
+            index = TreeIndex(Molecules, dump_path=self.dump_path)
+            self.assertEqual(ShardedIndex(manifest).generation, 2)
+            self.assertEqual(index.size, len(self.fingerprints))
+            for x, (_, found) in zip(q, index.get_similar_fingerprints(q, 5)):
+                self.assertEqual([m.id for m in found], self.brute_top_k(x, 5))
+
+    def test_stale_index(self):
+        self.add(50)
+        with db_session():
+            TreeIndex(Molecules, dump_path=self.dump_path)
+        manifest = self.path('Molecules.shards.json')
+
+        # rows added without update
+        self.add(3)
+        with db_session():
+            self.assertEqual(TreeIndex(Molecules, dump_path=self.dump_path).size, 53)
+        self.assertEqual(ShardedIndex(manifest).generation, 2)
+
+        # generation changed without update
+        with db_session():
+            bump_generation()
+            TreeIndex(Molecules, dump_path=self.dump_path)
+        self.assertEqual(ShardedIndex(manifest).generation, 3)
+
+        # index of other DB or fingerprints
+        for key, value in (('db', 'other'), ('bits', 8)):
+            with open(manifest) as f:
+                data = json.load(f)
+            data['state'][key] = value
+            with open(manifest, 'w') as f:
+                json.dump(data, f)
+            with db_session():
+                TreeIndex(Molecules, dump_path=self.dump_path)
+            self.assertEqual(ShardedIndex(manifest).generation, 4 if key == 'db' else 5)
+
+        # balltree dump keeps state too
+        with db_session():
+            TreeIndex(Molecules, engine='balltree', dump_path=self.dump_path)
+            bump_generation()
+            TreeIndex(Molecules, engine='balltree', dump_path=self.dump_path)
+            generation = get_generation()
+        with open(self.path('Molecules.bin'), 'rb') as f:
+            self.assertEqual(pickle.load(f)[2]['generation'], generation)
+
+
+class TestLSHIndex(IndexTestCase):
+    def test_update_and_compact(self):
+        self.add(200)
+        with db_session():
+            LSHIndex(Molecules, dump_path=self.dump_path, bands=16, rows=2)
+        ids, fps = self.add(5)
+        LSHIndex.update(Molecules, ids, fps, dump_path=self.dump_path)
+        self.assertTrue(os.path.exists(self.path('Molecules.lsh.delta.idx')))
+
+        with db_session():
+            index = LSHIndex(Molecules, dump_path=self.dump_path, bands=16, rows=2)
+            self.assertEqual(index.size, 205)
+            # delta is scanned exactly
+            _, found = index.get_within_fingerprints(self.fingerprints[[203]], 1.)[0]
+            self.assertIn(204, [m.id for m in found])
+
+        ids, fps = self.add(int(COMPACT_RATIO * 200))
+        LSHIndex.update(Molecules, ids, fps, dump_path=self.dump_path)
+        self.assertFalse(os.path.exists(self.path('Molecules.lsh.delta.idx')))
+        compacted = LSHTables(self.path('Molecules.lsh.idx'))
+        compacted = [np.array(x) for x in (compacted.ids, compacted.keys, compacted.order)]
+
+        with db_session():
+            LSHIndex(Molecules, reindex=True, dump_path=self.dump_path, bands=16, rows=2)
+        rebuilt = LSHTables(self.path('Molecules.lsh.idx'))
+        for x, y in zip(compacted, (rebuilt.ids, rebuilt.keys, rebuilt.order)):
+            self.assertTrue(np.array_equal(x, y))
+
+    def test_stale_index(self):
+        self.add(50)
+        file_path = self.path('Molecules.lsh.idx')
+        with db_session():
+            LSHIndex(Molecules, dump_path=self.dump_path, bands=16, rows=2)
+        tables = LSHTables(file_path)
+        keys = np.empty_like(tables.keys)
+        np.put_along_axis(keys, tables.order, tables.keys, axis=1)
+        bits, identity = tables.bits, tables.identity
+        self.assertEqual(bits, FINGERPRINT_SIZES['Molecules'])
+
+        # tables of other fingerprints size or DB
+        for other in ((bits // 2, identity), (bits, 'ab' * 16)):
+            write_lsh(file_path, tables.ids, tables.fingerprints, tables.counts, keys, 2, *other)
+            # delta of other fingerprints size isn't appended
+            LSHIndex.update(Molecules, *self.add(1), dump_path=self.dump_path)
+            self.assertEqual(os.path.exists(self.path('Molecules.lsh.delta.idx')), other[0] == bits)
+            with db_session():
+                self.assertEqual(LSHIndex(Molecules, dump_path=self.dump_path, bands=16, rows=2).size,
+                                 len(self.fingerprints))
+            rebuilt = LSHTables(file_path)
+            self.assertEqual((rebuilt.bits, rebuilt.identity), (bits, identity))
+            self.assertFalse(os.path.exists(self.path('Molecules.lsh.delta.idx')))
+
+
+if __name__ == '__main__':
+    unittest.main()